@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench.py is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+"""End-to-end fetch benchmark, against a local ISPRA stand-in.
+
+usage:
+
+    bench.py [ --engine=<engine> ] [ --workers=<n> ] [ --per-host=<n> ]
+             [ --throttle=<secs> ] [ --pool-size=<n> ] [ --cache ]
+             [ --archives=<n> ] [ --rows=<n> ] [ --latency=<secs> ]
+             [ --error-rate=<p> ] [ --truncate-rate=<p> ]
+             [ --url-prefix=<url> ]
+
+Unless --url-prefix is given, a stand-in server (see brace/standin.py)
+is started in-process. Fetches the first <archives> archives of the
+pollutant x region x year grid, and reports archives/s, bytes/s and
+p50/p99 per-archive latency.
+"""
+
+# Basic services and utilities
+import os
+import sys
+import shutil
+import tempfile
+
+# Time services
+from time import time
+
+# Options handling
+import getopt
+
+# logging
+import logging
+logging.basicConfig(format='-- %(message)s')
+
+logger = logging.getLogger("brace")
+logger.setLevel(logging.ERROR)
+
+import brace.network
+from brace.network import query, session
+
+from brace.ontology import pollutants_dict
+from brace.ontology import regions_dict
+
+from brace.opts import DEFAULT_FROM_YEAR, DEFAULT_TO_YEAR
+from brace.scheduler import FetchJob, FetchScheduler
+from brace.scheduler import DEFAULT_WORKERS, DEFAULT_MAX_PER_HOST
+from brace.asyncnet import AsyncEngine
+from brace.cache import ArchiveCache
+from brace.manifest import LocationManifest
+from brace.standin import StandinServer, DEFAULT_ROWS
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of values, None if there are none.
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def format_ms(secs):
+    if secs is None:
+        return "n/a"
+
+    return "%.1fms" % (1000 * secs)
+
+
+def tolerant(fetch, latencies):
+    """Wraps fetch, so that failed fetches yield None. The latencies of
+    successful fetches are appended to latencies.
+    """
+    def wrapper(job):
+        started = time()
+        try:
+            res = fetch(job)
+
+        except IOError:
+            return None
+
+        latencies.append(time() - started)
+        return res
+
+    return wrapper
+
+
+def main(args):
+    opts, args = getopt.getopt(args, "", [
+            "help", "engine=", "workers=", "per-host=", "throttle=",
+            "pool-size=", "cache", "archives=", "rows=", "latency=",
+            "error-rate=", "truncate-rate=", "url-prefix="])
+
+    engine = "threads"
+    workers = DEFAULT_WORKERS
+    per_host = DEFAULT_MAX_PER_HOST
+    throttle = 0.0
+    use_cache = False
+    archives = 100
+    url_prefix = None
+    standin = {'rows': DEFAULT_ROWS}
+
+    for o, a in opts:
+        if o == "--engine":
+            engine = a
+        elif o == "--workers":
+            workers = int(a)
+        elif o == "--per-host":
+            per_host = int(a)
+        elif o == "--throttle":
+            throttle = float(a)
+        elif o == "--pool-size":
+            session.pool_size = int(a)
+        elif o == "--cache":
+            use_cache = True
+        elif o == "--archives":
+            archives = int(a)
+        elif o == "--rows":
+            standin['rows'] = int(a)
+        elif o == "--latency":
+            standin['latency'] = float(a)
+        elif o == "--error-rate":
+            standin['error_rate'] = float(a)
+        elif o == "--truncate-rate":
+            standin['truncate_rate'] = float(a)
+        elif o == "--url-prefix":
+            url_prefix = a.rstrip("/")
+        elif o == "--help":
+            print __doc__
+            sys.exit()
+
+    server = None
+    if url_prefix is None:
+        server = StandinServer(("localhost", 0), **standin)
+        server.start()
+        url_prefix = server.url_prefix
+    brace.network.URL_PREFIX = url_prefix
+
+    (cache, manifest, tmpdir) = (None, None, None)
+    if use_cache:
+        tmpdir = tempfile.mkdtemp()
+        cache = ArchiveCache(tmpdir)
+        manifest = LocationManifest(os.path.join(tmpdir, "manifest.json"))
+
+    jobs = [FetchJob(p[0], r[0], year)
+            for p in pollutants_dict.all()
+            for r in regions_dict.all()
+            for year in range(DEFAULT_FROM_YEAR,
+                              1 + DEFAULT_TO_YEAR)][:archives]
+
+    latencies = []
+    if engine == "async":
+        scheduler = AsyncEngine(workers=workers, max_per_host=per_host,
+                                throttle=throttle, cache=cache,
+                                manifest=manifest)
+        latencies = scheduler.latencies
+    else:
+        scheduler = FetchScheduler(
+            tolerant(lambda job: query(job.region, job.pollutant, job.year,
+                                       cache, manifest), latencies),
+            workers=workers, max_per_host=per_host, throttle=throttle,
+            host=lambda job: url_prefix)
+
+    total_bytes = 0
+    fetched = 0
+    start = time()
+    try:
+        for (job, archive) in scheduler.imap(jobs):
+            if archive is None:
+                continue  # failed
+
+            archive.seek(0, os.SEEK_END)
+            total_bytes += archive.tell()
+            archive.close()
+            fetched += 1
+
+    except IOError, e:
+        print "aborted:     %s" % e  # the async engine stops on failures
+    elapsed = time() - start
+
+    print "engine:      %s (%d workers, %d per host)" % (
+        engine, workers, per_host)
+    print "archives:    %d in %.3fs, %.1f archives/s (%d failed)" % (
+        fetched, elapsed, fetched / elapsed, len(jobs) - fetched)
+    print "bytes:       %d, %.1f KB/s" % (
+        total_bytes, total_bytes / elapsed / 1024)
+    print "latency:     p50 %s, p99 %s" % (
+        format_ms(percentile(latencies, 0.50)),
+        format_ms(percentile(latencies, 0.99)))
+    if session.requests:
+        print "connections: %d requests, %d reused, %d opened" % (
+            session.requests, session.reused, session.connections)
+
+    session.close()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+    if tmpdir is not None:
+        shutil.rmtree(tmpdir, True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
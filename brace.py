@@ -8,7 +8,6 @@
 
 # TODO:
 # better abstraction
-# output by plugins
 # code cleanup
 # ... more ...
 
@@ -32,6 +31,9 @@ start = time()
 import zipfile
 import shutil
 
+# URL parsing
+import urlparse
+
 # opts handling
 from brace.opts import opts_mgr
 
@@ -41,12 +43,21 @@ from brace.ontology import regions_dict
 from brace.ontology import stations_dict
 
 # core modules
-from brace.network import download, query
+import brace.network
+from brace.network import download, query, session, is_archive
+from brace.scheduler import FetchJob, FetchScheduler
+from brace.asyncnet import AsyncEngine
+from brace.cache import ArchiveCache
+from brace.manifest import LocationManifest
+from brace.store import ArchiveStore
+from brace.parsed import ParsedCache
+from brace.availability import AvailabilityIndex, dump_plan
+from brace.cache import archive_key
 from brace.csvio import UnicodeReader
-from brace.data import DataRow, DataManager
+from brace.data import DataRow, DataManager, StreamingDataManager
 
-# output module
-from brace.out.dspl import DsplDumper
+# output plugins
+from brace.out.formats import create_dumper
 
 # logging, (set BRACE_DEBUG from the calling env to activate extra logging)
 import logging
@@ -59,8 +70,7 @@ logging.basicConfig(format=FORMAT)
 logger = logging.getLogger("brace")
 logger.setLevel(logging.INFO)
 
-# Temporary storage prefix
-TMP_DIR = "tmp/"
+# Output storage prefix
 OUT_DIR = "out/"
 
 try:
@@ -82,91 +92,248 @@ if not opts_mgr.regions:
 # main body
 if __name__ == "__main__":
 
-    data_mgr = DataManager()
+    if opts_mgr.streaming:
+        data_mgr = StreamingDataManager()
+    else:
+        data_mgr = DataManager()
+
+    session.pool_size = opts_mgr.pool_size
+
+    if opts_mgr.url_prefix:
+        brace.network.URL_PREFIX = opts_mgr.url_prefix
+
+    # the output is checked upfront (e.g. the bundle to update), before
+    # any data is fetched
+    dumper = create_dumper(opts_mgr.format, data_mgr, "out", opts_mgr)
+    try:
+        dumper.check()
+
+    except ValueError, e:
+        print (e)
+        sys.exit(-1)
+
+    (cache, manifest, availability, store) = (None, None, None, None)
+    if opts_mgr.cache:
+        availability = AvailabilityIndex(
+            os.path.join(opts_mgr.cache_dir, "availability.json"),
+            opts_mgr.availability_ttl)
+        stations_dict.index_path = os.path.join(opts_mgr.cache_dir,
+                                                "stations.idx")
+
+        # data parsed from local archives is kept in a memory mapped
+        # format, to start up as fast as possible
+        if opts_mgr.local:
+            store = ParsedCache(os.path.join(opts_mgr.cache_dir, "parsed"))
+        else:
+            store = ArchiveStore(os.path.join(opts_mgr.cache_dir,
+                                              "store.sqlite"))
+
+        if not opts_mgr.local:
+            cache = ArchiveCache(opts_mgr.cache_dir, opts_mgr.cache_size)
+            manifest = LocationManifest(
+                os.path.join(opts_mgr.cache_dir, "manifest.json"))
+
+    # the stations registry may not cover every region (the one
+    # shipped with brace covers Lombardia only), archives of the other
+    # regions can not be parsed
+    known = set(regcode for (regcode, _, _, _) in stations_dict.all())
+    unknown = [regions_dict.get_name(r) for r in opts_mgr.regions
+               if r not in known]
+    if unknown:
+        logger.warning("No stations known for %s in '%s', their data "
+                       "will not be available.", ", ".join(unknown),
+                       stations_dict.path)
 
     # Phase 1. Fetch data
-    total_rows = 0
-    for pollutant_code in opts_mgr.pollutants:
+    def fetch(job):
+        """Fetches the archive for a single (pollutant, region, year)
+        job. This runs on a scheduler worker thread.
+        """
+        (pollutant_code, region_code, year) = job
+
         pollutant_formula = pollutants_dict.get_formula(pollutant_code)
         pollutant_name = pollutants_dict.get_name(pollutant_code)
-
-        for region_code in opts_mgr.regions:
-            region_name = regions_dict.get_name(region_code)
-
+        region_name = regions_dict.get_name(region_code)
+
+        if not opts_mgr.local:
+            # fetch remote archive
+            logger.info(
+                "Trying to fetch data for year %d, pollutant '%s' (%s), "
+                "region '%s'", year, pollutant_formula, pollutant_name,
+                region_name)
+            archive = query(region_code, pollutant_code, year,
+                            cache, manifest)
+
+        else:
+            # use local archive
+            logger.info(
+                "Using local data for year %d, pollutant '%s' (%s), "
+                "region '%s'", year, pollutant_formula, pollutant_name,
+                region_name)
+            backup_name = '%s_%s_%s.zip' % (
+                region_code, pollutant_code, year)
+            archive = open(backup_name, "rt")
+
+        return archive
+
+    # jobs are laid out in the same order of a sequential run, the
+    # scheduler yields them back in this order.
+    jobs = [FetchJob(pollutant_code, region_code, year)
+            for pollutant_code in opts_mgr.pollutants
+            for region_code in opts_mgr.regions
             for year in range(opts_mgr.from_year,
-                              1 + opts_mgr.to_year):
-
-                if not opts_mgr.local:
-                    # fetch remote archive
-                    logger.info(
-                        "Trying to fetch data for year %d, pollutant '%s' (%s), "
-                        "region '%s'", year, pollutant_formula, pollutant_name,
-                        region_name)
-                    archive = query(region_code, pollutant_code, year)
-
-                else:
-                    # use local archive
-                    logger.info(
-                        "Using local data for year %d, pollutant '%s' (%s), "
-                        "region '%s'", year, pollutant_formula, pollutant_name,
-                        region_name)
-                    backup_name = '%s_%s_%s.zip' % (
-                        region_code, pollutant_code, year)
-                    archive = open(backup_name, "rt")
-
-                # copy it to local resource for later use
-                if (opts_mgr.keep):
-                    backup_name = '%s_%s_%s.zip' % (
-                        region_code, pollutant_code, year)
-
-                    bf = open(backup_name, "wt")
-                    shutil.copyfileobj(archive, bf)
-                    bf.close()
-
-                try:
-                    zf = zipfile.ZipFile(archive)
-                    for entry in zf.namelist():
-
-                        logger.info("Extracting '%s' ...", entry)
-                        zf.extract(entry, TMP_DIR)
-
-                        i = 0
-                        fullpath = os.path.join(TMP_DIR, entry)
+                              1 + opts_mgr.to_year)]
+
+    # prune combinations known to yield no data
+    if availability is not None and not opts_mgr.refresh:
+        pruned = [job for job in jobs if not availability.is_empty(
+                archive_key(job.region, job.pollutant, job.year))]
+
+        if len(pruned) < len(jobs):
+            logger.info("Skipping %d combinations known to yield no data",
+                        len(jobs) - len(pruned))
+        jobs = pruned
+
+    if opts_mgr.dry_run:
+        dump_plan(jobs, availability, manifest)
+        sys.exit()
+
+    if opts_mgr.engine == "async":
+        scheduler = AsyncEngine(workers=opts_mgr.workers,
+                                max_per_host=opts_mgr.per_host,
+                                throttle=opts_mgr.throttle,
+                                cache=cache,
+                                manifest=manifest)
+
+    else:
+        # local archives are not subject to per-host limits
+        host = not opts_mgr.local and \
+            urlparse.urlparse(brace.network.URL_PREFIX).netloc or None
+        scheduler = FetchScheduler(fetch,
+                                   workers=opts_mgr.workers,
+                                   max_per_host=opts_mgr.per_host,
+                                   throttle=opts_mgr.throttle,
+                                   host=lambda job: host)
 
-                        # data appears to be encoded using iso-8859-1,
-                        # it needs to be recoded to UTF-8.
-                        for row in UnicodeReader(open(fullpath),
-                                                 encoding="iso-8859-1"):
-
-                            assert row[1] == pollutant_formula
-
-                            data = {
-                                'region': region_name,
-                                'station': row[0],
-                                'pollutant': row[1] or pollutant_formula,
-                                'timestamp': row[2],
-                                'quantity': row[3]
-                                }
-
-                            data_mgr.append(**data)
-                            logger.debug("-- " + unicode(row))
-
-                            i += 1; total_rows += 1
-
-                        logger.info("Processed %d rows", i)
-
-                except Exception, e:
-                    logger.warning("Data unavailable [reason: %s]." % str(e))
-
-                archive.close()  # temp file will be removed automatically
-
-        # disk cleanup
-        if (os.path.exists(TMP_DIR)):
-            shutil.rmtree(TMP_DIR, True)  # TODO add something for errors
+    total_rows = 0
+    for ((pollutant_code, region_code, year), archive) in scheduler.imap(jobs):
+        pollutant_formula = pollutants_dict.get_formula(pollutant_code)
+        region_name = regions_dict.get_name(region_code)
+
+        # copy it to local resource for later use
+        if (opts_mgr.keep):
+            backup_name = '%s_%s_%s.zip' % (
+                region_code, pollutant_code, year)
+
+            bf = open(backup_name, "wt")
+            shutil.copyfileobj(archive, bf)
+            bf.close()
+
+        key = archive_key(region_code, pollutant_code, year)
+
+        # data already parsed from this very archive is reused, cached
+        # copies need not be read to be validated. Failures are known,
+        # along with the data parsed before them, for as long as the
+        # archive and the stations registry are unchanged.
+        (parsed, failure) = (None, None)
+        if store is not None:
+            validator = store.validator(
+                archive, cache is not None and cache.identify(archive))
+            failed_validator = "%s:%s" % (validator, stations_dict.digest)
+
+            failure = store.failure(key, failed_validator)
+            parsed = store.load(key, failure is None and validator or
+                                failed_validator)
+
+        # archives which can not be parsed entirely contribute the rows
+        # read before the failure, but are not known to be complete
+        # (or empty) either. Responses which are no archive at all (e.g.
+        # a 404 page) mean there is no data.
+        parsed_ok = True
+        if not is_archive(archive):
+            logger.warning("Data unavailable [reason: not an archive].")
+            archive_rows = 0
+
+        elif parsed is not None:
+            if failure is not None:
+                logger.warning("Data unavailable [reason: %s], as in "
+                               "earlier runs." % failure)
+                parsed_ok = False
+
+            logger.info("Reusing %d rows parsed earlier", len(parsed))
+            data_mgr.merge(parsed)
+            archive_rows = len(parsed)
+
+        else:
+            # rows are folded into data_mgr as they are read (e.g. into
+            # daily aggregates, with --streaming), unless the store needs
+            # them, hourly, to save the archive
+            if store is not None:
+                sink = DataManager()
+            else:
+                sink = data_mgr
+            already = len(sink)
+
+            try:
+                zf = zipfile.ZipFile(archive)
+                for entry in zf.infolist():
+                    if entry.filename.endswith("/"):
+                        continue  # a directory
+
+                    logger.info("Reading '%s' ...", entry.filename)
+                    member = zf.open(entry)
+
+                    # data appears to be encoded using iso-8859-1,
+                    # it needs to be recoded to UTF-8. Rows are decoded
+                    # on the fly, straight from the archive member.
+                    before = len(sink)
+                    try:
+                        sink.extend(region_name, pollutant_formula,
+                                    UnicodeReader(member,
+                                                  encoding="iso-8859-1"))
+
+                    finally:
+                        logger.info("Processed %d rows", len(sink) - before)
+
+                    member.close()
+
+                if store is not None:
+                    store.save(key, validator, sink)
+
+            except Exception, e:
+                logger.warning("Data unavailable [reason: %s]." % str(e))
+                parsed_ok = False
+
+                if store is not None:
+                    store.save_failure(key, failed_validator, str(e), sink)
+
+            archive_rows = len(sink) - already
+            if sink is not data_mgr:
+                data_mgr.merge(sink)
+
+            # what has been parsed so far survives an aborted run
+            if store is not None:
+                store.flush()
+
+        total_rows += archive_rows
+
+        archive.close()  # temp file will be removed automatically
+
+        if availability is not None and parsed_ok:
+            availability.record(key, archive_rows)
+
+    if cache is not None:
+        cache.flush()
+        manifest.flush()
+
+    if availability is not None:
+        availability.flush()
+
+    if store is not None:
+        store.close()
 
     # Phase 2. Dump output
     logger.info("Dumping output files...")
-    dumper = DsplDumper(data_mgr, "out.zip" )
 
     # try:
     #     dumper()
@@ -178,6 +345,22 @@ if __name__ == "__main__":
     dumper()  # avoid exception suppresion for development (pdb)
 
     # Phase 3. Show run stats
+    if session.requests:
+        logger.info(
+            "Issued %d HTTP requests, %d on reused keep-alive connections "
+            "(%d connections opened)", session.requests, session.reused,
+            session.connections)
+
+    if cache is not None:
+        logger.info(
+            "Archive cache: %d revalidated, %d downloaded", cache.hits,
+            cache.misses)
+
+    if store is not None:
+        logger.info(
+            "Archive store: %d archives reused, %d parsed", store.hits,
+            store.misses)
+
     logger.info(
         "Processed %d rows in %s", total_rows, "%d:%02d:%02d.%03d" % \
         reduce(lambda ll,b : divmod(ll[0],b) + ll[1:],
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Group-by aggregation services
+"""
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Standard collections
+import collections
+import itertools
+import operator
+
+from brace.ontology import pollutants_dict
+from brace.extsort import external_sort, DEFAULT_SORT_MEMORY
+
+# Estimated memory taken by each group held by group_by (in bytes), key
+# included
+GROUP_SIZE = 256
+
+# named tuple for a single aggregated group
+Aggregate = collections.namedtuple('Aggregate',
+    'region, station, day, pollutant, max, avg')
+
+
+def _fold(groups, pairs, max_groups=None):
+    """Folds (key, value) pairs into groups, a dict mapping keys to the
+    [max, sum, count] of their values. Stops at the first pair with a
+    new key once groups holds max_groups, and returns it. Returns None
+    when pairs are exhausted.
+    """
+    for (key, value) in pairs:
+        try:
+            acc = groups[key]
+
+        except KeyError:
+            if max_groups is not None and len(groups) >= max_groups:
+                return (key, value)
+
+            groups[key] = [value, value, 1]
+            continue
+
+        if acc[0] < value:
+            acc[0] = value
+        acc[1] += value
+        acc[2] += 1
+
+    return None
+
+
+def group_by(keys, values):
+    """Hash aggregation. Returns a dict mapping each distinct key to the
+    [max, sum, count] of its values. keys and values are parallel
+    iterables, in any order.
+    """
+    groups = {}
+    _fold(groups, itertools.izip(keys, values))
+
+    return groups
+
+
+def combine_groups(records):
+    """Combines partial groups. records are (key, max, sum, count)
+    tuples sorted by key, there may be several for the same key. Yields
+    a (key, [max, sum, count]) pair for each distinct key, in order.
+    """
+    for (key, partials) in itertools.groupby(records,
+                                             operator.itemgetter(0)):
+        (_, max_, sum_, count) = partials.next()
+        for (_, other_max, other_sum, other_count) in partials:
+            max_ = max(max_, other_max)
+            sum_ += other_sum
+            count += other_count
+
+        yield (key, [max_, sum_, count])
+
+
+def _partial_groups(groups, pending, pairs, max_groups):
+    """Yields the partial groups of pairs as (key, max, sum, count)
+    tuples, starting with groups and the pending pair (see _fold). At
+    most max_groups groups are held at once.
+    """
+    while True:
+        for (key, (max_, sum_, count)) in groups.iteritems():
+            yield (key, max_, sum_, count)
+
+        if pending is None:
+            return
+
+        groups.clear()
+        (key, value) = pending
+        groups[key] = [value, value, 1]
+        pending = _fold(groups, pairs, max_groups)
+
+
+def bounded_group_by(keys, values, max_memory=DEFAULT_SORT_MEMORY):
+    """Hash aggregation with bounded memory, see group_by. Returns an
+    iterator over (key, [max, sum, count]) pairs, one for each distinct
+    key, in no particular order. Keys are tuples of marshallable values.
+
+    At most max_memory MB worth of groups are held at once (see
+    GROUP_SIZE). Past that, partial groups go through an external sort
+    (see external_sort) and are combined (see combine_groups).
+    """
+    max_groups = max(1, int(max_memory * 1024 * 1024) // GROUP_SIZE)
+    pairs = itertools.izip(keys, values)
+
+    groups = {}
+    pending = _fold(groups, pairs, max_groups)
+    if pending is None:
+        return groups.iteritems()
+
+    logger.debug("More than %d groups, aggregating by sort", max_groups)
+    return combine_groups(external_sort(
+            _partial_groups(groups, pending, pairs, max_groups),
+            max_memory))
+
+
+def daily_aggregates(data_mgr, sort=True, sort_memory=DEFAULT_SORT_MEMORY):
+    """Yields daily max and average of the data held by data_mgr, one
+    Aggregate for each (region, station, pollutant, day) group. Groups
+    are computed with at most sort_memory MB of memory (see
+    bounded_group_by). Unless sort is False, groups are sorted by
+    region, station, pollutant formula and day, whatever the order of
+    the data; this is done in memory.
+    """
+    regions = data_mgr.regions
+    stations = data_mgr.stations
+
+    formulas = dict((pk, formula)
+                    for (pk, formula, _) in pollutants_dict.all())
+
+    def sort_key(group):
+        (region, station, pollutant, day) = group[0]
+        return (regions[region], stations[station], formulas[pollutant],
+                day)
+
+    groups = data_mgr.daily_groups(sort_memory)
+    if sort:
+        groups = sorted(groups, key=sort_key)
+
+    for ((region, station, pollutant, day), (max_, sum_, count)) in groups:
+        yield Aggregate(regions[region], stations[station], day, pollutant,
+                        max_, sum_ / count)
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""Event-driven network I/O services. Servlet and archive requests for
+many jobs are kept in flight on a single (asyncore based) event loop,
+instead of costing a blocking call each.
+"""
+import sys
+import time
+import heapq
+import socket
+import collections
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Event-driven socket services
+import asyncore
+
+# Temporary files support
+import tempfile
+
+# URL parsing
+import urlparse
+
+# Custom modules
+from brace.network import DOWNLOAD_RETRY_BUDGET, ARCHIVE_OK
+from brace.network import backoff_delay
+from brace.network import query_url, archive_url, extract_location
+
+from brace.cache import archive_key
+
+from brace.scheduler import DEFAULT_WORKERS
+from brace.scheduler import DEFAULT_MAX_PER_HOST
+from brace.scheduler import DEFAULT_THROTTLE
+
+# Size of a single socket read
+RECV_BUFFER_SIZE = 65536
+
+# Maximum number of redirects followed for a single request
+MAX_REDIRECTS = 5
+
+
+class HttpRequest(asyncore.dispatcher):
+    """A single non-blocking HTTP GET request. The response body is
+    spooled to a temporary file. When the request completes, callback
+    is invoked with the request itself and an error (None on success).
+    """
+
+    def __init__(self, url, address, callback, map, headers=None):
+        asyncore.dispatcher.__init__(self, map=map)
+
+        self.url = url
+        self.status = None
+        self.headers = {}
+        self.body = None
+        self.received = 0
+
+        self._callback = callback
+        self._head = ""
+        self._done = False
+
+        (_, netloc, path, params, query, _) = urlparse.urlparse(url)
+        path = urlparse.urlunparse(("", "", path or "/", params, query, ""))
+        self._outbuf = "GET %s HTTP/1.0\r\n" \
+                       "Host: %s\r\n" \
+                       "Connection: close\r\n" % (path, netloc)
+        for (k, v) in (headers or {}).items():
+            self._outbuf += "%s: %s\r\n" % (k, v)
+        self._outbuf += "\r\n"
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(address)
+
+        except socket.error:
+            self.close()
+            raise
+
+    def _parse_head(self, head):
+        lines = head.split("\r\n")
+
+        try:
+            self.status = int(lines[0].split()[1])
+
+        except (IndexError, ValueError):
+            raise IOError("Malformed response from '%s'" % self.url)
+
+        for line in lines[1:]:
+            if ":" in line:
+                (k, v) = line.split(":", 1)
+                self.headers[k.strip().lower()] = v.strip()
+
+    def _finish(self, error):
+        if self._done:
+            return
+        self._done = True
+
+        if self.body is not None:
+            self.body.seek(0)
+
+        self._callback(self, error)
+
+    def writable(self):
+        return bool(self._outbuf)
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self._outbuf)
+        self._outbuf = self._outbuf[sent:]
+
+    def handle_read(self):
+        data = self.recv(RECV_BUFFER_SIZE)
+
+        if self.body is None:
+            self._head += data
+            if "\r\n\r\n" not in self._head:
+                return
+
+            (head, data) = self._head.split("\r\n\r\n", 1)
+            self._parse_head(head)
+            self.body = tempfile.TemporaryFile()
+
+        if data:
+            self.body.write(data)
+            self.received += len(data)
+
+    def handle_close(self):
+        self.close()
+
+        if self.body is None:
+            self._finish(IOError("Incomplete response from '%s'" %
+                                 self.url))
+            return
+
+        length = self.headers.get("content-length")
+        if length is not None and int(length) != self.received:
+            self._finish(IOError("Truncated response from '%s' "
+                                 "(%d of %s bytes)" % (
+                        self.url, self.received, length)))
+            return
+
+        self._finish(None)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        self.close()
+        self._finish(error)
+
+
+class AsyncEngine(object):
+    """Fetches the archives for many (pollutant, region, year) jobs
+    concurrently on a single event loop. This provides the same imap
+    interface of brace.scheduler.FetchScheduler: results are yielded in
+    job order, fetch errors are re-raised when their turn comes.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 max_per_host=DEFAULT_MAX_PER_HOST,
+                 throttle=DEFAULT_THROTTLE, prefix=None,
+                 budget=DOWNLOAD_RETRY_BUDGET, cache=None, manifest=None):
+
+        self._workers = workers
+        self._max_per_host = max_per_host
+        self._throttle = throttle
+        self._prefix = prefix
+        self._budget = budget
+        self._cache = cache
+        self._manifest = manifest
+
+        self._map = {}
+        self._timers = []
+        self._pending = collections.deque()
+        self._results = {}
+
+        self._in_flight = 0
+        self._host_in_flight = collections.defaultdict(int)
+        self._host_next_slot = collections.defaultdict(float)
+        self._addresses = {}
+
+        # per-job fetch latencies (in seconds), in completion order
+        self.latencies = []
+
+        # number of jobs allowed to run ahead of the consumer
+        self._window = 2 * workers
+
+    # -- timers
+    def _call_later(self, delay, func):
+        heapq.heappush(self._timers, (time.time() + delay, id(func), func))
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            (_, _, func) = heapq.heappop(self._timers)
+            func()
+
+    # -- requests
+    def _address(self, netloc):
+        try:
+            return self._addresses[netloc]
+
+        except KeyError:
+            (host, _, port) = netloc.partition(":")
+            address = (socket.gethostbyname(host), int(port or 80))
+            self._addresses[netloc] = address
+            return address
+
+    def _request(self, url, on_success, on_failure, headers=None,
+                 attempts=0, redirects=0, started=None):
+        """Enqueues a GET request for url. on_success is called with the
+        completed request, on_failure with the exc_info of the last error.
+        """
+        self._pending.append((url, headers, on_success, on_failure,
+                              attempts, redirects, started or time.time()))
+
+    def _admit(self):
+        """Starts as many pending requests as limits allow.
+        """
+        now = time.time()
+
+        for _ in range(len(self._pending)):
+            if self._workers <= self._in_flight:
+                break
+
+            item = self._pending.popleft()
+            host = urlparse.urlparse(item[0]).netloc
+
+            if self._max_per_host <= self._host_in_flight[host] or \
+                    now < self._host_next_slot[host]:
+                self._pending.append(item)
+                continue
+
+            self._host_in_flight[host] += 1
+            self._host_next_slot[host] = now + self._throttle
+            self._in_flight += 1
+            self._start(host, *item)
+
+    def _start(self, host, url, headers, on_success, on_failure,
+               attempts, redirects, started):
+        attempts += 1
+
+        def completed(request, error):
+            self._host_in_flight[host] -= 1
+            self._in_flight -= 1
+            delay = backoff_delay(attempts)
+
+            if error is None and request.status in (301, 302, 303, 307):
+                location = request.headers.get("location")
+                request.body.close()
+
+                if location is None or MAX_REDIRECTS <= redirects:
+                    error = IOError("Too many redirects for '%s'" % url)
+                else:
+                    self._request(urlparse.urljoin(url, location),
+                                  on_success, on_failure, headers,
+                                  attempts, 1 + redirects, started)
+                    return
+
+            elif error is None and 500 <= request.status:
+                request.body.close()
+                error = IOError("Server error %d for '%s'" % (
+                        request.status, url))
+
+            # other responses (e.g. 404 for data which is not available)
+            # are handed over as they are, like brace.network._download
+            # does: client errors are not going to go away by retrying
+            if error is None:
+                logger.info("Downloaded %d bytes.", request.received)
+                on_success(request)
+
+            elif time.time() - started + delay <= self._budget:
+                logger.warning(str(error))
+                self._call_later(delay, lambda: self._request(
+                        url, on_success, on_failure, headers,
+                        attempts, redirects, started))
+
+            else:
+                try:
+                    raise IOError("Could not fetch '%s' after %d attempts "
+                                  "[%s]." % (url, attempts, error))
+
+                except IOError:
+                    on_failure(sys.exc_info())
+
+        logger.debug("Downloading url '%s', attempt %d", url, attempts)
+        try:
+            HttpRequest(url, self._address(host), completed, self._map,
+                        headers)
+
+        except Exception, e:
+            completed(None, e)
+
+    # -- jobs
+    def _start_job(self, index, job):
+        (pollutant, region, year) = job
+        key = archive_key(region, pollutant, year)
+        started = time.time()
+
+        def failed(exc_info):
+            self._results[index] = (None, exc_info)
+
+        def fetch(location, on_failure, conditional=True, known=False):
+            def fetched(request):
+                if known and request.status not in ARCHIVE_OK:
+                    # a known location which has gone stale
+                    request.body.close()
+                    on_failure()
+                    return
+
+                try:
+                    archive = request.body
+                    if self._cache is not None:
+                        try:
+                            archive = self._cache.reconcile(
+                                key, archive, request.status,
+                                request.headers.get("etag"),
+                                request.headers.get("last-modified"))
+
+                        except KeyError:
+                            if not conditional:
+                                raise
+
+                            # not modified, but the cached copy has gone
+                            # since it was revalidated: fetch it again,
+                            # unconditionally
+                            logger.info("Cached copy for '%s' is gone, "
+                                        "fetching it again.", key)
+                            fetch(location, on_failure, False, known)
+                            return
+
+                    if self._manifest is not None and \
+                            request.status in ARCHIVE_OK:
+                        self._manifest.record(
+                            key, location, archive,
+                            self._cache and self._cache.identify(archive))
+
+                except Exception:
+                    failed(sys.exc_info())
+                    return
+
+                self.latencies.append(time.time() - started)
+                self._results[index] = (archive, None)
+
+            headers = None
+            if self._cache is not None and conditional:
+                headers = self._cache.validators(key)
+
+            self._request(archive_url(location, self._prefix),
+                          fetched, on_failure, headers)
+
+        def resolved(request):
+            try:
+                location = extract_location(request.body)
+
+            except Exception:
+                failed(sys.exc_info())
+                return
+
+            finally:
+                request.body.close()
+
+            fetch(location, failed)
+
+        def resolve(exc_info=None, stale=True):
+            if stale:
+                logger.info("Known location for '%s' is stale, "
+                            "resolving it again.", key)
+                self._manifest.forget(key)
+
+            self._request(query_url(region, pollutant, year, self._prefix),
+                          resolved, failed)
+
+        location = self._manifest is not None and self._manifest.location(key)
+        if location:
+            fetch(location, resolve, known=True)
+        else:
+            resolve(stale=False)
+
+    def _step(self):
+        """Runs a single iteration of the event loop.
+        """
+        self._run_timers()
+        self._admit()
+
+        if self._map:
+            asyncore.loop(timeout=0.05, map=self._map, count=1)
+
+        else:
+            time.sleep(0.01)  # waiting on timers or throttling
+
+    def imap(self, jobs):
+        """Yields (job, archive) pairs, in job order.
+        """
+        jobs = list(jobs)
+
+        submitted = 0
+        try:
+            for (index, job) in enumerate(jobs):
+
+                # keep the loop busy, without running too far ahead
+                while submitted < min(len(jobs), index + self._window):
+                    self._start_job(submitted, jobs[submitted])
+                    submitted += 1
+
+                while index not in self._results:
+                    self._step()
+
+                (result, error) = self._results.pop(index)
+                if error is not None:
+                    raise error[0], error[1], error[2]
+
+                yield (job, result)
+
+        finally:
+            for channel in self._map.values():
+                channel.close()
+
+            self._map.clear()
+            self._pending.clear()
+            self._timers = []
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Persistent index of data availability for (region, pollutant, year)
+combinations
+"""
+import sys
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Threading support
+import threading
+
+from brace.jsonfile import JsonIndex
+from brace.cache import archive_key
+
+from brace.ontology import pollutants_dict
+from brace.ontology import regions_dict
+
+# Default time to live (in days) of availability information
+DEFAULT_AVAILABILITY_TTL = 30
+
+
+class AvailabilityIndex(object):
+    """Records how many usable rows each (region, pollutant, year)
+    combination yielded, and when. Combinations which yielded no rows
+    recently enough (within ttl days) are known to be empty, and need
+    not be fetched at all.
+
+    Changes are kept in memory and merged into the index file when
+    flushed.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_AVAILABILITY_TTL):
+        self._index = JsonIndex(path)
+        self._lock = threading.Lock()
+        self._changes = {}
+
+        self.ttl = ttl * 86400
+
+    def get(self, key):
+        with self._lock:
+            if key in self._changes:
+                return self._changes[key]
+
+        return self._index.get(key)
+
+    def is_empty(self, key):
+        """Returns True iff key is known to yield no rows.
+        """
+        entry = self.get(key)
+        return entry is not None and not entry["rows"] and \
+            time.time() - entry["checked"] < self.ttl
+
+    def rows(self, key):
+        """Returns the number of rows key yielded last time, or None.
+        """
+        entry = self.get(key)
+        return entry and entry["rows"]
+
+    def record(self, key, rows):
+        with self._lock:
+            self._changes[key] = {
+                'rows': rows,
+                'checked': time.time(),
+            }
+
+    def flush(self):
+        """Merges the changes into the index file.
+        """
+        with self._lock:
+            (changes, self._changes) = (self._changes, {})
+
+        if changes:
+            self._index.update(lambda data: data.update(changes))
+
+
+def dump_plan(jobs, availability=None, manifest=None, out=sys.stdout):
+    """Writes a fetch plan to out, along with the estimated bytes and
+    rows for each job. Jobs never seen before are estimated with the
+    average of the known ones.
+    """
+    def known(func):
+        values = [func(archive_key(job.region, job.pollutant, job.year))
+                  for job in jobs]
+        return [v for v in values if v is not None]
+
+    def size(key):
+        entry = manifest and manifest.get(key)
+        return entry and entry["size"]
+
+    def rows(key):
+        return availability and availability.rows(key)
+
+    def average(values):
+        return values and sum(values) / len(values) or None
+
+    avg_size = average(known(size))
+    avg_rows = average(known(rows))
+
+    total_size = total_rows = 0
+    for job in jobs:
+        key = archive_key(job.region, job.pollutant, job.year)
+
+        job_size = size(key)
+        if job_size is None:
+            job_size = avg_size
+
+        job_rows = rows(key)
+        if job_rows is None:
+            job_rows = avg_rows
+
+        out.write("%-22s %-5s %d %12s bytes %10s rows\n" % (
+                regions_dict.get_name(job.region),
+                pollutants_dict.get_formula(job.pollutant), job.year,
+                job_size is None and "?" or "~%d" % job_size,
+                job_rows is None and "?" or "~%d" % job_rows))
+
+        total_size += job_size or 0
+        total_rows += job_rows or 0
+
+    out.write("%d archives, ~%d bytes, ~%d rows\n" % (
+            len(jobs), total_size, total_rows))
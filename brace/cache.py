@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed on-disk cache for fetched archives
+"""
+import os
+import time
+import errno
+import hashlib
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Threading support
+import threading
+
+from brace.jsonfile import JsonIndex
+
+# Default cache location
+DEFAULT_CACHE_DIR = "cache/"
+
+# Default cache size limit (in MB)
+DEFAULT_CACHE_SIZE = 512
+
+# Size of a single read when hashing/copying archives
+COPY_BUFFER_SIZE = 65536
+
+
+def archive_key(region, pollutant, year):
+    """Returns the key identifying the archive for a given region,
+    pollutant and year (all codes).
+    """
+    return "%s_%s_%s" % (region, pollutant, year)
+
+
+class ArchiveCache(object):
+    """Caches archives on disk. Archives are stored once per content
+    hash (sha1) under objects/, an index maps each (region, pollutant,
+    year) key to its current archive and to the validators (ETag and
+    Last-Modified) needed to revalidate it with a conditional request.
+
+    The total size of the stored archives is bounded, least recently
+    used entries are evicted first. The cache is thread-safe, and runs
+    sharing the same cache directory can safely update the index.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self._path = path
+        self._objects = os.path.join(path, "objects")
+
+        self.max_size = max_size * 1024 * 1024
+
+        self._lock = threading.RLock()
+        self._touched = {}
+
+        # run stats
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self._objects):
+            os.makedirs(self._objects)
+
+        self._index = JsonIndex(os.path.join(path, "index.json"))
+
+    def _update(self, func):
+        """Applies func to the index, along with the access times of the
+        entries used so far, and evicts entries over the size limit.
+        """
+        with self._lock:
+            (touched, self._touched) = (self._touched, {})
+
+        def update(index):
+            for (key, atime) in touched.items():
+                if key in index:
+                    index[key]["atime"] = max(atime, index[key]["atime"])
+
+            func(index)
+            self._evict(index)
+
+        self._index.update(update)
+
+    def _evict(self, index):
+        blobs = {}
+        for entry in index.values():
+            blobs[entry["sha1"]] = entry["size"]
+
+        total = sum(blobs.values())
+        for key in sorted(index, key=lambda k: index[k]["atime"]):
+            if total <= self.max_size:
+                break
+
+            sha1 = index.pop(key)["sha1"]
+            logger.debug("Evicting '%s' from cache", key)
+
+            if sha1 not in [e["sha1"] for e in index.values()]:
+                total -= blobs[sha1]
+                try:
+                    os.unlink(self._blob_path(sha1))
+
+                except OSError:
+                    pass
+
+    def _blob_path(self, sha1):
+        return os.path.join(self._objects, sha1[:2], sha1)
+
+    # -- public interface
+    def lookup(self, key):
+        """Returns the cache entry for key, or None.
+        """
+        entry = self._index.get(key)
+        if entry is None or not os.path.exists(self._blob_path(entry["sha1"])):
+            return None
+
+        return entry
+
+    def identify(self, archive):
+        """Returns the (size, sha1) of archive, a file object, if it is
+        a cached copy (see open and store), None otherwise. Cached
+        copies are stored by sha1, nothing needs to be read.
+        """
+        name = getattr(archive, "name", None)
+        if not isinstance(name, basestring) or \
+                os.path.dirname(os.path.dirname(name)) != self._objects:
+            return None
+
+        return (os.fstat(archive.fileno()).st_size, os.path.basename(name))
+
+    def validators(self, key):
+        """Returns the headers for a conditional request revalidating
+        the entry for key.
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def open(self, key):
+        """Opens the cached archive for key, which has been revalidated.
+        Raises KeyError if there is no cached copy (any more).
+        """
+        entry = self.lookup(key)
+        if entry is None:
+            raise KeyError("'%s' is not cached" % key)
+
+        try:
+            res = open(self._blob_path(entry["sha1"]), "rb")
+
+        except IOError:
+            raise KeyError("'%s' is not cached" % key)  # just evicted
+
+        with self._lock:
+            self.hits += 1
+            self._touched[key] = time.time()
+
+        return res
+
+    def store(self, key, archive, etag=None, last_modified=None):
+        """Stores archive (a file object) for key, along with its
+        validators. The archive is consumed and closed, an open file
+        object for the stored copy is returned.
+        """
+        sha1 = hashlib.sha1()
+        size = 0
+
+        tmp = os.path.join(self._objects, "tmp-%d-%d" % (
+                os.getpid(), threading.current_thread().ident))
+        with open(tmp, "wb") as out:
+            while True:
+                packet = archive.read(COPY_BUFFER_SIZE)
+                if not packet:
+                    break
+
+                sha1.update(packet)
+                out.write(packet)
+                size += len(packet)
+        archive.close()
+
+        sha1 = sha1.hexdigest()
+        blob = self._blob_path(sha1)
+        if not os.path.exists(os.path.dirname(blob)):
+            try:
+                os.makedirs(os.path.dirname(blob))
+
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        os.rename(tmp, blob)  # atomic, identical content anyway
+        res = open(blob, "rb")
+
+        def register(index):
+            index[key] = {
+                'sha1': sha1,
+                'size': size,
+                'etag': etag,
+                'last_modified': last_modified,
+                'atime': time.time(),
+            }
+
+        with self._lock:
+            self.misses += 1
+        self._update(register)
+
+        return res
+
+    def reconcile(self, key, archive, status, etag=None, last_modified=None):
+        """Reconciles the response to a (conditional) archive request
+        with the cache. Returns an open file object for the archive.
+        Raises KeyError if the archive has not been modified, but the
+        cached copy has gone in the meantime (e.g. evicted).
+        """
+        if status == 304:
+            logger.info("Archive not modified, using cached copy.")
+            archive.close()
+            return self.open(key)
+
+        # 206 is the final status of a transfer which has been resumed
+        if status in (200, 206):
+            return self.store(key, archive, etag, last_modified)
+
+        return archive  # not cacheable
+
+    def flush(self):
+        """Saves the access times of the entries used so far, so that
+        eviction sees them as recently used.
+        """
+        if self._touched:
+            self._update(lambda index: None)
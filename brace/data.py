@@ -5,28 +5,112 @@
 import logging
 logger = logging.getLogger("brace")
 
+import operator
+
 # Standard collections
 import collections
+import itertools
 
-# Time handling support
-import time
+# Compact storage support
+import array
 
 from brace.ontology import regions_dict
 from brace.ontology import stations_dict
 from brace.ontology import pollutants_dict
 
-from brace.exceptions import OntologyException
+from brace.exceptions import OntologyException, DataException
+from brace.timestamps import parse_hour, HOURS_PER_DAY
+from brace.aggregate import bounded_group_by, combine_groups
+from brace.extsort import external_sort, DEFAULT_SORT_MEMORY
+from brace.index import DataIndex
 
-# named tuple for lighteweight data storage
+# named tuple for lighteweight data storage, timestamps are hours
+# since the epoch (see brace.timestamps)
 DataRow = collections.namedtuple('DataRow',
     'region, station, pollutant, timestamp, quantity')
 
+# array typecodes of the (region, station, pollutant, timestamp,
+# quantity) columns
+COLUMN_TYPES = ('H', 'H', 'H', 'i', 'd')
+
+# array typecodes of the (region, station, pollutant, day, max, sum,
+# count) columns of daily accumulators, see StreamingDataManager
+GROUP_TYPES = ('H', 'H', 'H', 'i', 'd', 'd', 'i')
+
+# Maximum number of daily accumulators looked up by key, see
+# StreamingDataManager
+MAX_OPEN_GROUPS = 1 << 12
+
+
+def _extend(column, values):
+    """Appends values (an array, a buffer or any iterable) to column, an
+    array. Arrays and buffers (e.g. ctypes arrays) are copied at once.
+    """
+    if isinstance(values, array.array):
+        column.extend(values)
+        return
+
+    try:
+        column.fromstring(buffer(values))
+
+    except TypeError:
+        column.extend(values)
+
+
+def _recode(column, codes, values):
+    """Appends values (codes of another DataManager) to column, an
+    array, translated by codes (a list). Values are copied at once if
+    codes are the same.
+    """
+    if codes == range(len(codes)):
+        _extend(column, values)
+
+    else:
+        column.extend(array.array(column.typecode,
+                                  map(codes.__getitem__, values)))
+
+
+class Codebook(object):
+    """Dictionary encoding: maps values to small integer codes, and
+    back.
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self.values = []
+
+    def code(self, value):
+        try:
+            return self._codes[value]
+
+        except KeyError:
+            res = self._codes[value] = len(self.values)
+            self.values.append(value)
+            return res
+
+
 class DataManager(object):
-    """DataManager class
+    """DataManager class. Data is stored by columns: regions and
+    stations are dictionary encoded, pollutants are stored by pk and
+    timestamps as hours since the epoch (a few bytes per sample).
     """
 
     def __init__(self):
-        self._data = []
+        self._regions = Codebook()
+        self._stations = Codebook()
+
+        (self._region, self._station, self._pollutant, self._timestamp,
+         self._quantity) = [array.array(t) for t in COLUMN_TYPES]
+
+        # secondary indexes, built on demand
+        self._index = None
+
+    def _store(self, region, station, pollutant, timestamp, quantity):
+        self._region.append(region)
+        self._station.append(station)
+        self._pollutant.append(pollutant)
+        self._timestamp.append(timestamp)
+        self._quantity.append(quantity)
 
     def append(self, *args, **kwargs):
 
@@ -49,7 +133,7 @@ class DataManager(object):
                 cleaned["pollutant"] = pollutants_dict.get_pk(v)
 
             elif (k == "timestamp"):
-                cleaned["timestamp"] = time.strptime(v, "%d-%m-%Y %H")
+                cleaned["timestamp"] = parse_hour(v)
 
             elif (k == "quantity"):
                 cleaned["quantity"] = float(v)
@@ -58,10 +142,6 @@ class DataManager(object):
                 raise ValueError(
                     "Unexpected named parameter: '%s'" % k)
 
-        # normalized, cleaned up data
-        row = DataRow(**cleaned)
-        self._data.append(row)
-
         station, region = cleaned["station"], cleaned["region"]  # aliases
 
         if station not in stations_dict:
@@ -72,12 +152,284 @@ class DataManager(object):
             raise OntologyException("Station '%s' not found in the ontology." %
                                     station)
 
+        # normalized, cleaned up data
+        self._store(self._regions.code(region),
+                    self._stations.code(station),
+                    cleaned["pollutant"], cleaned["timestamp"],
+                    cleaned["quantity"])
+
+    def extend(self, region, formula, rows):
+        """Bulk ingestion of a whole archive. Region and pollutant are
+        constant throughout an archive, they are validated and resolved
+        once; rows are (station, formula, timestamp, quantity) tuples,
+        as read from the csv file.
+
+        Rows are stored as they are validated, an exception is raised
+        on the first invalid row. Returns the number of rows stored.
+        """
+        region = unicode(region)
+        if region not in regions_dict:
+            raise OntologyException("Region '%s' not found in the ontology." %
+                                    region)
+
+        region = self._regions.code(region)
+        pollutant = pollutants_dict.get_pk(formula)
+
+        # stations repeat throughout an archive, validate and encode
+        # them once
+        stations = {}
+
+        store = self._store
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        count = 0
+        for row in rows:
+            (station, row_formula, timestamp, quantity) = row[:4]
+
+            if row_formula != formula:
+                raise ValueError("Unexpected pollutant: '%s'" % row_formula)
+
+            try:
+                code = stations[station]
+
+            except KeyError:
+                name = unicode(station)
+                if name not in stations_dict:
+                    raise OntologyException(
+                        "Station '%s' not found in the ontology." % name)
+                code = stations[station] = self._stations.code(name)
+
+            # convert first, so that a bad row leaves no partial data
+            (timestamp, quantity) = (parse_hour(timestamp), float(quantity))
+
+            store(region, code, pollutant, timestamp, quantity)
+            if debug:
+                logger.debug("-- " + unicode(row))
+
+            count += 1
+
+        return count
+
+    def __len__(self):
+        return len(self._quantity)
+
+    @classmethod
+    def from_columns(cls, regions, stations, columns):
+        """Builds a DataManager holding the given (region, station,
+        pollutant, timestamp, quantity) columns (arrays, see columns),
+        region and station codes being decoded by the regions and
+        stations lists.
+        """
+        res = cls()
+        for value in regions:
+            res._regions.code(value)
+        for value in stations:
+            res._stations.code(value)
+
+        (res._region, res._station, res._pollutant, res._timestamp,
+         res._quantity) = columns
+
+        return res
+
+    def merge(self, other):
+        """Appends all of the data held by other, a DataManager (or any
+        object providing regions, stations and columns).
+        """
+        regions = [self._regions.code(value) for value in other.regions]
+        stations = [self._stations.code(value) for value in other.stations]
+
+        (region, station, pollutant, timestamp, quantity) = other.columns
+
+        _recode(self._region, regions, region)
+        _recode(self._station, stations, station)
+        _extend(self._pollutant, pollutant)
+        _extend(self._timestamp, timestamp)
+        _extend(self._quantity, quantity)
+
+    @property
+    def columns(self):
+        """The (region, station, pollutant, timestamp, quantity) columns,
+        region and station codes are decoded by the regions and stations
+        lists.
+        """
+        return (self._region, self._station, self._pollutant,
+                self._timestamp, self._quantity)
+
+    @property
+    def regions(self):
+        return self._regions.values
+
+    @property
+    def stations(self):
+        return self._stations.values
+
+    def daily_groups(self, sort_memory=DEFAULT_SORT_MEMORY):
+        """Yields a ((region, station, pollutant, day), [max, sum,
+        count]) pair for each daily group (codes, see columns), in no
+        particular order. At most sort_memory MB worth of groups are
+        held at once (see bounded_group_by).
+        """
+        days = itertools.imap(operator.floordiv, self._timestamp,
+                              itertools.repeat(HOURS_PER_DAY))
+
+        return bounded_group_by(itertools.izip(self._region, self._station,
+                                               self._pollutant, days),
+                                self._quantity, sort_memory)
+
+    def _row(self, i):
+        return DataRow(self._regions.values[self._region[i]],
+                       self._stations.values[self._station[i]],
+                       self._pollutant[i], self._timestamp[i],
+                       self._quantity[i])
+
+    def _rows(self):
+        """Yields all data as DataRows, in insertion order.
+        """
+        regions = self._regions.values
+        stations = self._stations.values
+
+        for (region, station, pollutant, timestamp, quantity) in \
+                itertools.izip(self._region, self._station,
+                               self._pollutant, self._timestamp,
+                               self._quantity):
+            yield DataRow(regions[region], stations[station], pollutant,
+                          timestamp, quantity)
+
+    def select(self, pollutants=None, stations=None, regions=None,
+               start=None, end=None):
+        """Yields the ids of the rows matching all of the given
+        predicates: pollutants, stations and regions are lists of
+        identifiers, pks or names (a row matches if it matches any of
+        them, unknown identifiers match nothing), start and end bound
+        timestamps (hours since the epoch, or "%d-%m-%Y %H" strings;
+        end is excluded). Rows come series by series
+        (region, station and pollutant), each in time order.
+
+        Predicates are resolved through secondary indexes, which are
+        (re)built on demand.
+        """
+        if self._index is None or self._index.rows != len(self):
+            self._index = DataIndex(self)
+
+        return self._index.select(self, pollutants, stations, regions,
+                                  start, end)
+
+    def query(self, pollutants=None, stations=None, regions=None,
+              start=None, end=None):
+        """Yields the DataRows matching the given predicates, see
+        select().
+        """
+        for i in self.select(pollutants, stations, regions, start, end):
+            yield self._row(i)
+
+    def take(self, ids):
+        """Returns the (region, station, pollutant, timestamp, quantity)
+        columns of the given rows (see columns), e.g. the result of
+        select().
+        """
+        ids = list(ids)
+        return tuple(array.array(typecode, map(column.__getitem__, ids))
+                     for (typecode, column) in zip(COLUMN_TYPES,
+                                                   self.columns))
+
     def filter_by_formula(self, formula):
+        pks = [pk for (pk, pk_formula, _) in pollutants_dict.all()
+               if pk_formula == formula]
 
-        for row in self._data:
-            if pollutants_dict.get_formula(row.pollutant) == formula:
-                yield row
+        for i in sorted(self.select(pollutants=pks)):
+            yield self._row(i)
 
     @property
     def data(self):
-        return iter(self._data)
+        return self._rows()
+
+
+class StreamingDataManager(DataManager):
+    """A DataManager which folds each row into the accumulator (max, sum
+    and count) of its day as it is stored, instead of retaining it.
+    Accumulators are stored by columns, like rows are (see
+    GROUP_TYPES): 30 bytes for each station-day, against 432 for its 24
+    hourly rows. On the other hand, only daily aggregates are
+    available.
+
+    Rows find their accumulator through a lookup table of the most
+    recent ones, which is bounded (see MAX_OPEN_GROUPS). A station-day
+    met again after the table has been recycled gets another
+    accumulator, accumulators of the same station-day are combined when
+    read (see daily_groups). Rows are grouped by station and day in
+    archives, so this is rare.
+    """
+
+    def __init__(self):
+        super(StreamingDataManager, self).__init__()
+
+        self._groups = [array.array(t) for t in GROUP_TYPES]
+        (self._g_region, self._g_station, self._g_pollutant, self._g_day,
+         self._g_max, self._g_sum, self._g_count) = self._groups
+
+        # accumulators by (packed) key
+        self._open = {}
+        self._recycled = False
+
+        self._count = 0
+
+    def _store(self, region, station, pollutant, timestamp, quantity):
+        day = timestamp // HOURS_PER_DAY
+        key = ((((region << 16) | station) << 16 | pollutant) << 32) | \
+            (day & 0xffffffff)
+        self._count += 1
+
+        try:
+            slot = self._open[key]
+
+        except KeyError:
+            if MAX_OPEN_GROUPS <= len(self._open):
+                self._open.clear()
+                self._recycled = True
+
+            self._open[key] = len(self._g_count)
+            for (column, value) in itertools.izip(
+                    self._groups, (region, station, pollutant, day,
+                                   quantity, quantity, 1)):
+                column.append(value)
+            return
+
+        if self._g_max[slot] < quantity:
+            self._g_max[slot] = quantity
+        self._g_sum[slot] += quantity
+        self._g_count[slot] += 1
+
+    def __len__(self):
+        return self._count
+
+    def merge(self, other):
+        regions = [self._regions.code(value) for value in other.regions]
+        stations = [self._stations.code(value) for value in other.stations]
+
+        store = self._store
+        for (region, station, pollutant, timestamp, quantity) in \
+                itertools.izip(*other.columns):
+            store(regions[region], stations[station], pollutant, timestamp,
+                  quantity)
+
+    def daily_groups(self, sort_memory=DEFAULT_SORT_MEMORY):
+        groups = (((region, station, pollutant, day), max_, sum_, count)
+                  for (region, station, pollutant, day, max_, sum_, count)
+                  in itertools.izip(*self._groups))
+
+        if not self._recycled:
+            return ((key, [max_, sum_, count])
+                    for (key, max_, sum_, count) in groups)
+
+        # combine the accumulators of the same station-day
+        return combine_groups(external_sort(groups, sort_memory))
+
+    def _aggregates_only(self, *args, **kwargs):
+        raise DataException("--streaming keeps daily aggregates only, "
+                            "hourly rows are not available")
+
+    _rows = select = take = _aggregates_only
+
+    @property
+    def columns(self):
+        self._aggregates_only()
@@ -4,3 +4,7 @@
 
 class OntologyException(Exception):
     pass
+
+
+class DataException(Exception):
+    pass
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""External merge sort services
+"""
+import sys
+import heapq
+import marshal
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Temporary files support
+import tempfile
+
+# Default memory cap (in MB) for sorting
+DEFAULT_SORT_MEMORY = 64
+
+
+def _estimate(record):
+    """Estimates the memory taken by a record (a tuple) in bytes.
+    """
+    return sys.getsizeof(record) + sum(sys.getsizeof(field)
+                                       for field in record)
+
+
+def _spill(run):
+    """Sorts a run and writes it to a temporary file, which is returned
+    rewound.
+    """
+    run.sort()
+
+    f = tempfile.TemporaryFile()
+    for record in run:
+        marshal.dump(record, f)
+    f.seek(0)
+
+    return f
+
+
+def _read(f):
+    """Yields the records of a run, then closes it.
+    """
+    try:
+        while True:
+            try:
+                yield marshal.load(f)
+
+            except EOFError:
+                return
+
+    finally:
+        f.close()
+
+
+def external_sort(records, max_memory=DEFAULT_SORT_MEMORY):
+    """Yields records (tuples of marshallable values) in sorted order.
+    At most max_memory MB worth of records are held in memory: larger
+    inputs are split in sorted runs, spilled to temporary files and
+    merged back.
+    """
+    max_memory = max_memory * 1024 * 1024
+
+    runs = []
+    run = []
+    for record in records:
+        if not run:
+            # records are assumed to be alike
+            limit = max(1, max_memory // _estimate(record))
+
+        run.append(record)
+        if len(run) >= limit:
+            runs.append(_spill(run))
+            run = []
+
+    if not runs:
+        run.sort()
+        return iter(run)
+
+    if run:
+        runs.append(_spill(run))
+
+    logger.debug("Merging %d sorted runs", len(runs))
+    return heapq.merge(*[_read(f) for f in runs])
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Secondary indexes over DataManager columns
+"""
+import bisect
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Standard collections
+import collections
+import itertools
+
+# Compact storage support
+import array
+
+from brace.ontology import pollutants_dict
+from brace.ontology import regions_dict
+from brace.ontology import stations_dict
+from brace.timestamps import parse_hour
+
+
+def _resolve(values, idents, dictionary):
+    """Returns the set of codes of values (a name list) matching any of
+    idents. Identifiers are looked up in dictionary (e.g. regions_dict),
+    by pk or name; names it does not know are matched as they are, case
+    insensitively. Other identifiers match nothing.
+    """
+    codes = dict((value.lower(), code) for (code, value) in enumerate(values))
+
+    res = set()
+    for ident in idents:
+        try:
+            name = dictionary.get_name(ident)
+
+        except KeyError:
+            if not isinstance(ident, basestring):
+                continue  # matches nothing
+
+            name = ident
+
+        code = codes.get(name.lower())
+        if code is not None:
+            res.add(code)
+
+    return res
+
+
+def _hour(stamp):
+    """Accepts hours since the epoch, or "%d-%m-%Y %H" timestamps.
+    """
+    if isinstance(stamp, basestring):
+        return parse_hour(stamp)
+
+    return stamp
+
+
+class DataIndex(object):
+    """Indexes the rows of a DataManager by series (region, station and
+    pollutant), each series being ordered by time, and the series by
+    region, station and pollutant. The index reflects the rows stored
+    when it was built (see rows).
+    """
+
+    def __init__(self, data_mgr):
+        (region, station, pollutant, timestamp, _) = data_mgr.columns
+        self.rows = len(timestamp)
+
+        # row ids by series
+        series = collections.defaultdict(list)
+        for (i, key) in enumerate(itertools.izip(region, station,
+                                                 pollutant)):
+            series[key].append(i)
+
+        # (row ids, timestamps) of each series, in time order
+        self.series = {}
+
+        self.by_region = collections.defaultdict(set)
+        self.by_station = collections.defaultdict(set)
+        self.by_pollutant = collections.defaultdict(set)
+
+        for (key, ids) in series.iteritems():
+            ids.sort(key=timestamp.__getitem__)
+            self.series[key] = (array.array('l', ids),
+                                array.array('i', (timestamp[i]
+                                                  for i in ids)))
+
+            self.by_region[key[0]].add(key)
+            self.by_station[key[1]].add(key)
+            self.by_pollutant[key[2]].add(key)
+
+        logger.debug("Indexed %d rows, %d series", self.rows, len(series))
+
+    def _matching(self, index, codes):
+        """Returns the union of the series indexed under codes.
+        """
+        return set().union(*[index.get(code, ()) for code in codes])
+
+    def select(self, data_mgr, pollutants=None, stations=None,
+               regions=None, start=None, end=None):
+        """Yields the ids of the rows matching all of the given
+        predicates, series by series, each in time order. pollutants,
+        stations and regions are lists of identifiers (matching any
+        of them), start and end bound the timestamps (end excluded).
+        """
+        keys = set(self.series)
+
+        if pollutants is not None:
+            codes = set()
+            for ident in pollutants:
+                try:
+                    codes.add(pollutants_dict.get_pk(ident))
+
+                except KeyError:
+                    pass  # matches nothing
+
+            keys &= self._matching(self.by_pollutant, codes)
+
+        if stations is not None:
+            keys &= self._matching(self.by_station,
+                                   _resolve(data_mgr.stations, stations,
+                                            stations_dict))
+
+        if regions is not None:
+            keys &= self._matching(self.by_region,
+                                   _resolve(data_mgr.regions, regions,
+                                            regions_dict))
+
+        for key in sorted(keys):
+            (ids, stamps) = self.series[key]
+
+            lo = 0
+            if start is not None:
+                lo = bisect.bisect_left(stamps, _hour(start))
+
+            hi = len(stamps)
+            if end is not None:
+                hi = bisect.bisect_left(stamps, _hour(end))
+
+            for i in itertools.islice(ids, lo, hi):
+                yield i
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Dictionaries persisted as JSON files
+"""
+import os
+import json
+import errno
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# File locking, guards against concurrent runs
+import fcntl
+
+# Threading support
+import threading
+
+
+class JsonIndex(object):
+    """A dictionary persisted as a JSON file. Updates reload the file,
+    apply the changes and save it back atomically, all while holding a
+    lock file, so that concurrent threads and runs sharing the same file
+    never lose each other's changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + ".lock"
+        self._lock = threading.RLock()
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                return json.load(f)
+
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        except ValueError:
+            logger.warning("'%s' is corrupted, starting afresh.", self.path)
+
+        return {}
+
+    def update(self, func):
+        """Reloads the dictionary, applies func to it and saves it back.
+        """
+        with self._lock:
+            with open(self._lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                data = self._load()
+                func(data)
+
+                tmp = "%s.%d" % (self.path, os.getpid())
+                with open(tmp, "wb") as f:
+                    json.dump(data, f)
+                os.rename(tmp, self.path)
+
+                self.data = data
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self.data.get(key, default)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Persistent manifest of resolved archive locations
+"""
+import hashlib
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Threading support
+import threading
+
+from brace.jsonfile import JsonIndex
+
+# Size of a single read when fingerprinting archives
+FINGERPRINT_BUFFER_SIZE = 65536
+
+
+def fingerprint(archive):
+    """Returns the (size, sha1) of an archive file object, which is
+    rewound afterwards.
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+
+    archive.seek(0)
+    while True:
+        packet = archive.read(FINGERPRINT_BUFFER_SIZE)
+        if not packet:
+            break
+
+        sha1.update(packet)
+        size += len(packet)
+    archive.seek(0)
+
+    return (size, sha1.hexdigest())
+
+
+class LocationManifest(object):
+    """Maps each (region, pollutant, year) key to the location the
+    servlet resolved its archive to, along with the last known size
+    and sha1 of the archive. Knowing the location, the servlet round
+    trip can be skipped altogether.
+
+    Changes are kept in memory and merged into the manifest file when
+    flushed.
+    """
+
+    def __init__(self, path):
+        self._index = JsonIndex(path)
+        self._lock = threading.Lock()
+        self._changes = {}
+
+    def get(self, key):
+        """Returns the manifest entry for key, or None.
+        """
+        with self._lock:
+            if key in self._changes:
+                return self._changes[key]
+
+        return self._index.get(key)
+
+    def location(self, key):
+        entry = self.get(key)
+        return entry and entry["location"]
+
+    def record(self, key, location, archive, identity=None):
+        """Records the location of the archive for key. The archive
+        (a file object) is fingerprinted and rewound, unless its (size,
+        sha1) identity is already known (see ArchiveCache.identify).
+        """
+        (size, sha1) = identity or fingerprint(archive)
+
+        with self._lock:
+            self._changes[key] = {
+                'location': location,
+                'size': size,
+                'sha1': sha1,
+            }
+
+    def forget(self, key):
+        """Drops the (stale) location for key.
+        """
+        with self._lock:
+            self._changes[key] = None
+
+    def flush(self):
+        """Merges the changes into the manifest file.
+        """
+        with self._lock:
+            (changes, self._changes) = (self._changes, {})
+
+        def merge(data):
+            for (key, entry) in changes.items():
+                if entry is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = entry
+
+        if changes:
+            self._index.update(merge)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 """Network I/O services
 """
+import os
 import time
+import random
 
 # Logging support
 import logging
@@ -13,57 +15,128 @@ import tempfile
 # Network I/O services
 import urllib
 
-# HTML parsing
-from BeautifulSoup import BeautifulSoup
+# Pooled HTTP connections
+from brace.session import HttpSession
 
-# The URL of the website that provides pollutants data
-URL_PREFIX = "http://www.brace.sinanet.apat.it/zipper"
+# Redirect scraping
+import re
+
+# The URL of the website that provides pollutants data. It can be
+# overridden from the environment (e.g. to use a local stand-in, see
+# brace.standin) or from the command line.
+URL_PREFIX = os.environ.get("BRACE_URL_PREFIX",
+                            "http://www.brace.sinanet.apat.it/zipper")
 
 # Custom modules
 from brace.ontology import regions_dict
 from brace.ontology import pollutants_dict
 
-# Maximum number of attempts to download a single file
-DOWNLOAD_MAX_RETRIES = 6
+from brace.cache import archive_key
 
-# Delay between retries
-DOWNLOAD_DELAY_TIME_BETWEEN_ATTEMPTS = 10
+# The servlet page redirects to the generated archive by means of a
+# <script> element, e.g. window.location="../download/<location>"
+SCRIPT_RE = re.compile(r"<script[^>]*>(.*?)</script>", re.I | re.S)
 
-def download(url, max_retries=DOWNLOAD_MAX_RETRIES,
-             delay=DOWNLOAD_DELAY_TIME_BETWEEN_ATTEMPTS):
-    """Download a remote url to a newly created temporary file.
-    The file will be destroyed when the object is closed.
+# Archive response statuses meaning the archive was obtained (206 is the
+# final status of a resumed transfer, 304 is a revalidated cached copy)
+ARCHIVE_OK = (200, 206, 304)
+
+# Signatures a zip archive starts with: a local file header, or the end
+# of central directory record of an empty archive
+ZIP_SIGNATURES = ("PK\x03\x04", "PK\x05\x06")
+
+# Size of a single read while streaming a download to disk
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Overall time budget (in seconds) for the attempts to download a
+# single file
+DOWNLOAD_RETRY_BUDGET = 300
+
+# Base and cap (in seconds) of the exponential backoff between attempts
+DOWNLOAD_BACKOFF_BASE = 1
+DOWNLOAD_BACKOFF_MAX = 60
+
+# Keep-alive connections shared by every download in a run
+session = HttpSession()
+
+def backoff_delay(attempts, base=DOWNLOAD_BACKOFF_BASE,
+                  cap=DOWNLOAD_BACKOFF_MAX):
+    """Returns the delay before the next attempt, after a given number
+    of failed ones: exponential backoff with full jitter.
     """
-    res = None
+    return random.uniform(0, min(cap, base * 2 ** (attempts - 1)))
 
-    # try downloading file up to a given number of attempts
-    (attempts, success) = (0, False)
-    while (not success and attempts < max_retries):
+
+def _download(url, budget=DOWNLOAD_RETRY_BUDGET, headers=None):
+    """Download a remote url to a newly created temporary file. Returns
+    the file and the (closed) response, which carries status and
+    headers.
+
+    The response is streamed to disk in fixed size chunks. If a
+    transfer is interrupted, the next attempt resumes it by means of a
+    Range request. Attempts are spaced out with an exponential backoff,
+    until the retry budget (in seconds) is exhausted.
+    """
+    res = tempfile.TemporaryFile()
+    validator = None
+
+    (started, attempts) = (time.time(), 0)
+    while True:
 
         attempts += 1
 
+        # resume an interrupted transfer, provided the remote
+        # resource has not changed in the meantime
+        offset = res.tell()
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers["Range"] = "bytes=%d-" % offset
+            if validator:
+                request_headers["If-Range"] = validator
+
         try:
-            logger.debug("Downloading url '%s', attempt %d",
-                         url, attempts)
+            logger.debug("Downloading url '%s', attempt %d (offset %d)",
+                         url, attempts, offset)
 
-            urlfile = urllib.urlopen(url)
-            if urlfile is None:
-                raise Exception(
-                    "Could not access to remote url '%s'" % url)
+            urlfile = session.open(url, request_headers)
+            try:
+                if 500 <= urlfile.status:
+                    raise IOError("Server error %d (%s) for '%s'" % (
+                            urlfile.status, urlfile.reason, url))
 
-            # dumping to temp file
-            res = tempfile.TemporaryFile()
-            while True:
-                packet = urlfile.read()
-                if not packet:
-                    break
+                if offset and (urlfile.status != 206 or not \
+                        urlfile.getheader("content-range", "").\
+                        startswith("bytes %d-" % offset)):
+                    # range not honoured, start over
+                    res.seek(0)
+                    res.truncate()
 
-                res.write(packet)
+                    if urlfile.status == 416:
+                        raise IOError("Could not resume '%s'" % url)
 
-            urlfile.close()
-            success = True
+                validator = urlfile.getheader("etag") or \
+                    urlfile.getheader("last-modified")
+
+                # dumping to temp file
+                while True:
+                    packet = urlfile.read(DOWNLOAD_CHUNK_SIZE)
+                    if not packet:
+                        break
+
+                    res.write(packet)
+
+            finally:
+                urlfile.close()
+
+            break
 
         except IOError, ioe:
+            delay = backoff_delay(attempts)
+            if budget < time.time() - started + delay:
+                res.close()
+                raise IOError("Could not download '%s' after %d attempts "
+                              "[%s]." % (url, attempts, ioe))
+
             logger.warning(str(ioe))
             time.sleep(delay)  # wait before next attempt
 
@@ -72,24 +145,26 @@ def download(url, max_retries=DOWNLOAD_MAX_RETRIES,
     res.seek(0)
     logger.info("Downloaded %d bytes.", size)
 
-    return res
+    return (res, urlfile)
 
 
-def query(region, pollutant, year):
+def download(url, budget=DOWNLOAD_RETRY_BUDGET):
+    """Download a remote url to a newly created temporary file.
+    The file will be destroyed when the object is closed.
     """
+    (res, _) = _download(url, budget)
+    return res
+
+
+def query_url(region, pollutant, year, prefix=None):
+    """Returns the url of the servlet generating the archive for a
+    given region, pollutant and year.
     """
     region_code = regions_dict.get_pk(region)
     region_name = regions_dict.get_name(region)
 
     pollutant_code = pollutants_dict.get_pk(pollutant)
     pollutant_formula = pollutants_dict.get_formula(pollutant)
-    # pollutant_name = pollutants_dict.get_name(pollutant)
-    # name = '%sdownload/%s_%s_%s.zip' % (
-    #     URL_PREFIX,
-    #     region_name.upper(),
-    #     pollutant_formula.upper(),
-    #     year,
-    # )
 
     query = urllib.urlencode({
             'p_comp': pollutant_code,
@@ -99,29 +174,115 @@ def query(region, pollutant, year):
             'p_anno': year,
     })
 
-    genfile = "%(prefix)s/servlet/zipper?%(query)s" % {
-        'prefix': URL_PREFIX,
+    return "%(prefix)s/servlet/zipper?%(query)s" % {
+        'prefix': prefix or URL_PREFIX,
         'query': query,
     }
 
-    link = download(genfile)
-    if link is None:
-        raise IOError("Could not fetch '%s'." % genfile)
 
-    soup = BeautifulSoup(link)
+def archive_url(location, prefix=None):
+    """Returns the url of a generated archive, given its location.
+    """
+    return "%(prefix)s/download/%(location)s" % {
+        'prefix': prefix or URL_PREFIX,
+        'location': location }
+
+
+def is_archive(f):
+    """Tells whether a downloaded file (a file object) looks like a zip
+    archive, as opposed to e.g. an error page. Archives cut short or
+    corrupt still look like archives. The file is rewound.
+    """
+    f.seek(0)
+    signature = f.read(len(ZIP_SIGNATURES[0]))
+    f.seek(0)
 
-    location = \
-        soup.find('script').contents[0].split('"')[1].\
-        replace("../download/", "")
+    return signature in ZIP_SIGNATURES
 
-    link.close()
 
-    archive = download(
-        "%(prefix)s/download/%(location)s" % {
-            'prefix': URL_PREFIX,
-            'location': location })
+def extract_location(page):
+    """Extracts the location of the generated archive from the page
+    returned by the servlet (a string or a file object). The page
+    redirects the browser to the archive by means of a <script>
+    element.
+    """
+    if hasattr(page, "read"):
+        page = page.read()
+
+    match = SCRIPT_RE.search(page)
+    try:
+        location = match.group(1).split('"')[1]
+
+    except (AttributeError, IndexError):
+        raise IOError("No archive location found in servlet response")
+
+    return location.replace("../download/", "")
+
+
+def _fetch_archive(location, key, cache=None):
+    """Fetches the archive at location, going through the cache if one
+    is given. Returns the archive and the response status.
+    """
+    url = archive_url(location)
+
+    if cache is None:
+        (archive, response) = _download(url)
+        return (archive, response.status)
+
+    (archive, response) = _download(url, headers=cache.validators(key))
+    try:
+        archive = cache.reconcile(key, archive, response.status,
+                                  response.getheader("etag"),
+                                  response.getheader("last-modified"))
+
+    except KeyError:
+        # not modified, but the cached copy has gone since it was
+        # revalidated: fetch it again, unconditionally
+        logger.info("Cached copy of '%s' is gone, fetching it again.", url)
+        (archive, response) = _download(url)
+        archive = cache.reconcile(key, archive, response.status,
+                                  response.getheader("etag"),
+                                  response.getheader("last-modified"))
+
+    return (archive, response.status)
+
+
+def query(region, pollutant, year, cache=None, manifest=None):
+    """Fetches the archive for a given region, pollutant and year to a
+    temporary file. This takes two steps: first the servlet generates
+    the archive and redirects to it, then the archive is downloaded.
+
+    If an ArchiveCache is given, the archive is fetched with a
+    conditional request and the cached copy is returned when it has not
+    been modified. If a LocationManifest is given and it knows where the
+    archive is, the servlet step is skipped.
+    """
+    region_code = regions_dict.get_pk(region)
+    pollutant_code = pollutants_dict.get_pk(pollutant)
+    key = archive_key(region_code, pollutant_code, year)
+
+    location = manifest is not None and manifest.location(key)
+    if location:
+        (archive, status) = _fetch_archive(location, key, cache)
+        if status in ARCHIVE_OK:
+            manifest.record(key, location, archive,
+                            cache and cache.identify(archive))
+            return archive
+
+        archive.close()
+        logger.info("Known location '%s' is stale (status %d), "
+                    "resolving it again.", location, status)
+        manifest.forget(key)
+
+    genfile = query_url(region, pollutant, year)
+
+    link = download(genfile)
+    location = extract_location(link)
+    link.close()
 
-    if archive is None:
-        raise IOError("Could not fetch '%s'." % genfile)
+    (archive, status) = _fetch_archive(location, key, cache)
+    if manifest is not None and status in ARCHIVE_OK:
+        manifest.record(key, location, archive,
+                        cache and cache.identify(archive))
 
     return archive
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
-"""Source data dictionaries for pollutants and italian regions.
+"""Source data dictionaries for pollutants, italian regions and
+sampling stations.
 """
+import os
+import math
+import cPickle
+import marshal
+import hashlib
+
 # Logging support
 import logging
 logger = logging.getLogger("brace")
@@ -8,7 +15,58 @@ logger = logging.getLogger("brace")
 # localization services
 from gettext import gettext as _
 
-# TODO: improve these classes for performance
+from brace.csvio import UnicodeReader
+
+# The stations registry, a csv file (region code, name, latitude,
+# longitude). This can be set from the environment as well. Remark:
+# the registry shipped with brace covers Lombardia only, archives of
+# other regions hold stations which are not found in the ontology.
+STATIONS_FILE = os.environ.get(
+    "BRACE_STATIONS", os.path.join(os.path.dirname(__file__),
+                                   "resources", "stations.csv"))
+
+# Version of the binary stations index format
+STATIONS_INDEX_VERSION = 2
+
+# Size (in degrees) of the cells of the stations spatial index
+GRID_CELL_SIZE = 0.25
+
+# Mean earth radius, and length of a degree of latitude (in km)
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def _build_index(entries, fields):
+    """Builds a case insensitive lookup index over entries (tuples):
+    maps the value of each of the given fields to its entry, string
+    values are lowercased. On collisions, earlier fields take
+    precedence.
+    """
+    index = {}
+    for field in fields:
+        for entry in entries:
+            key = entry[field]
+            if isinstance(key, basestring):
+                key = key.lower()
+
+            index.setdefault(key, entry)
+
+    return index
+
+
+def _find_entry(index, ident, message):
+    """Looks up ident (case insensitive) in an index built by
+    _build_index. Raises a KeyError if no entry could be found.
+    """
+    if isinstance(ident, basestring):
+        ident = ident.lower()
+
+    try:
+        return index[ident]
+
+    except (KeyError, TypeError):
+        raise KeyError(message % ident)
+
 
 class PollutantsDictionary(object):
     """Provides loookup services for pollutants. All of the get_xxx
@@ -30,19 +88,14 @@ class PollutantsDictionary(object):
         (20, "C6H6", _(u"Benzene")),
     ]
 
+    def __init__(self):
+        # lookup by pk, formula and name
+        self._index = _build_index(self.pollutants, (0, 1, 2))
+
     # case insensitive find
     def _find_tuple(self, ident):
-
-        if isinstance(ident, unicode) or \
-                isinstance(ident, str):
-            ident = ident.lower()
-
-        for (pk, formula, name) in self.pollutants:
-            if ident in (pk, formula.lower(), name.lower()):
-                return (pk, formula, name)
-
-        raise KeyError (
-            "%s is not a known pollutant." % ident)
+        return _find_entry(self._index, ident,
+                           "%s is not a known pollutant.")
 
     def get_pk(self, ident):
         """Given a chemical identifier, returns its pk in the
@@ -69,13 +122,11 @@ class PollutantsDictionary(object):
 
     def __contains__(self, ident):
         try:
-            (_, _, _, _) = self._find_tuple(ident)
+            self._find_tuple(ident)
             return True
 
-        except:
-            pass
-
-        return False
+        except KeyError:
+            return False
 
 
     def all(self):
@@ -117,19 +168,14 @@ class ItalianRegionsDictionary(object):
         (5, u"Veneto", 45.439722, 12.331945),
     ]
 
+    def __init__(self):
+        # lookup by pk and name
+        self._index = _build_index(self.regions, (0, 1))
+
     # case insensitive find
     def _find_tuple(self, ident):
-
-        if isinstance(ident, unicode) or \
-                isinstance(ident, str):
-            ident = ident.lower()
-
-        for (pk, name, latitude, longitude) in self.regions:
-            if ident in (pk, name.lower()):
-                return (pk, name, latitude, longitude)
-
-        raise KeyError(
-            "'%s' is not an italian region" % ident)
+        return _find_entry(self._index, ident,
+                           "'%s' is not an italian region")
 
     def get_pk(self, ident):
 
@@ -151,13 +197,11 @@ class ItalianRegionsDictionary(object):
 
     def __contains__(self, ident):
         try:
-            (_, _, _, _) = self._find_tuple(ident)
+            self._find_tuple(ident)
             return True
 
-        except:
-            pass
-
-        return False
+        except KeyError:
+            return False
 
     def all(self):
         return self.regions
@@ -165,148 +209,237 @@ class ItalianRegionsDictionary(object):
 regions_dict = ItalianRegionsDictionary()
 
 
+class StationsGrid(object):
+    """A spatial index over stations: a regular grid of cells, each
+    holding the stations whose coordinates fall within it. Supports
+    nearest station and bounding box queries.
+    """
+
+    def __init__(self, stations, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+
+        # the smallest length of a degree of longitude, relative to a
+        # degree of latitude, over all of the stations
+        self.min_cos = 1.0
+
+        for station in stations:
+            (_, _, latitude, longitude) = station
+            self.cells.setdefault(self._cell(latitude, longitude),
+                                  []).append(station)
+            self.min_cos = min(self.min_cos,
+                               math.cos(math.radians(latitude)))
+
+        # the extent of the grid, in cells
+        rows = [row for (row, _) in self.cells] or [0]
+        cols = [col for (_, col) in self.cells] or [0]
+        self.rows = (min(rows), max(rows))
+        self.cols = (min(cols), max(cols))
+
+    def _cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def _ring(self, center, radius):
+        """Yields the stations in the cells at exactly radius cells
+        from center.
+        """
+        (row, col) = center
+        (top, bottom) = (row - radius, row + radius)
+        (left, right) = (col - radius, col + radius)
+
+        # only the cells within the extent of the grid may hold stations
+        rows = [i for i in sorted(set([top, bottom]))
+                if self.rows[0] <= i <= self.rows[1]]
+        cols = [j for j in sorted(set([left, right]))
+                if self.cols[0] <= j <= self.cols[1]]
+
+        # the top and bottom rows, then the rest of the sides
+        cells = [(i, j) for i in rows
+                 for j in range(max(left, self.cols[0]),
+                                min(right, self.cols[1]) + 1)]
+        cells += [(i, j) for i in range(max(top + 1, self.rows[0]),
+                                        min(bottom - 1, self.rows[1]) + 1)
+                  for j in cols]
+
+        for cell in cells:
+            for station in self.cells.get(cell, ()):
+                yield station
+
+    def nearest(self, latitude, longitude):
+        """Returns the station nearest to the given coordinates, or None
+        if there are no stations at all.
+        """
+        if not self.cells:
+            return None
+
+        center = self._cell(latitude, longitude)
+
+        # no station is farther than this many rings from center
+        rings = max(abs(center[0] - self.rows[0]),
+                    abs(center[0] - self.rows[1]),
+                    abs(center[1] - self.cols[0]),
+                    abs(center[1] - self.cols[1]))
+
+        (best, best_distance) = (None, None)
+        for radius in range(rings + 1):
+
+            # stations beyond this ring are at least this far away
+            bound = max(0, radius - 1) * self.cell_size * \
+                KM_PER_DEGREE * self.min_cos
+            if best is not None and best_distance <= bound:
+                break
+
+            for station in self._ring(center, radius):
+                distance = great_circle(latitude, longitude,
+                                        station[2], station[3])
+                if best is None or distance < best_distance:
+                    (best, best_distance) = (station, distance)
+
+        return best
+
+    def within(self, south, west, north, east):
+        """Returns the stations within the given bounding box.
+        """
+        (row0, col0) = self._cell(south, west)
+        (row1, col1) = self._cell(north, east)
+
+        res = []
+        for ((row, col), stations) in self.cells.iteritems():
+            if row0 <= row <= row1 and col0 <= col <= col1:
+                res.extend(station for station in stations
+                           if south <= station[2] <= north and
+                           west <= station[3] <= east)
+
+        return res
+
+
+def great_circle(lat0, lon0, lat1, lon1):
+    """Returns the great circle distance (in km) between two points.
+    """
+    (lat0, lon0, lat1, lon1) = map(math.radians, (lat0, lon0, lat1, lon1))
+
+    h = math.sin((lat1 - lat0) / 2) ** 2 + \
+        math.cos(lat0) * math.cos(lat1) * math.sin((lon1 - lon0) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
 class StationsDictionary(object):
     """Provides loookup services for the pulltant stations. All of the
     get_xxx methods below take a generic identifier. The given
     identifier is used to perform look-up using key and name in this
     order.
+
+    The registry is read from a csv file (region code, name, latitude,
+    longitude) on first use. If index_path is set, the parsed registry
+    and its indexes are cached there, in binary form, and reused for as
+    long as the csv file is unchanged (same sha1).
+
+    Remark: the registry shipped with brace (see STATIONS_FILE) covers
+    Lombardia only, stations of other regions are unknown.
     """
 
-    # List of sampling stations (region_code, station_name, latitude, longitude)
-    # TODO: as of now the ontology holds only the stations for Lombardy, extracting
-    # these indeed is a PITA. This list comes from a lot of Emacs macro wizardry and
-    # a certain amount of nerve.
-
-    stations = [
-
-        # TODO fix coordinates
-        (3, u"ABBADIA CERRETO", 45.5855555, 9.930278),
-        (3, u"ARCONATE", 45.5855555, 9.930278),
-        (3, u"ARESE", 45.5855555, 9.930278),
-        (3, u"BERGAMO - VIA GARIBALDI", 45.5855555, 9.930278),
-        (3, u"BERGAMO - VIA GOISIS", 45.5855555, 9.930278),
-        (3, u"BERGAMO - VIA MEUCCI", 45.5855555, 9.930278),
-        (3, u"BERTONICO", 45.5855555, 9.930278),
-        (3, u"BORGOFRANCO", 45.5855555, 9.930278),
-        (3, u"BORMIO", 45.5855555, 9.930278),
-        (3, u"BRESCIA - BROLETTO", 45.5855555, 9.930278),
-        (3, u"BRESCIA - VIA ZIZIOLA", 45.5855555, 9.930278),
-        (3, u"BRESCIA VIA CANTORE", 45.5855555, 9.930278),
-        (3, u"BRESCIA VILLAGGIO SERENO", 45.5855555, 9.930278),
-        (3, u"BUSTO ARSIZIO - ACCAM", 45.5855555, 9.930278),
-        (3, u"CALUSCO", 45.5855555, 9.930278),
-        (3, u"CANTU - VIA MEUCCI", 45.5855555, 9.930278),
-        (3, u"CARBONARA DI PO", 45.5855555, 9.930278),
-        (3, u"CASIRATE D'ADDA", 45.5855555, 9.930278),
-        (3, u"CASSANO VIA DI VONA", 45.5855555, 9.930278),
-        (3, u"CASSANO VIA MILANO", 45.5855555, 9.930278),
-        (3, u"CHIAVENNA", 45.5855555, 9.930278),
-        (3, u"CITTADELLA", 45.5855555, 9.930278),
-        (3, u"CODOGNO", 45.5855555, 9.930278),
-        (3, u"COLICO", 45.5855555, 9.930278),
-        (3, u"COMO", 45.5855555, 9.930278),
-        (3, u"CORMANO", 45.5855555, 9.930278),
-        (3, u"CORNALE", 45.5855555, 9.930278),
-        (3, u"CORTE DEI CORTESI", 45.5855555, 9.930278),
-        (3, u"CREMA - VIA INDIPENDENZA", 45.5855555, 9.930278),
-        (3, u"CREMA - VIA XI FEBBRAIO", 45.5855555, 9.930278),
-        (3, u"CREMONA - P.ZZA CADORNA", 45.5855555, 9.930278),
-        (3, u"CREMONA - PIAZZA LIBERTA", 45.5855555, 9.930278),
-        (3, u"CREMONA VIA FATEBENEFRATELLI", 45.5855555, 9.930278),
-        (3, u"DARFO_2", 45.5855555, 9.930278),
-        (3, u"ERBA", 45.5855555, 9.930278),
-        (3, u"ERBA- Via Battisti", 45.5855555, 9.930278),
-        (3, u"FERNO", 45.5855555, 9.930278),
-        (3, u"FERRERA ERBOGNONE - Eni", 45.5855555, 9.930278),
-        (3, u"FILAGO", 45.5855555, 9.930278),
-        (3, u"GALLARATE S.LORENZO", 45.5855555, 9.930278),
-        (3, u"GAMBARA", 45.5855555, 9.930278),
-        (3, u"LACCHIARELLA", 45.5855555, 9.930278),
-        (3, u"LALLIO", 45.5855555, 9.930278),
-        (3, u"LECCO VIA AMENDOLA", 45.5855555, 9.930278),
-        (3, u"LECCO VIA SORA", 45.5855555, 9.930278),
-        (3, u"LEGNANO S.MAGNO", 45.5855555, 9.930278),
-        (3, u"LIMITO", 45.5855555, 9.930278),
-        (3, u"LODI", 45.5855555, 9.930278),
-        (3, u"LODI S.ALBERTO", 45.5855555, 9.930278),
-        (3, u"LONATO", 45.5855555, 9.930278),
-        (3, u"MAGENTA VF", 45.5855555, 9.930278),
-        (3, u"MANTOVA - LUNETTA", 45.5855555, 9.930278),
-        (3, u"MANTOVA - TRIDOLINO", 45.5855555, 9.930278),
-        (3, u"MANTOVA - VIA ARIOSTO", 45.5855555, 9.930278),
-        (3, u"MANTOVA GRAMSCI", 45.5855555, 9.930278),
-        (3, u"MANTOVA SANT'AGNESE", 45.5855555, 9.930278),
-        (3, u"MARMIROLO - BOSCO FONTANA", 45.5855555, 9.930278),
-        (3, u"MEDA", 45.5855555, 9.930278),
-        (3, u"MERATE", 45.5855555, 9.930278),
-        (3, u"MILANO - JUVARA", 45.5855555, 9.930278),
-        (3, u"MILANO - P.CO LAMBRO", 45.5855555, 9.930278),
-        (3, u"MILANO - SENATO", 45.5855555, 9.930278),
-        (3, u"MILANO - V.LE MARCHE", 45.5855555, 9.930278),
-        (3, u"MILANO - VERZIERE", 45.5855555, 9.930278),
-        (3, u"MILANO - VIA MESSINA", 45.5855555, 9.930278),
-        (3, u"MILANO VIA PASCAL", 45.5855555, 9.930278),
-        (3, u"MILANO VIA ZAVATTARI", 45.5855555, 9.930278),
-        (3, u"MOGGIO", 45.5855555, 9.930278),
-        (3, u"MONTANASO", 45.5855555, 9.930278),
-        (3, u"MONZA", 45.5855555, 9.930278),
-        (3, u"MONZA via MACHIAVELLI", 45.5855555, 9.930278),
-        (3, u"MONZAMBANO", 45.5855555, 9.930278),
-        (3, u"MORBEGNO2", 45.5855555, 9.930278),
-        (3, u"MOTTA VISCONTI", 45.5855555, 9.930278),
-        (3, u"Mortara", 45.5855555, 9.930278),
-        (3, u"ODOLO", 45.5855555, 9.930278),
-        (3, u"OLGIATE COMASCO", 45.5855555, 9.930278),
-        (3, u"OSIO SOTTO", 45.5855555, 9.930278),
-        (3, u"OSPITALETTO", 45.5855555, 9.930278),
-        (3, u"OSTIGLIA S.G.", 45.5855555, 9.930278),
-        (3, u"PARONA", 45.5855555, 9.930278),
-        (3, u"PAVIA - P.ZZA MINERVA", 45.5855555, 9.930278),
-        (3, u"PAVIA - VIA FOLPERTI", 45.5855555, 9.930278),
-        (3, u"PERO", 45.5855555, 9.930278),
-        (3, u"PORTO MANTOVANO", 45.5855555, 9.930278),
-        (3, u"REZZATO", 45.5855555, 9.930278),
-        (3, u"RIVOLTA D'ADDA", 45.5855555, 9.930278),
-        (3, u"S.GIORGIO", 45.5855555, 9.930278),
-        (3, u"S.NAZZARO", 45.5855555, 9.930278),
-        (3, u"SAN ROCCO AL PORTO", 45.5855555, 9.930278),
-        (3, u"SAREZZO - VIA MINELLI", 45.5855555, 9.930278),
-        (3, u"SARONNO - SANTUARIO", 45.5855555, 9.930278),
-        (3, u"SCHIVENOGLIA", 45.5855555, 9.930278),
-        (3, u"SERIATE", 45.5855555, 9.930278),
-        (3, u"SERMIDE TOGLIATTI", 45.5855555, 9.930278),
-        (3, u"SOMMA LOMBARDO - MXP", 45.5855555, 9.930278),
-        (3, u"SONDRIO - VIA MERIZZI", 45.5855555, 9.930278),
-        (3, u"SONDRIO PARIBELLI", 45.5855555, 9.930278),
-        (3, u"SORESINA", 45.5855555, 9.930278),
-        (3, u"TAVAZZANO", 45.5855555, 9.930278),
-        (3, u"TREVIGLIO", 45.5855555, 9.930278),
-        (3, u"TREZZO D'ADDA", 45.5855555, 9.930278),
-        (3, u"TURANO", 45.5855555, 9.930278),
-        (3, u"TURBIGO", 45.5855555, 9.930278),
-        (3, u"VALMADRERA", 45.5855555, 9.930278),
-        (3, u"VARENNA", 45.5855555, 9.930278),
-        (3, u"VARESE - VIA COPELLI", 45.5855555, 9.930278),
-        (3, u"VARESE - VIA VIDOLETTI", 45.5855555, 9.930278),
-        (3, u"VIA TURATI", 45.5855555, 9.930278),
-        (3, u"VIGEVANO", 45.5855555, 9.930278),
-        (3, u"VIMERCATE", 45.5855555, 9.930278),
-        (3, u"VOGHERA - VIA POZZONI", 45.5855555, 9.930278),
-    ]
+    def __init__(self, path=STATIONS_FILE, index_path=None):
+        self.path = path
+        self.index_path = index_path
 
-    # case insensitive find
-    def _find_tuple(self, ident):
+        self._stations = None
+        self._index = None
+        self._grid = None
+        self._digest = None
+
+    def _parse(self):
+        res = []
+
+        with open(self.path, "rb") as f:
+            for row in UnicodeReader(f):
+                if row[0] == u"region":
+                    continue  # header
 
-        if isinstance(ident, unicode) or \
-                isinstance(ident, str):
-            ident = ident.lower()
+                res.append((int(row[0]), row[1],
+                            float(row[2]), float(row[3])))
 
-        for (regcode, name, latitude, longitude) in self.stations:
-            if ident in (name.lower(), ):
-                return (regcode, name, latitude, longitude)
+        return res
 
-        raise KeyError(
-            "'%s' is not a registered sampling station" % ident)
+    def _load(self):
+        """Loads the registry, from the binary index if it is up to
+        date, from the csv file otherwise.
+
+        The index starts with its signature (format version and sha1 of
+        the csv file), which is checked before the rest of it is
+        unpickled. Any index which does not match, or can not be read,
+        is rebuilt.
+        """
+        with open(self.path, "rb") as f:
+            self._digest = hashlib.sha1(f.read()).hexdigest()
+
+        signature = (STATIONS_INDEX_VERSION, self._digest)
+
+        if self.index_path is not None:
+            try:
+                with open(self.index_path, "rb") as f:
+                    if marshal.load(f) == signature:
+                        (stations, index, grid) = cPickle.load(f)
+
+                        if isinstance(stations, list) and \
+                                isinstance(index, dict) and \
+                                isinstance(grid, StationsGrid):
+                            (self._stations, self._index, self._grid) = \
+                                (stations, index, grid)
+                            return
+
+            except IOError:
+                pass  # not built yet
+
+            except Exception, e:
+                logger.debug("Stations index unusable [%s]", e)
+
+        self._stations = self._parse()
+        self._index = _build_index(self._stations, (1, ))
+        self._grid = StationsGrid(self._stations)
+        logger.debug("Loaded %d stations from '%s'", len(self._stations),
+                     self.path)
+
+        if self.index_path is not None:
+            try:
+                tmp = self.index_path + ".tmp"
+                with open(tmp, "wb") as f:
+                    marshal.dump(signature, f)
+                    cPickle.dump((self._stations, self._index, self._grid),
+                                 f, cPickle.HIGHEST_PROTOCOL)
+
+                os.rename(tmp, self.index_path)
+
+            except (IOError, OSError), e:
+                logger.warning("Could not write stations index [%s]", e)
+
+    @property
+    def digest(self):
+        """The sha1 of the csv file the registry is read from.
+        """
+        if self._digest is None:
+            self._load()
+
+        return self._digest
+
+    @property
+    def stations(self):
+        """The list of sampling stations (region code, name, latitude,
+        longitude).
+        """
+        if self._stations is None:
+            self._load()
+
+        return self._stations
+
+    # case insensitive find
+    def _find_tuple(self, ident):
+        if self._index is None:
+            self._load()
+
+        return _find_entry(self._index, ident,
+                           "'%s' is not a registered sampling station")
 
     def get_regcode(self, ident):
 
@@ -328,17 +461,30 @@ class StationsDictionary(object):
 
     def __contains__(self, ident):
         try:
-            (_, _, _, _) = self._find_tuple(ident)
+            self._find_tuple(ident)
             return True
 
-        except:
-            pass
+        except KeyError:
+            return False
+
+    def nearest(self, latitude, longitude):
+        """Returns the station nearest to the given coordinates.
+        """
+        if self._grid is None:
+            self._load()
+
+        return self._grid.nearest(latitude, longitude)
+
+    def within(self, south, west, north, east):
+        """Returns the stations within the given bounding box.
+        """
+        if self._grid is None:
+            self._load()
 
-        return False
+        return self._grid.within(south, west, north, east)
 
     def all(self):
         return self.stations
 
 
-
 stations_dict = StationsDictionary()
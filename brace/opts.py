@@ -16,9 +16,35 @@ import getopt
 from brace.ontology import pollutants_dict
 from brace.ontology import regions_dict
 
+from brace.scheduler import DEFAULT_WORKERS
+from brace.scheduler import DEFAULT_MAX_PER_HOST
+from brace.scheduler import DEFAULT_THROTTLE
+
+from brace.session import DEFAULT_POOL_SIZE
+
+from brace.cache import DEFAULT_CACHE_DIR
+from brace.cache import DEFAULT_CACHE_SIZE
+
+from brace.availability import DEFAULT_AVAILABILITY_TTL
+
+from brace.extsort import DEFAULT_SORT_MEMORY
+
+from brace.out.zipstream import DEFAULT_DEFLATE_LEVEL
+from brace.out.base import DEFAULT_BATCH_SIZE
+from brace.out.npz import HAVE_NUMPY
+
 DEFAULT_FROM_YEAR = 2002
 DEFAULT_TO_YEAR = 2010
 
+# Supported network engines
+ENGINES = ("threads", "async")
+
+# Supported slice sharding modes
+SHARD_MODES = ("pollutant", "year")
+
+# Supported output formats (see brace.out.formats)
+FORMATS = ("dspl", "columnar", "npz", "jsonl")
+
 usage = """
 brace.py - a tool for public data knowledge sharing.
 
@@ -30,8 +56,15 @@ usage:
              [ --to=<to_year> ]
              [ --region=<region_1>  [--region=<region_2> ... ] ]
              [ --pollutant=<formula_1> [--pollutant=<formula_2> ... ] ]
+             [ --workers=<n> ] [ --per-host=<n> ] [ --throttle=<secs> ]
+             [ --engine=<engine> ] [ --pool-size=<n> ]
+             [ --cache-dir=<dir> ] [ --cache-size=<MB> ] [ --no-cache ]
+             [ --availability-ttl=<days> ] [ --refresh ] [ --dry-run ]
+             [ --url-prefix=<url> ] [ --streaming ]
+             [ --sort-memory=<MB> ] [ --deflate-level=<level> ]
+             [ --compress-workers=<n> ] [ --shard=<mode> ] [ --update ]
              [ --verbosity=<level> ] [ --help ]
-             [ --format<format> ]
+             [ --format=<format> ] [ --batch-size=<n> ]
              filename
 
 options:
@@ -72,6 +105,83 @@ options:
 
   %(pollutants)s
 
+  --workers=<n>, the number of archives fetched concurrently (default
+  is %(workers)d). Archives are processed in the same order regardless
+  of this setting, so output does not depend on it.
+
+  --per-host=<n>, the maximum number of concurrent fetches towards the
+  same host (default is %(per_host)d).
+
+  --throttle=<secs>, the minimum delay in seconds between two
+  consecutive fetches started towards the same host (default is
+  %(throttle).1f).
+
+  --engine=<engine>, selects the network engine used to fetch
+  archives. Supported engines are 'threads' (default), which runs
+  blocking downloads on a pool of worker threads, and 'async', which
+  keeps all of the requests in flight on a single event loop. With
+  'async', --workers is the number of requests in flight.
+
+  --pool-size=<n>, the number of idle keep-alive connections retained
+  for each host, for reuse by later requests (default is %(pool_size)d).
+
+  --cache-dir=<dir>, the directory holding the archive cache (default
+  is '%(cache_dir)s'). Cached archives are revalidated with a conditional
+  request, and downloaded again only if they have changed. The cache
+  directory also holds a manifest of the archive locations resolved by
+  the ISPRA servlet, so that later runs can skip the servlet step.
+
+  --cache-size=<MB>, the maximum size of the archive cache, in
+  megabytes (default is %(cache_size)d). Least recently used archives are
+  evicted first.
+
+  --no-cache, disables the archive cache and the locations manifest.
+
+  --availability-ttl=<days>, the number of days a region, pollutant
+  and year combination which yielded no data is skipped for (default
+  is %(availability_ttl)d). Availability information is kept in the cache
+  directory.
+
+  --refresh, fetches every combination, including the ones known to
+  yield no data.
+
+  --dry-run, prints the fetch plan, along with the estimated bytes and
+  rows to be fetched, and exits.
+
+  --url-prefix=<url>, the url of the site to fetch archives from,
+  instead of the ISPRA web site (e.g. a local stand-in, see
+  brace/standin.py). This can be set from the environment as well, by
+  means of the BRACE_URL_PREFIX variable.
+
+  --streaming, folds each row into daily aggregates as soon as it is
+  read, instead of retaining all of the hourly data until output is
+  written. This takes much less memory.
+
+  --sort-memory=<MB>, the amount of memory used to compute daily
+  aggregates, and to sort output rows (default is %(sort_memory)d MB).
+  Past that, aggregates are computed by sorting, and sorted in runs,
+  on disk.
+
+  --deflate-level=<level>, the compression level of the output archive,
+  between 0 (no compression) and 9 (best compression). Default is
+  %(deflate_level)d.
+
+  --compress-workers=<n>, the number of processes deflating the output
+  archive in parallel, in blocks (default is 1, i.e. no parallelism).
+
+  --shard=<mode>, splits the DSPL slice in a slice and table for each
+  pollutant ('pollutant'), or for each pollutant and year ('year'),
+  each backed by its own csv file, so that consumers can load only
+  the partitions they need. By default, a single slice holds all of
+  the data.
+
+  --update, merges the data into the existing output file (e.g. a
+  newly published year), instead of writing it from scratch. Daily
+  aggregates for the stations and days found in the data replace the
+  ones in the output file, all of the others are retained. Slice
+  tables with nothing to merge are copied as they are. The output
+  file must be sharded the same way (see --shard).
+
   --help, prints this message.
 
   --verbosity=<level>, adjusts the level of verbosity of the
@@ -79,7 +189,15 @@ options:
   verbose). This is manly for debugging purposes.
 
   --format=<format>, determines the output format for the dataset.
-  Currently the tool supports only DSPL (Dataset publishing Language).
+  Supported formats are:
+
+  dspl, DSPL (Dataset Publishing Language) bundle (default)
+  columnar, compact binary file of typed columns (see brace/out/columnar.py)
+  npz, NumPy arrays archive, one array per column (requires NumPy)
+  jsonl, newline delimited JSON, one object per daily aggregate
+
+  --batch-size=<n>, the number of daily aggregates written at once, by
+  the columnar, npz and jsonl formats (default is %(batch_size)d).
 
 arguments:
 
@@ -92,6 +210,17 @@ arguments:
             'formula': pollutants_dict.get_formula(p[0]),
             'name': pollutants_dict.get_name(p[0]),
             } for p in pollutants_dict.all() ]),
+
+    'workers': DEFAULT_WORKERS,
+    'per_host': DEFAULT_MAX_PER_HOST,
+    'throttle': DEFAULT_THROTTLE,
+    'pool_size': DEFAULT_POOL_SIZE,
+    'cache_dir': DEFAULT_CACHE_DIR,
+    'cache_size': DEFAULT_CACHE_SIZE,
+    'availability_ttl': DEFAULT_AVAILABILITY_TTL,
+    'sort_memory': DEFAULT_SORT_MEMORY,
+    'deflate_level': DEFAULT_DEFLATE_LEVEL,
+    'batch_size': DEFAULT_BATCH_SIZE,
 }
 
 
@@ -109,6 +238,26 @@ class OptionsManager(object):
         "year=",
         "pollutant=",
         "region=",
+        "workers=",
+        "per-host=",
+        "throttle=",
+        "engine=",
+        "pool-size=",
+        "cache-dir=",
+        "cache-size=",
+        "no-cache",
+        "availability-ttl=",
+        "refresh",
+        "dry-run",
+        "url-prefix=",
+        "streaming",
+        "sort-memory=",
+        "deflate-level=",
+        "compress-workers=",
+        "shard=",
+        "update",
+        "format=",
+        "batch-size=",
     ]
 
     def __init__(self):
@@ -117,6 +266,26 @@ class OptionsManager(object):
         self.verbosity = 1  # Normal
         self.keep = False
         self.local = False
+        self.workers = DEFAULT_WORKERS
+        self.per_host = DEFAULT_MAX_PER_HOST
+        self.throttle = DEFAULT_THROTTLE
+        self.engine = "threads"
+        self.pool_size = DEFAULT_POOL_SIZE
+        self.cache = True
+        self.cache_dir = DEFAULT_CACHE_DIR
+        self.cache_size = DEFAULT_CACHE_SIZE
+        self.availability_ttl = DEFAULT_AVAILABILITY_TTL
+        self.refresh = False
+        self.dry_run = False
+        self.url_prefix = None
+        self.streaming = False
+        self.sort_memory = DEFAULT_SORT_MEMORY
+        self.deflate_level = DEFAULT_DEFLATE_LEVEL
+        self.compress_workers = 1
+        self.shard = None
+        self.update = False
+        self.format = "dspl"
+        self.batch_size = DEFAULT_BATCH_SIZE
 
         self.regions = []
         self.pollutants = []
@@ -174,6 +343,155 @@ class OptionsManager(object):
                 logger.debug("Adding pollutant '%s' (%s)",
                              pollutant_formula, pollutant_name)
 
+            elif o == "--workers":
+                workers = int(a)
+                if workers < 1:
+                    raise getopt.GetoptError(
+                        "At least one worker is required")
+
+                self.workers = workers
+                logger.debug("Setting number of workers to %d", workers)
+
+            elif o == "--per-host":
+                per_host = int(a)
+                if per_host < 1:
+                    raise getopt.GetoptError(
+                        "At least one fetch per host is required")
+
+                self.per_host = per_host
+                logger.debug("Setting fetches per host to %d", per_host)
+
+            elif o == "--throttle":
+                throttle = float(a)
+                if throttle < 0:
+                    raise getopt.GetoptError(
+                        "Throttle delay can not be negative")
+
+                self.throttle = throttle
+                logger.debug("Setting throttle delay to %.3fs", throttle)
+
+            elif o == "--engine":
+                engine = a.lower()
+                if engine not in ENGINES:
+                    raise getopt.GetoptError(
+                        "Unsupported engine '%s'" % a)
+
+                self.engine = engine
+                logger.debug("Setting network engine to '%s'", engine)
+
+            elif o == "--pool-size":
+                pool_size = int(a)
+                if pool_size < 0:
+                    raise getopt.GetoptError(
+                        "Pool size can not be negative")
+
+                self.pool_size = pool_size
+                logger.debug("Setting connection pool size to %d", pool_size)
+
+            elif o == "--cache-dir":
+                self.cache_dir = a
+                logger.debug("Setting cache directory to '%s'", a)
+
+            elif o == "--cache-size":
+                cache_size = int(a)
+                if cache_size < 0:
+                    raise getopt.GetoptError(
+                        "Cache size can not be negative")
+
+                self.cache_size = cache_size
+                logger.debug("Setting cache size to %dMB", cache_size)
+
+            elif o == "--no-cache":
+                self.cache = False
+                logger.debug("Disabling archive cache")
+
+            elif o == "--availability-ttl":
+                ttl = int(a)
+                if ttl < 0:
+                    raise getopt.GetoptError(
+                        "Availability TTL can not be negative")
+
+                self.availability_ttl = ttl
+                logger.debug("Setting availability TTL to %d days", ttl)
+
+            elif o == "--refresh":
+                self.refresh = True
+                logger.debug("Ignoring known data availability")
+
+            elif o == "--dry-run":
+                self.dry_run = True
+
+            elif o == "--url-prefix":
+                self.url_prefix = a.rstrip("/")
+                logger.debug("Setting url prefix to '%s'", self.url_prefix)
+
+            elif o == "--streaming":
+                self.streaming = True
+                logger.debug("Enabling streaming aggregation")
+
+            elif o == "--sort-memory":
+                sort_memory = int(a)
+                if sort_memory < 1:
+                    raise getopt.GetoptError(
+                        "Sort memory must be at least 1MB")
+
+                self.sort_memory = sort_memory
+                logger.debug("Setting sort memory to %dMB", sort_memory)
+
+            elif o == "--deflate-level":
+                level = int(a)
+                if not 0 <= level <= 9:
+                    raise getopt.GetoptError(
+                        "Deflate level must be between 0 and 9")
+
+                self.deflate_level = level
+                logger.debug("Setting deflate level to %d", level)
+
+            elif o == "--compress-workers":
+                workers = int(a)
+                if workers < 1:
+                    raise getopt.GetoptError(
+                        "At least one compress worker is required")
+
+                self.compress_workers = workers
+                logger.debug("Setting compress workers to %d", workers)
+
+            elif o == "--shard":
+                shard = a.lower()
+                if shard not in SHARD_MODES:
+                    raise getopt.GetoptError(
+                        "Unsupported sharding mode '%s'" % a)
+
+                self.shard = shard
+                logger.debug("Sharding slices by %s", shard)
+
+            elif o == "--update":
+                self.update = True
+                logger.debug("Updating existing output")
+
+            elif o == "--format":
+                format = a.lower()
+                if format not in FORMATS:
+                    raise getopt.GetoptError(
+                        "Unsupported format '%s'" % a)
+
+                if format == "npz" and not HAVE_NUMPY:
+                    raise getopt.GetoptError(
+                        "The npz format requires NumPy, which is not "
+                        "installed")
+
+                self.format = format
+                logger.debug("Setting output format to '%s'", format)
+
+            elif o == "--batch-size":
+                batch_size = int(a)
+                if batch_size < 1:
+                    raise getopt.GetoptError(
+                        "Batch size must be at least 1")
+
+                self.batch_size = batch_size
+                logger.debug("Setting batch size to %d", batch_size)
+
             elif o == "--verbosity":
                 level = int(a)
                 self.verbosity = level
@@ -213,5 +531,13 @@ class OptionsManager(object):
             else:
                 assert False, "unhandled option"
 
+        if self.local and self.engine == "async":
+            raise getopt.GetoptError(
+                "--local and --engine=async are not supported together")
+
+        if self.format != "dspl" and (self.shard or self.update):
+            raise getopt.GetoptError(
+                "--shard and --update are supported by the dspl format only")
+
 
 opts_mgr = OptionsManager()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Output plugins interface
+"""
+import itertools
+
+# Abstract base classes support
+from abc import ABCMeta, abstractmethod
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+from brace.ontology import pollutants_dict
+
+from brace.aggregate import daily_aggregates
+from brace.extsort import external_sort, DEFAULT_SORT_MEMORY
+
+# Default number of aggregates handed over to writers at once
+DEFAULT_BATCH_SIZE = 4096
+
+
+def batches(iterable, size):
+    """Yields lists of (at most) size items of iterable, in order.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+
+        yield batch
+
+
+class Dumper(object):
+    """Output plugin interface. A dumper writes the daily aggregates of
+    a DataManager to a file, when called. The extension of the format is
+    appended to out, unless it has one already.
+    """
+
+    __metaclass__ = ABCMeta
+
+    # file name extension of the format
+    EXTENSION = None
+
+    def __init__(self, data_mgr, out):
+        self._data_mgr = data_mgr
+
+        if '.' not in out:
+            out = out + self.EXTENSION
+        self._out = out
+
+    @classmethod
+    def from_options(cls, data_mgr, out, opts):
+        """Builds a dumper, as configured by opts (an OptionsManager).
+        """
+        return cls(data_mgr, out)
+
+    def check(self):
+        """Checks, before any data is fetched, that the output file can
+        be written as configured. Raises ValueError otherwise.
+        """
+
+    @abstractmethod
+    def __call__(self):
+        """Writes the output file.
+        """
+
+
+class BatchDumper(Dumper):
+    """Base class for dumpers consuming the aggregate stream in batches
+    of bounded size. Aggregates are computed, then sorted by region,
+    station, pollutant formula and day, with at most sort_memory MB of
+    memory each (see bounded_group_by and external_sort), on top of the
+    data held by the DataManager.
+
+    Each batch is handed over to _write by columns: a tuple of region
+    names, station names, pollutant formulas, days (since the epoch),
+    daily maxima and daily averages. Subclasses implement _open, _write
+    and _close.
+    """
+
+    # names of the columns of each batch
+    COLUMNS = ("region", "station", "pollutant", "day", "max", "avg")
+
+    def __init__(self, data_mgr, out, sort_memory=DEFAULT_SORT_MEMORY,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        super(BatchDumper, self).__init__(data_mgr, out)
+
+        self._sort_memory = sort_memory
+        self._batch_size = batch_size
+
+    @classmethod
+    def from_options(cls, data_mgr, out, opts):
+        return cls(data_mgr, out, opts.sort_memory, opts.batch_size)
+
+    def _records(self):
+        for (region, station, day, pollutant, max_, avg_) in \
+                daily_aggregates(self._data_mgr, sort=False,
+                                 sort_memory=self._sort_memory):
+
+            yield (region, station, pollutants_dict.get_formula(pollutant),
+                   day, max_, avg_)
+
+    def __call__(self):
+        self._open()
+
+        count = 0
+        for batch in batches(external_sort(self._records(),
+                                           self._sort_memory),
+                             self._batch_size):
+
+            self._write(zip(*batch))
+            count += len(batch)
+
+        self._close()
+        logger.info("Written %d aggregates to '%s'", count, self._out)
+
+    @abstractmethod
+    def _open(self):
+        """Opens the output file.
+        """
+
+    @abstractmethod
+    def _write(self, columns):
+        """Writes a batch of aggregates, by columns.
+        """
+
+    @abstractmethod
+    def _close(self):
+        """Completes and closes the output file.
+        """
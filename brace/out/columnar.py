@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Compact binary columnar output services
+"""
+import os
+import sys
+import json
+import struct
+import itertools
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Compact storage support
+import array
+
+from brace.data import Codebook
+from brace.out.base import BatchDumper
+
+# File header: magic, version
+HEADER = struct.Struct("<4sH")
+MAGIC = "BRCF"
+VERSION = 1
+
+# File trailer: length of the JSON footer, magic
+TRAILER = struct.Struct("<I4s")
+
+# Columns are aligned to this many bytes
+ALIGNMENT = 8
+
+# array typecodes of the columns (see BatchDumper.COLUMNS)
+COLUMN_TYPES = ('H', 'H', 'H', 'i', 'd', 'd')
+
+# Dictionary encoded columns, the first ones
+DICTIONARY_COLUMNS = ("region", "station", "pollutant")
+
+
+def _align(offset):
+    return -offset % ALIGNMENT
+
+
+class ColumnEncoder(object):
+    """Encodes batches of aggregates (see BatchDumper) as typed arrays.
+    Region names, station names and pollutant formulas are dictionary
+    encoded, as codes into the dictionaries.
+    """
+
+    def __init__(self):
+        self._codebooks = [Codebook() for _ in DICTIONARY_COLUMNS]
+
+    def encode(self, columns):
+        """Returns the columns of a batch as arrays (see COLUMN_TYPES).
+        """
+        (regions, stations, formulas, days, maxs, avgs) = columns
+
+        coded = [map(codebook.code, column)
+                 for (codebook, column) in itertools.izip(
+                self._codebooks, (regions, stations, formulas))]
+
+        return [array.array(typecode, values)
+                for (typecode, values) in itertools.izip(
+                COLUMN_TYPES, coded + [days, maxs, avgs])]
+
+    @property
+    def dictionaries(self):
+        """The values of the dictionary encoded columns, by column.
+        """
+        return dict(itertools.izip(DICTIONARY_COLUMNS,
+                                   (codebook.values
+                                    for codebook in self._codebooks)))
+
+
+class ColumnarDumper(BatchDumper):
+    """Writes aggregates to a binary file, by columns. Each batch is
+    written as a block of fixed width columns (see COLUMN_TYPES),
+    aligned and in native byte order. A JSON footer, at the end of the
+    file, describes the columns, the blocks and holds the dictionaries.
+    See ColumnarFile for reading.
+    """
+
+    EXTENSION = ".brc"
+
+    def _open(self):
+        self._file = open(self._out, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+
+        self._encoder = ColumnEncoder()
+        self._blocks = []
+
+    def _write(self, columns):
+        offsets = []
+        for column in self._encoder.encode(columns):
+            self._file.write("\0" * _align(self._file.tell()))
+            offsets.append(self._file.tell())
+            column.tofile(self._file)
+
+        self._blocks.append((len(columns[0]), offsets))
+
+    def _close(self):
+        footer = json.dumps({
+            'byteorder': sys.byteorder,
+            'columns': zip(self.COLUMNS, COLUMN_TYPES),
+            'dictionaries': self._encoder.dictionaries,
+            'blocks': self._blocks,
+        })
+
+        self._file.write(footer)
+        self._file.write(TRAILER.pack(len(footer), MAGIC))
+        self._file.close()
+
+
+class ColumnarFile(object):
+    """Reads a file written by ColumnarDumper, block by block.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+
+        (magic, version) = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a columnar file: '%s'" % path)
+
+        self._file.seek(-TRAILER.size, os.SEEK_END)
+        (size, magic) = TRAILER.unpack(self._file.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError("Truncated columnar file: '%s'" % path)
+
+        self._file.seek(-TRAILER.size - size, os.SEEK_END)
+        self.footer = json.loads(self._file.read(size))
+        if self.footer["byteorder"] != sys.byteorder:
+            raise ValueError("Byte order mismatch: '%s'" % path)
+
+        self.columns = [name for (name, _) in self.footer["columns"]]
+        self.dictionaries = self.footer["dictionaries"]
+
+    def __len__(self):
+        return sum(rows for (rows, _) in self.footer["blocks"])
+
+    def blocks(self):
+        """Yields the columns of each block, as arrays (see
+        COLUMN_TYPES).
+        """
+        for (rows, offsets) in self.footer["blocks"]:
+            res = []
+            for ((_, typecode), offset) in itertools.izip(
+                    self.footer["columns"], offsets):
+
+                self._file.seek(offset)
+                column = array.array(str(typecode))
+                column.fromfile(self._file, rows)
+                res.append(column)
+
+            yield tuple(res)
+
+    def close(self):
+        self._file.close()
@@ -2,16 +2,13 @@
 """DSPL (Dataset Publishing Language) output services
 """
 
-# os services
+# System services
 import os
+import re
 
 # time services
-import time
 import datetime
 
-# Temporary files support
-import tempfile
-
 # Logging support
 import logging
 logger = logging.getLogger("brace")
@@ -23,12 +20,45 @@ from brace.ontology import pollutants_dict
 from brace.ontology import regions_dict
 from brace.ontology import stations_dict
 
+from brace.timestamps import format_day, parse_isoday, year_of
+from brace.aggregate import daily_aggregates
+from brace.extsort import external_sort, DEFAULT_SORT_MEMORY
+from brace.out.zipstream import ZipEntryWriter, DEFAULT_DEFLATE_LEVEL
+from brace.out.zipstream import copy_member
+from brace.out.base import Dumper
+from brace.csvio import UnicodeReader, UnicodeWriter
+
 # zipfile
 import zipfile
-import shutil
+
+# Standard services
+import heapq
+import itertools
+import operator
+
+# Multiprocessing support
+import multiprocessing
 
 from xml.sax.saxutils import escape
 
+# Members are stored under this directory in the output archive
+ARCHIVE_DIR = "zip/"
+
+# Slice table members of an existing bundle (see shard_filename)
+SHARD_MEMBER = re.compile(r"^%sdata((?:_[^_/]+)*)\.csv$" %
+                          re.escape(ARCHIVE_DIR))
+
+# Columns of the slice tables
+SLICE_COLUMNS = (u"region", u"station", u"aggregate", u"pollutant", u"day",
+                 u"measurement")
+
+# Number of shard fields, by sharding mode
+SHARD_FIELDS = {
+    None: 0,
+    "pollutant": 1,
+    "year": 2,
+}
+
 # TODO: this code is *very* raw, at some point in time this should use
 # some decent templating engine (e.g. Genshi)
 
@@ -220,6 +250,46 @@ def build_dspl_pollutant_concept_xml(pollutant):
 """
 
 
+# -- shards
+def shard_suffix(shard):
+    """Returns the suffix of the ids of the slice and table for a shard
+    of the data. A shard is a tuple: () for the whole data set,
+    (formula, ) for a pollutant, (formula, year) for a pollutant in a
+    year.
+    """
+    return "".join("_%s" % part for part in shard)
+
+
+def shard_filename(shard):
+    """Returns the name of the csv file backing the table of a shard.
+    """
+    return "data%s.csv" % shard_suffix(shard)
+
+
+def shard_comment(shard):
+    """Describes a shard, within an XML comment.
+    """
+    if not shard:
+        return ""
+
+    return " (%s)" % ", ".join(map(str, shard))
+
+
+def merge_updates(rows, updates):
+    """Yields sorted records, out of rows and updates, both sorted
+    records whose last field is a value, and the others a key. Updates
+    replace rows with the same key.
+    """
+    last = None
+    for (key, _, record) in heapq.merge(
+            ((row[:-1], 1, row) for row in rows),
+            ((update[:-1], 0, update) for update in updates)):
+
+        if key != last:
+            last = key
+            yield record
+
+
 # -- tables
 def build_dspl_aggregates_table_xml():
     """
@@ -284,12 +354,13 @@ def build_dspl_stations_table_xml():
 """
 
 
-def build_dspl_pollutants_slice_table_xml():
-    """Builds the dspl pollutants slice table.
+def build_dspl_pollutants_slice_table_xml(shard=()):
+    """Builds the dspl pollutants slice table, for a shard (see
+    shard_suffix).
     """
 
-    return """<!-- Slice table for pollutants. -->
-<table id="pollutants_slice_table">
+    return """<!-- Slice table for pollutants%(comment)s. -->
+<table id="pollutants_slice_table%(suffix)s">
     <column id="region" type="string" />
     <column id="station" type="string" />
     <column id="aggregate" type="string" />
@@ -298,13 +369,17 @@ def build_dspl_pollutants_slice_table_xml():
 
     <column id="measurement" type="float" />
     <data>
-        <file format="csv" encoding="utf-8">data.csv</file>
+        <file format="csv" encoding="utf-8">%(filename)s</file>
     </data>
 </table>
-"""
+""" % {
+        'comment': shard_comment(shard),
+        'suffix': shard_suffix(shard),
+        'filename': shard_filename(shard),
+}
 
 
-def build_dspl_tables_xml():
+def build_dspl_tables_xml(shards=((),)):
     """
     """
 
@@ -317,7 +392,7 @@ def build_dspl_tables_xml():
         "\n" + \
         build_dspl_stations_table_xml() + \
         "\n" + \
-        build_dspl_pollutants_slice_table_xml()
+        "\n".join(map(build_dspl_pollutants_slice_table_xml, shards))
 
 
 def build_dspl_concepts_xml():
@@ -337,11 +412,11 @@ def build_dspl_concepts_xml():
         build_dspl_measurement_concept_xml()
 
 
-def build_dspl_pollutant_slice_xml():
+def build_dspl_pollutant_slice_xml(shard=()):
+    """Builds the dspl pollutants slice, for a shard (see shard_suffix).
     """
-    """
-    return """<!-- Slice for pollutants -->
-<slice id="pollutants_slice">
+    return """<!-- Slice for pollutants%(comment)s -->
+<slice id="pollutants_slice%(suffix)s">
     <dimension concept="region" />
     <dimension concept="station" />
     <dimension concept="aggregate" />
@@ -349,21 +424,22 @@ def build_dspl_pollutant_slice_xml():
     <dimension concept="time:day" />
 
     <metric concept="measurement" />
-    <table ref="pollutants_slice_table" />
+    <table ref="pollutants_slice_table%(suffix)s" />
 </slice>
-"""
+""" % {
+        'comment': shard_comment(shard),
+        'suffix': shard_suffix(shard),
+}
 
 
-def build_dspl_slices_xml():
-    """Builds the dspl slices for pollutants.
+def build_dspl_slices_xml(shards=((),)):
+    """Builds the dspl slices for pollutants, one for each shard.
     """
-    # return \
-    #     "\n".join(map(build_dspl_pollutant_slice_xml,
-    #                   opts_mgr.pollutants))
-    return build_dspl_pollutant_slice_xml()
+    return "\n".join(map(build_dspl_pollutant_slice_xml, shards))
+
 
-def build_dspl_xml():
-    """Builds the dspl file.
+def build_dspl_xml(shards=((),)):
+    """Builds the dspl file, with a slice and table for each of shards.
     """
 
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -421,197 +497,318 @@ def build_dspl_xml():
 """ % {
         'now': datetime.datetime.now().strftime("%a, %d %b %Y - %H:%M"),
         'concepts': build_dspl_concepts_xml(),
-        'tables': build_dspl_tables_xml(),
-        'slices': build_dspl_slices_xml(),
+        'tables': build_dspl_tables_xml(shards),
+        'slices': build_dspl_slices_xml(shards),
 }
 
 
 
-class DsplDumper(object):
-    """(missing docs)
+class DsplDumper(Dumper):
+    """Writes aggregates as a DSPL bundle (a zip archive holding the
+    XML descriptor and the csv tables).
     """
 
-    def __init__(self, data_mgr, out):
-        self._data_mgr = data_mgr
-        self._out = out
-        self._tmpdir = "zip/"
+    EXTENSION = ".zip"
 
-    def _yield(self):
-        """Yields aggregate data for this output plugin.
+    def __init__(self, data_mgr, out, sort_memory=DEFAULT_SORT_MEMORY,
+                 deflate_level=DEFAULT_DEFLATE_LEVEL, workers=1, shard=None,
+                 update=False):
+        super(DsplDumper, self).__init__(data_mgr, out)
+
+        self._sort_memory = sort_memory
+        self._deflate_level = deflate_level
+        self._workers = workers
+        self._pool = None
+
+        # slices are sharded by pollutant ('pollutant'), by pollutant
+        # and year ('year'), or not at all (None)
+        self._shard = shard
+
+        # if set, an existing bundle is updated with the data, rather
+        # than written from scratch
+        self._update = update
+
+    @classmethod
+    def from_options(cls, data_mgr, out, opts):
+        return cls(data_mgr, out, opts.sort_memory, opts.deflate_level,
+                   opts.compress_workers, opts.shard, opts.update)
+
+    def _member(self, azip, name):
+        """Returns a writer for a member of the output archive.
         """
-        # initialization
-        region = None
-        station = None
-        pollutant = None
-        day = None
-
-        max_ = 0.0   # (aggregate max)
-        cum_ = 0.0   # (aggregate cum sum)
-        samples = 0  # (number of samples, needed for avg)
-        data = False # when True data needs to be yielded
-
-        for row in self._data_mgr.data:
-            (row_region, row_station, row_pollutant, row_timestamp, row_quantity) = row
-
-            # day as a 3-tuple
-            row_day = (row_timestamp.tm_year, row_timestamp.tm_mon, row_timestamp.tm_mday)
-
-            # new data available ?
-            data = region is not None and \
-                   (row_region != region or \
-                    row_station != station or \
-                    row_pollutant != pollutant or \
-                    row_day != day)
-
-            # if dealing with another region, station, pollutant or day,
-            # yield result and reinitialize counters
-            if data:
-
-                avg_ = cum_ / samples
-                yield (region, station, day, pollutant, max_, avg_)
-                max_ = 0.0
-                cum_ = 0.0
-                samples = 0
-                data = False
-
-            region = row_region
-            station = row_station
-            pollutant = row_pollutant
-            day = row_day
-
-            # update aggregate measurement
-            max_ = max(max_, row_quantity)
-            cum_ += row_quantity
-            samples += 1
-
-        # yield last row if necessary
-        if data:
-            avg_ = cum_ / samples
-            yield (region, station, day, pollutant, max_, avg_)
+        return ZipEntryWriter(azip, ARCHIVE_DIR + name, self._deflate_level,
+                              self._pool, self._workers)
 
-    def __call__(self):
+    def _writer(self, member):
+        """Returns a csv writer for a member of the output archive (see
+        _member). Fields are quoted as needed.
+        """
+        return UnicodeWriter(member, lineterminator="\n")
+
+    def _reader(self, bundle, name):
+        """Returns a csv reader for a member of an existing bundle.
+        Bundles written before tables went through the csv module have
+        fields separated by ", ", those spaces are skipped.
+        """
+        return UnicodeReader(bundle.open(name), skipinitialspace=True)
+
+    def _shard_of(self, formula, day):
+        """Returns the shard an aggregate belongs to.
+        """
+        if self._shard == "pollutant":
+            return (formula, )
+
+        if self._shard == "year":
+            return (formula, year_of(day))
 
-        if '.' not in self._out:
-            self._out = self._out + ".zip"
+        return ()
 
-        # disk cleanup
-        if (os.path.exists(self._tmpdir)):
-            shutil.rmtree(self._tmpdir, True)  # TODO add something for errors
-        os.mkdir(self._tmpdir)
+    def _slice_table(self, azip, shard, rows):
+        """Writes the csv file of the slice table of a shard, out of
+        sorted rows.
+        """
+        with self._member(azip, shard_filename(shard)) as member:
+            data_csv = self._writer(member)
+            data_csv.writerow(SLICE_COLUMNS)
+
+            # generate aggregated data
+            for (_, region, station, aggregate, formula, day, qty) in rows:
+                data_csv.writerow((region, station, aggregate, formula,
+                                   format_day(day), u"%.3f" % qty))
+
+    def _bundle_shards(self, bundle):
+        """Returns the slice table members of an existing bundle, by
+        shard. Raises ValueError if the bundle is not sharded the way
+        the output is.
+        """
+        res = {}
+        for name in bundle.namelist():
+            match = SHARD_MEMBER.match(name)
+            if match is None:
+                continue
+
+            shard = tuple(match.group(1).split("_")[1:])
+            if len(shard) != SHARD_FIELDS[self._shard]:
+                modes = dict((fields, mode or "none")
+                             for (mode, fields) in SHARD_FIELDS.iteritems())
+                raise ValueError(
+                    "Bundle '%s' is sharded differently (%s, not %s), "
+                    "use the same --shard or rebuild it" % (
+                        self._out, modes.get(len(shard), "unknown"),
+                        modes[SHARD_FIELDS[self._shard]]))
+
+            if len(shard) == 2:
+                shard = (shard[0], int(shard[1]))
+
+            res[shard] = name
+
+        return res
+
+    def _bundle_rows(self, bundle, name):
+        """Yields the records of a slice table of an existing bundle, in
+        the order they are stored.
+        """
+        reader = self._reader(bundle, name)
+        reader.next()  # header
+
+        for (region, station, aggregate, formula, day, qty) in reader:
+            day = parse_isoday(day)
+            yield (self._shard_of(formula, day), region, station, aggregate,
+                   formula, day, float(qty))
+
+    def _bundle_current(self, bundle, name):
+        """Tells whether a slice table of an existing bundle is written
+        the way it is now: through the csv module, and sorted. Tables
+        written before that have fields separated by ", ", some of them
+        not sorted by aggregate (max rows came first).
+        """
+        return bundle.open(name).readline().rstrip("\r\n") == \
+            ",".join(SLICE_COLUMNS)
 
-        azip = zipfile.ZipFile(self._out, "w" )
+    def _bundle_table(self, bundle, name):
+        """Yields the sorted records of a slice table of an existing
+        bundle. Older tables (see _bundle_current) are sorted again.
+        """
+        rows = self._bundle_rows(bundle, name)
+        if self._bundle_current(bundle, name):
+            return rows
+
+        logger.info("Sorting '%s', written by an older version", name)
+        return external_sort(rows, self._sort_memory)
+
+    def _bundle_regions(self, bundle):
+        """Returns the codes of the regions of an existing bundle.
+        """
+        reader = self._reader(bundle, ARCHIVE_DIR + "regions.csv")
+        reader.next()  # header
+
+        return [regions_dict.get_pk(row[0]) for row in reader]
+
+    def _copy_table(self, azip, bundle, shard, name):
+        """Copies the slice table of a shard from an existing bundle as
+        it is, unless it was written by an older version (see
+        _bundle_current): it is written again.
+        """
+        if self._bundle_current(bundle, name):
+            copy_member(azip, bundle, name)
+
+        else:
+            self._slice_table(azip, shard, self._bundle_table(bundle, name))
+
+    def check(self):
+        """Checks that the bundle to update, if any, is sharded the way
+        the output is.
+        """
+        if not self._update or not os.path.exists(self._out):
+            return
+
+        try:
+            bundle = zipfile.ZipFile(self._out, "r")
+            try:
+                self._bundle_shards(bundle)
+
+            finally:
+                bundle.close()
+
+        except zipfile.BadZipfile, e:
+            raise ValueError("Bundle '%s' can not be updated [%s]" % (
+                    self._out, e))
+
+    def __call__(self):
 
-        # write output to file
-        fullpath = os.path.join(self._tmpdir, "brace.xml")
-        xml = open(fullpath, "wt")
-        xml.write(build_dspl_xml())
-        xml.close()
-        azip.write(fullpath)
+        # an existing bundle is read while the new one is written, the
+        # latter replaces the former when complete
+        bundle = None
+        bundled = {}
+        target = self._out
+        if self._update:
+            if os.path.exists(self._out):
+                bundle = zipfile.ZipFile(self._out, "r")
+                bundled = self._bundle_shards(bundle)
+                target = self._out + ".tmp"
+
+            else:
+                logger.info("No bundle to update, writing '%s'", self._out)
+
+        # members are deflated by a pool of processes, if more than one
+        # worker is requested
+        if 1 < self._workers:
+            self._pool = multiprocessing.Pool(self._workers)
+
+        done = False
+        try:
+            self._dump(target, bundle, bundled)
+            done = True
+
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+            if bundle is not None:
+                bundle.close()
+
+            if not done and target != self._out and os.path.exists(target):
+                os.remove(target)
+
+        if target != self._out:
+            os.rename(target, self._out)
+
+    def _dump(self, target, bundle=None, bundled=None):
+        azip = zipfile.ZipFile(target, "w")
+
+        # regions of the bundle being updated are retained, first
+        regions = []
+        if bundle is not None:
+            regions = self._bundle_regions(bundle)
+        regions.extend(r for r in opts_mgr.regions if r not in regions)
 
         # write aggregates csv file
-        fullpath = os.path.join(self._tmpdir, "aggregates.csv")
-        aggrcsv = open(fullpath, "wt")
-        aggrcsv.write("aggregate, description\n")
-        for (id, desc) in [ ( "max", "Maximum daily concentration" ),
-                            ( "avg", "Average daily concentration" ), ]:
-            entry = u"%(id)s, %(description)s\n" % {
-                'id': id,
-                'description': desc,
-            }
-            aggrcsv.write(entry)
-        aggrcsv.close()
-        azip.write(fullpath)
+        with self._member(azip, "aggregates.csv") as member:
+            aggrcsv = self._writer(member)
+            aggrcsv.writerow((u"aggregate", u"description"))
+            for (id, desc) in [ ( u"max", u"Maximum daily concentration" ),
+                                ( u"avg", u"Average daily concentration" ), ]:
+                aggrcsv.writerow((id, desc))
 
         # write regions csv file
-        fullpath = os.path.join(self._tmpdir, "regions.csv")
-        regcsv = open(fullpath, "wt")
-        regcsv.write("region, name, latitude, longitude\n")
-        for r in opts_mgr.regions:
-            entry = u"%(region)s, %(region)s, %(latitude)s, %(longitude)s\n" % {
-                'region': regions_dict.get_name(r),
-                'latitude': regions_dict.get_latitude(r),
-                'longitude': regions_dict.get_longitude(r),
-            }
-            regcsv.write(entry)
-        regcsv.close()
-        azip.write(fullpath)
+        with self._member(azip, "regions.csv") as member:
+            regcsv = self._writer(member)
+            regcsv.writerow((u"region", u"name", u"latitude", u"longitude"))
+            for r in regions:
+                regcsv.writerow((regions_dict.get_name(r),
+                                 regions_dict.get_name(r),
+                                 unicode(regions_dict.get_latitude(r)),
+                                 unicode(regions_dict.get_longitude(r))))
 
         # write stations csv file
-        fullpath = os.path.join(self._tmpdir, "stations.csv")
-        stscsv = open(fullpath, "wt")
-        stscsv.write("station, name, region, latitude, longitude\n")
-        for (regcode, name, latitude, longitude) in stations_dict.all():
-            entry = u"%(station)s, %(station)s, %(region)s, %(latitude)s, %(longitude)s\n" % {
-                'station': name,
-                'region': regions_dict.get_name(regcode),
-                'latitude': latitude,
-                'longitude': longitude,
-            }
-            stscsv.write(entry)
-        stscsv.close()
-        azip.write(fullpath)
+        with self._member(azip, "stations.csv") as member:
+            stscsv = self._writer(member)
+            stscsv.writerow((u"station", u"name", u"region", u"latitude",
+                             u"longitude"))
+            for (regcode, name, latitude, longitude) in stations_dict.all():
+                stscsv.writerow((name, name, regions_dict.get_name(regcode),
+                                 unicode(latitude), unicode(longitude)))
 
         # write pollutants csv file
-        fullpath = os.path.join(self._tmpdir, "pollutants.csv")
-        csv = open(fullpath, "wt")
-        csv.write("pollutant, description\n")
-        for (_, formula, description) in pollutants_dict.all():
-            entry = u"%(formula)s, %(description)s\n" % {
-                'formula': formula,
-                'description': escape(description),
-                }
-            csv.write(entry)
-        csv.close()
-        azip.write(fullpath)
-
-        # write pollutants csv files for slice tables
-        # Remark: as csv file *must* be sorted according to dimensions
-        # it is necessary to build two separate temp files and then
-        # join them together when every row has been processed. :-/
-        data_fullpath = os.path.join(self._tmpdir, "data.csv")
-        data_csv = open(data_fullpath, "wt")
-        data_csv.write("region, station, aggregate, pollutant, day, measurement\n")
-
-        max_file = tempfile.TemporaryFile()
-        avg_file = tempfile.TemporaryFile()
-
-        # generate aggregated data
-        for (region, station, day, pollutant, max_, avg_) in self._yield():
-
-            formula = pollutants_dict.get_formula(pollutant)
-
-            entry = u"%(region)s, %(station)s, max, %(formula)s, %(day)s, %(qty).3f\n" % {
-                'region': region,
-                'station': station,
-                'formula': formula,
-                'day': time.strftime("%Y-%m-%d", day +(0, ) * 6),
-                'qty': max_,
-            }
-            max_file.write(entry)
-
-            entry = u"%(region)s, %(station)s, avg, %(formula)s, %(day)s, %(qty).3f\n" % {
-                'region': region,
-                'station': station,
-                'formula': formula,
-                'day': time.strftime("%Y-%m-%d", day +(0, ) * 6),
-                'qty': avg_,
-            }
-            avg_file.write(entry)
-
-        # concatenate max_file and avg_file files
-        max_file.seek(0)
-        for l in max_file:
-            data_csv.write(l)
-        max_file.close()  # get rid of temp file
-
-        avg_file.seek(0)
-        for l in avg_file:
-            data_csv.write(l)
-        avg_file.close()  # get rid of temp file
-
-        data_csv.close()
-        azip.write(data_fullpath)
-
-        # disk cleanup
-        if (os.path.exists(self._tmpdir)):
-            shutil.rmtree(self._tmpdir, True)  # TODO add something for errors
+        with self._member(azip, "pollutants.csv") as member:
+            csv = self._writer(member)
+            csv.writerow((u"pollutant", u"description"))
+            for (_, formula, description) in pollutants_dict.all():
+                csv.writerow((formula, escape(description)))
+
+        # write pollutants csv files for slice tables, one for each
+        # shard. Remark: as csv files *must* be sorted according to
+        # dimensions (region, station, aggregate, pollutant, day), rows
+        # go through an external sort, with bounded memory. Sorting by
+        # shard first makes each shard a contiguous run of rows.
+        def records():
+            for (region, station, day, pollutant, max_, avg_) in \
+                    daily_aggregates(self._data_mgr, sort=False,
+                                     sort_memory=self._sort_memory):
+
+                formula = pollutants_dict.get_formula(pollutant)
+                shard = self._shard_of(formula, day)
+                yield (shard, region, station, u"max", formula, day, max_)
+                yield (shard, region, station, u"avg", formula, day, avg_)
+
+        # When updating a bundle, new aggregates are merged into the
+        # slice tables of their shards, replacing the ones for the same
+        # station and day. Slice tables of other shards are copied as
+        # they are (see _copy_table).
+        pending = sorted(bundled or ())
+
+        shards = []
+        for (shard, rows) in itertools.groupby(
+                external_sort(records(), self._sort_memory),
+                operator.itemgetter(0)):
+
+            while pending and pending[0] < shard:
+                shards.append(pending[0])
+                self._copy_table(azip, bundle, pending[0],
+                                 bundled[pending.pop(0)])
+
+            if pending and pending[0] == shard:
+                rows = merge_updates(
+                    self._bundle_table(bundle, bundled[pending.pop(0)]), rows)
+
+            shards.append(shard)
+            self._slice_table(azip, shard, rows)
+
+        for shard in pending:
+            shards.append(shard)
+            self._copy_table(azip, bundle, shard, bundled[shard])
+
+        if not shards:
+            shards.append(())
+            self._slice_table(azip, (), [])
+
+        logger.info("Written %d slice table(s)", len(shards))
+
+        # write output to file. This comes last, as it lists the shards
+        # written above.
+        with self._member(azip, "brace.xml") as xml:
+            xml.write(build_dspl_xml(shards))
+
+        azip.close()
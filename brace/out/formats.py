@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Output plugins registry
+"""
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+from brace.out.dspl import DsplDumper
+from brace.out.columnar import ColumnarDumper
+from brace.out.npz import NpzDumper
+from brace.out.jsonl import JsonLinesDumper
+
+# Output plugins, by format name (see brace.opts.FORMATS)
+PLUGINS = {
+    "dspl": DsplDumper,
+    "columnar": ColumnarDumper,
+    "npz": NpzDumper,
+    "jsonl": JsonLinesDumper,
+}
+
+
+def create_dumper(format, data_mgr, out, opts):
+    """Returns a dumper writing the aggregates of data_mgr to out (a
+    file name, the extension of the format is appended unless it has
+    one), in format, as configured by opts (an OptionsManager).
+    """
+    return PLUGINS[format].from_options(data_mgr, out, opts)
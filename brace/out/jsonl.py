@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Newline delimited JSON output services
+"""
+import json
+import itertools
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+from brace.timestamps import format_day
+from brace.out.base import BatchDumper
+
+
+class JsonLinesDumper(BatchDumper):
+    """Writes one JSON object for each daily aggregate, on its own line:
+
+    {"avg": 41.5, "day": "2009-01-31", "max": 63.0, "pollutant": "NO2",
+     "region": "Lombardia", "station": "ARESE"}
+    """
+
+    EXTENSION = ".jsonl"
+
+    def _open(self):
+        self._file = open(self._out, "wb")
+
+    def _write(self, columns):
+        (regions, stations, formulas, days, maxs, avgs) = columns
+
+        self._file.write("".join(
+                json.dumps({
+                    'region': region,
+                    'station': station,
+                    'pollutant': formula,
+                    'day': format_day(day),
+                    'max': max_,
+                    'avg': avg_,
+                }, sort_keys=True) + "\n"
+                for (region, station, formula, day, max_, avg_) in
+                itertools.izip(regions, stations, formulas, days, maxs,
+                               avgs)))
+
+    def _close(self):
+        self._file.close()
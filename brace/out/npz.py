@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""NumPy (.npz) output services. NumPy is optional, this format is
+available only if it is installed (see HAVE_NUMPY).
+"""
+import shutil
+import zipfile
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Temporary files support
+import tempfile
+
+try:
+    import numpy
+    from numpy.lib import format as npformat
+
+except ImportError:
+    numpy = None
+
+# True if NumPy is available
+HAVE_NUMPY = numpy is not None
+
+from brace.out.base import BatchDumper, DEFAULT_BATCH_SIZE
+from brace.out.columnar import ColumnEncoder, COLUMN_TYPES
+from brace.out.zipstream import ZipEntryWriter, DEFAULT_DEFLATE_LEVEL
+from brace.extsort import DEFAULT_SORT_MEMORY
+
+
+class NpzDumper(BatchDumper):
+    """Writes aggregates to a NumPy .npz archive, holding an array for
+    each column (see BatchDumper.COLUMNS), and the dictionaries of the
+    dictionary encoded ones (regions, stations and pollutants):
+
+    >>> data = numpy.load("out.npz")
+    >>> data["stations"][data["station"]]
+
+    Batches are spilled to temporary files, by column, until all of
+    them are written, as the length of the arrays comes first in .npy
+    files.
+    """
+
+    EXTENSION = ".npz"
+
+    def __init__(self, data_mgr, out, sort_memory=DEFAULT_SORT_MEMORY,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 deflate_level=DEFAULT_DEFLATE_LEVEL):
+        if not HAVE_NUMPY:
+            raise ImportError("The npz format requires NumPy")
+
+        super(NpzDumper, self).__init__(data_mgr, out, sort_memory,
+                                        batch_size)
+        self._deflate_level = deflate_level
+
+    @classmethod
+    def from_options(cls, data_mgr, out, opts):
+        return cls(data_mgr, out, opts.sort_memory, opts.batch_size,
+                   opts.deflate_level)
+
+    def _open(self):
+        self._encoder = ColumnEncoder()
+        self._spills = [tempfile.TemporaryFile() for _ in self.COLUMNS]
+        self._rows = 0
+
+    def _write(self, columns):
+        for (column, f) in zip(self._encoder.encode(columns),
+                               self._spills):
+            column.tofile(f)
+
+        self._rows += len(columns[0])
+
+    def _member(self, azip, name):
+        return ZipEntryWriter(azip, name + ".npy", self._deflate_level)
+
+    def _close(self):
+        azip = zipfile.ZipFile(self._out, "w")
+
+        for (name, typecode, f) in zip(self.COLUMNS, COLUMN_TYPES,
+                                       self._spills):
+            with self._member(azip, name) as npy:
+                npformat.write_array_header_1_0(npy, {
+                    'descr': npformat.dtype_to_descr(numpy.dtype(typecode)),
+                    'fortran_order': False,
+                    'shape': (self._rows, ),
+                })
+
+                f.seek(0)
+                shutil.copyfileobj(f, npy)
+
+            f.close()
+
+        # dictionaries, e.g. "stations" for the "station" column
+        for (name, values) in self._encoder.dictionaries.iteritems():
+            with self._member(azip, name + "s") as npy:
+                npformat.write_array(npy, numpy.array(values,
+                                                      dtype=unicode))
+
+        azip.close()
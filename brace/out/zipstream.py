@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Streaming zip archive members
+"""
+import time
+import zlib
+import struct
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Standard collections
+import collections
+
+# zipfile
+import zipfile
+
+# Default deflate level (zlib's own default)
+DEFAULT_DEFLATE_LEVEL = 6
+
+# Data descriptor signature
+DATA_DESCRIPTOR = 0x08074b50
+
+# Size of the blocks deflated in parallel (when a pool is given)
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+# Size of the chunks copied between archives
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+# The helpers below write members into a zipfile.ZipFile through the
+# internals of the Python 2.7 zipfile module (ZipFile.fp, filelist,
+# NameToInfo, _writecheck and _didModify, ZipInfo.FileHeader and the
+# local header layout), which are not part of its public interface.
+# Nothing else in brace relies on them.
+
+def _begin_member(azip, zinfo):
+    """Writes the local header of a new member of azip, described by
+    zinfo, at the current position. Data follows.
+    """
+    zinfo.header_offset = azip.fp.tell()
+
+    azip._writecheck(zinfo)
+    azip._didModify = True
+    azip.fp.write(zinfo.FileHeader(False))
+
+
+def _write_data(azip, data):
+    """Writes data of the member being written into azip.
+    """
+    azip.fp.write(data)
+
+
+def _patch_header(azip, zinfo):
+    """Rewrites the local header of a member of azip, once its crc and
+    sizes are known. The file of azip must be seekable.
+    """
+    end = azip.fp.tell()
+
+    azip.fp.seek(zinfo.header_offset)
+    azip.fp.write(zinfo.FileHeader(False))
+    azip.fp.seek(end)
+
+
+def _end_member(azip, zinfo):
+    """Adds a member, fully written, to the central directory of azip.
+    """
+    azip.filelist.append(zinfo)
+    azip.NameToInfo[zinfo.filename] = zinfo
+
+
+def _member_data(source, name):
+    """Returns the info of a member of source (a zipfile.ZipFile open
+    for reading), with the file of source positioned at its data, past
+    the local header.
+    """
+    src = source.getinfo(name)
+
+    source.fp.seek(src.header_offset)
+    header = struct.unpack(zipfile.structFileHeader,
+                           source.fp.read(zipfile.sizeFileHeader))
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad local header for '%s'" % name)
+
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+                   header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    return src
+
+
+def _read_data(source, size):
+    """Reads up to size bytes of the member of source located by
+    _member_data.
+    """
+    return source.fp.read(size)
+
+
+def deflate_block(data, level, final):
+    """Deflates a block of data on its own. Blocks but the final one end
+    on a byte boundary, without the final bit set, so that they can be
+    concatenated into a single deflate stream. This runs on pool
+    workers.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + \
+        compressor.flush(final and zlib.Z_FINISH or zlib.Z_FULL_FLUSH)
+
+
+class ZipEntryWriter(object):
+    """A file-like object writing a single member straight into a zip
+    archive (a zipfile.ZipFile open for writing), compressing on the
+    fly. Sizes and crc are not known in advance: for deflated members
+    they follow the data, in a data descriptor. Stored members (level
+    0) can not be read without knowing their size upfront, so their
+    local header is rewritten instead, the file of the archive must be
+    seekable.
+
+    Unicode strings are written utf-8 encoded. No other member can be
+    written to the archive until the writer is closed.
+
+    If a pool (a multiprocessing.Pool) is given, data is cut in blocks
+    which are deflated in parallel by the pool workers, then written
+    in order.
+    """
+
+    def __init__(self, azip, arcname, level=DEFAULT_DEFLATE_LEVEL,
+                 pool=None, workers=1):
+        self._azip = azip
+
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0o600 << 16   # ?rw-------
+        zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+
+        self._compressor = None
+        self._level = level
+        if level:
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.flag_bits |= 0x08         # data descriptor follows
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        else:
+            zinfo.compress_type = zipfile.ZIP_STORED
+
+        _begin_member(azip, zinfo)
+
+        self._zinfo = zinfo
+        self._crc = 0
+
+        # parallel compression
+        self._pool = level and pool or None
+        self._window = 2 * workers
+        self._pending = collections.deque()
+        self._blocks = []
+        self._buffered = 0
+
+    def _emit(self, data):
+        _write_data(self._azip, data)
+        self._zinfo.compress_size += len(data)
+
+    def _submit(self, final):
+        """Hands the buffered data over to the pool, as a block, and
+        writes the blocks deflated so far, in order.
+        """
+        data = "".join(self._blocks)
+        (self._blocks, self._buffered) = ([], 0)
+
+        self._pending.append(self._pool.apply_async(
+                deflate_block, (data, self._level, final)))
+
+        while self._pending and (final or
+                                 self._window < len(self._pending) or
+                                 self._pending[0].ready()):
+            self._emit(self._pending.popleft().get())
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        self._crc = zlib.crc32(data, self._crc)
+        self._zinfo.file_size += len(data)
+
+        if self._pool is not None:
+            self._blocks.append(data)
+            self._buffered += len(data)
+            if COMPRESS_BLOCK_SIZE <= self._buffered:
+                self._submit(False)
+
+        elif self._compressor is not None:
+            self._emit(self._compressor.compress(data))
+
+        else:
+            self._emit(data)
+
+    def close(self):
+        zinfo = self._zinfo
+        if self._pool is not None:
+            self._submit(True)
+
+        elif self._compressor is not None:
+            self._emit(self._compressor.flush())
+        self._compressor = None
+
+        if zipfile.ZIP64_LIMIT < max(zinfo.file_size, zinfo.compress_size):
+            raise zipfile.LargeZipFile(
+                "Member '%s' would require ZIP64 extensions" %
+                zinfo.filename)
+
+        zinfo.CRC = self._crc & 0xffffffff
+        if zinfo.flag_bits & 0x08:
+            _write_data(self._azip, struct.pack(
+                    "<LLLL", DATA_DESCRIPTOR, zinfo.CRC,
+                    zinfo.compress_size, zinfo.file_size))
+        else:
+            _patch_header(self._azip, zinfo)
+
+        _end_member(self._azip, zinfo)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def copy_member(azip, source, name):
+    """Copies a member of source (a zipfile.ZipFile open for reading)
+    into azip (a zipfile.ZipFile open for writing) as is, without
+    decompressing and compressing it again.
+    """
+    src = _member_data(source, name)
+
+    zinfo = zipfile.ZipInfo(src.filename, src.date_time)
+    zinfo.external_attr = src.external_attr
+    zinfo.compress_type = src.compress_type
+    zinfo.CRC = src.CRC
+    zinfo.compress_size = src.compress_size
+    zinfo.file_size = src.file_size
+
+    _begin_member(azip, zinfo)
+
+    remaining = src.compress_size
+    while remaining:
+        chunk = _read_data(source, min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipfile("Truncated member '%s'" % name)
+
+        _write_data(azip, chunk)
+        remaining -= len(chunk)
+
+    _end_member(azip, zinfo)
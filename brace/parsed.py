@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Memory mapped binary cache of parsed archives
+"""
+import os
+import sys
+import json
+import struct
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Compact storage support
+import array
+
+# Memory mapping support
+import mmap
+import ctypes
+
+# File header: magic, version, length of the JSON descriptor
+HEADER = struct.Struct("<4sHI")
+MAGIC = "BRPC"
+VERSION = 1
+
+# Columns are aligned to this many bytes
+ALIGNMENT = 8
+
+# array typecodes of the (region, pollutant) columns, which are
+# constant, see brace.data.COLUMN_TYPES
+REGION_TYPECODE = 'H'
+POLLUTANT_TYPECODE = 'H'
+
+# ctypes of the (station, timestamp, quantity) columns, see
+# brace.data.COLUMN_TYPES
+STATION_TYPE = ctypes.c_uint16
+TIMESTAMP_TYPE = ctypes.c_int32
+QUANTITY_TYPE = ctypes.c_double
+
+
+def _align(offset):
+    return -offset % ALIGNMENT
+
+
+class ParsedArchive(object):
+    """The data parsed from an archive (a single region and pollutant),
+    as a read-only view over a memory mapped file. Columns are ctypes
+    arrays backed by the mapping, nothing is copied until this is merged
+    into a DataManager: DataManager.merge copies each column at once,
+    as a buffer, unless station codes need to be translated.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        (magic, version, size) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a parsed archive: '%s'" % path)
+
+        offset = HEADER.size
+        self.descriptor = json.loads(self._mmap[offset: offset + size])
+        offset += size
+
+        rows = self.descriptor["rows"]
+        if self.descriptor["byteorder"] != sys.byteorder:
+            raise ValueError("Byte order mismatch: '%s'" % path)
+
+        views = []
+        for ctype in (STATION_TYPE, TIMESTAMP_TYPE, QUANTITY_TYPE):
+            offset += _align(offset)
+            views.append((ctype * rows).from_buffer(self._mmap, offset))
+            offset += rows * ctypes.sizeof(ctype)
+
+        (self._station, self._timestamp, self._quantity) = views
+
+    def __len__(self):
+        return self.descriptor["rows"]
+
+    @property
+    def regions(self):
+        return [self.descriptor["region"]]
+
+    @property
+    def stations(self):
+        return self.descriptor["stations"]
+
+    @property
+    def columns(self):
+        rows = len(self)
+        return (array.array(REGION_TYPECODE, [0]) * rows, self._station,
+                array.array(POLLUTANT_TYPECODE,
+                            [self.descriptor["pollutant"]]) * rows,
+                self._timestamp, self._quantity)
+
+
+class ParsedCache(object):
+    """Keeps the data parsed from local archives in a fixed width,
+    columnar binary format (station code, hour stamp, quantity), one
+    file for each archive. Files are memory mapped when loaded back.
+
+    Entries are validated against the size and modification time of
+    the archive they were parsed from. Archives which could not be
+    parsed entirely are recorded as well, with the reason and the data
+    parsed before the failure.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # run stats
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key):
+        return os.path.join(self._path, key + ".bin")
+
+    def _failure_entry(self, key):
+        return os.path.join(self._path, key + ".failed")
+
+    def validator(self, archive, identity=None):
+        """Returns the validator of an archive (a local file object).
+        """
+        info = os.fstat(archive.fileno())
+        return "%d:%d" % (info.st_size, info.st_mtime)
+
+    def load(self, key, validator):
+        """Returns a ParsedArchive holding the data parsed from the
+        archive for key, provided it is unchanged. Returns None
+        otherwise.
+        """
+        try:
+            res = ParsedArchive(self._entry(key))
+            if res.descriptor["validator"] == validator:
+                self.hits += 1
+                return res
+
+        except (IOError, ValueError, struct.error), e:
+            logger.debug("No parsed data for '%s' [%s]", key, e)
+
+        self.misses += 1
+        return None
+
+    def failure(self, key, validator):
+        """Returns the reason why the archive for key could not be
+        parsed, provided it is unchanged. Returns None otherwise.
+        """
+        try:
+            with open(self._failure_entry(key), "rb") as f:
+                record = json.load(f)
+
+            if record["validator"] == validator:
+                return record["reason"]
+
+        except (IOError, ValueError, KeyError):
+            pass
+
+        return None
+
+    def save_failure(self, key, validator, reason, data_mgr):
+        """Records that the archive for key could not be parsed
+        entirely, and why, along with the data parsed before the
+        failure (see save and load).
+        """
+        self.save(key, validator, data_mgr)
+
+        path = self._failure_entry(key)
+        with open(path + ".tmp", "wb") as f:
+            json.dump({'validator': validator, 'reason': reason}, f)
+
+        os.rename(path + ".tmp", path)
+
+    def save(self, key, validator, data_mgr):
+        """Records the data parsed from the archive for key, a
+        DataManager holding a single region and pollutant.
+        """
+        (_, station, pollutant, timestamp, quantity) = data_mgr.columns
+        if len(data_mgr.regions) != 1 or len(set(pollutant)) != 1:
+            return  # not a single archive
+
+        descriptor = json.dumps({
+            'validator': validator,
+            'byteorder': sys.byteorder,
+            'rows': len(data_mgr),
+            'region': data_mgr.regions[0],
+            'pollutant': pollutant[0],
+            'stations': data_mgr.stations,
+        })
+
+        path = self._entry(key)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(descriptor)))
+            f.write(descriptor)
+
+            for column in (station, timestamp, quantity):
+                f.write("\0" * _align(f.tell()))
+                column.tofile(f)
+
+        os.rename(tmp, path)
+
+        if os.path.exists(self._failure_entry(key)):
+            os.unlink(self._failure_entry(key))
+
+    def flush(self):
+        pass  # entries are written as they are saved
+
+    def close(self):
+        pass
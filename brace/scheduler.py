@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Concurrent fetch scheduling services
+"""
+import sys
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Standard collections
+import collections
+
+# Threading support
+import threading
+import Queue
+
+# Default number of concurrent fetch workers
+DEFAULT_WORKERS = 4
+
+# Default maximum number of concurrent jobs towards the same host
+DEFAULT_MAX_PER_HOST = 2
+
+# Default minimum delay (in seconds) between two jobs started against
+# the same host
+DEFAULT_THROTTLE = 0.5
+
+# named tuple for a single cell of the pollutant x region x year grid
+FetchJob = collections.namedtuple('FetchJob', 'pollutant, region, year')
+
+
+class HostThrottle(object):
+    """Limits the number of concurrent jobs towards a single host, and
+    enforces a minimum delay between two consecutive job starts (a
+    politeness throttle).
+    """
+
+    def __init__(self, max_concurrent, interval):
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._interval = interval
+        self._next_slot = 0.0
+
+    def __enter__(self):
+        self._semaphore.acquire()
+
+        # reserve the next available start slot
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+
+        if now < slot:
+            time.sleep(slot - now)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._semaphore.release()
+
+
+class FetchScheduler(object):
+    """Runs fetch jobs on a bounded pool of worker threads. Results are
+    yielded in the very same order the jobs were submitted, regardless
+    of the order in which they complete. This way downstream processing
+    is deterministic and output is identical to a sequential run.
+    """
+
+    def __init__(self, fetch, workers=DEFAULT_WORKERS,
+                 max_per_host=DEFAULT_MAX_PER_HOST,
+                 throttle=DEFAULT_THROTTLE, host=None):
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+
+        self._fetch = fetch
+        self._workers = workers
+        self._max_per_host = max_per_host
+        self._throttle = throttle
+        self._host = host or (lambda job: None)
+
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+
+        # per-job fetch latencies (in seconds), in completion order
+        self.latencies = []
+
+        # number of jobs allowed to run ahead of the consumer, this
+        # bounds the number of fetched results waiting to be consumed
+        self._window = 2 * workers
+
+    def _get_throttle(self, host):
+        with self._hosts_lock:
+            try:
+                return self._hosts[host]
+
+            except KeyError:
+                throttle = HostThrottle(self._max_per_host, self._throttle)
+                self._hosts[host] = throttle
+                return throttle
+
+    def _timed_fetch(self, job):
+        started = time.time()
+        res = self._fetch(job)
+        self.latencies.append(time.time() - started)
+
+        return res
+
+    def _run(self, job):
+        host = self._host(job)
+        if host is None:
+            return self._timed_fetch(job)
+
+        with self._get_throttle(host):
+            return self._timed_fetch(job)
+
+    def imap(self, jobs):
+        """Yields (job, result) pairs, in job order. If fetching a job
+        raised an exception, it is re-raised when its turn comes.
+        """
+        jobs = list(jobs)
+
+        pending = Queue.Queue()
+        done = {}
+        cond = threading.Condition()
+
+        def worker():
+            while True:
+                item = pending.get()
+                if item is None:
+                    return
+
+                (index, job) = item
+                try:
+                    outcome = (self._run(job), None)
+
+                except Exception:
+                    outcome = (None, sys.exc_info())
+
+                with cond:
+                    done[index] = outcome
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self._workers, len(jobs)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        submitted = 0
+        try:
+            for (index, job) in enumerate(jobs):
+
+                # keep the pool busy, without running too far ahead
+                while submitted < min(len(jobs), index + self._window):
+                    pending.put((submitted, jobs[submitted]))
+                    submitted += 1
+
+                with cond:
+                    while index not in done:
+                        cond.wait(1.0)  # a timeout keeps ^C responsive
+                    (result, error) = done.pop(index)
+
+                if error is not None:
+                    raise error[0], error[1], error[2]
+
+                yield (job, result)
+
+        finally:
+            # discard jobs not yet started and stop the workers
+            try:
+                while True:
+                    pending.get_nowait()
+
+            except Queue.Empty:
+                pass
+
+            for _ in threads:
+                pending.put(None)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Pooled, persistent (keep-alive) HTTP connections
+"""
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Standard collections
+import collections
+
+# Threading support
+import threading
+
+# HTTP services
+import httplib
+import socket
+import urlparse
+
+# Default number of idle connections retained for each host
+DEFAULT_POOL_SIZE = 4
+
+# Default socket timeout (in seconds)
+DEFAULT_TIMEOUT = 60
+
+# Maximum number of redirects followed for a single request
+MAX_REDIRECTS = 5
+
+
+class PooledResponse(object):
+    """A file-like wrapper around an HTTP response. When closed, the
+    underlying connection goes back to the pool it came from, provided
+    the response has been read completely and the server agreed to
+    keep the connection alive.
+    """
+
+    def __init__(self, session, key, conn, response):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+        self.status = response.status
+        self.reason = response.reason
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+
+        except httplib.HTTPException, e:
+            raise IOError("Broken response [%s]" % e.__class__.__name__)
+
+        # httplib does not complain about a body cut short when
+        # reading in chunks
+        if amt and not data and self._response.length:
+            raise IOError("Truncated response (%d bytes missing)" %
+                          self._response.length)
+
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+
+        (conn, self._conn) = (self._conn, None)
+        if self._response.isclosed() and not self._response.will_close:
+            self._session._release(self._key, conn)
+
+        else:
+            self._response.close()
+            conn.close()
+
+
+class HttpSession(object):
+    """Keeps a pool of persistent connections for each host, so that
+    subsequent requests to the same host can reuse an already
+    established connection. Sessions are thread-safe, a single session
+    is meant to be shared by every fetcher in a run.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+        # run stats
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+
+    def _acquire(self, key, fresh=False):
+        """Returns a connection to key, and whether it is a reused one.
+        Unless fresh is set, idle connections are reused first.
+        """
+        with self._lock:
+            self.requests += 1
+
+            try:
+                if not fresh:
+                    conn = self._idle[key].pop()
+                    self.reused += 1
+                    return (conn, True)
+
+            except IndexError:
+                pass
+
+            self.connections += 1
+
+        (scheme, netloc) = key
+        if scheme == "https":
+            return (httplib.HTTPSConnection(netloc, timeout=self.timeout),
+                    False)
+
+        return (httplib.HTTPConnection(netloc, timeout=self.timeout), False)
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+
+        conn.close()  # pool is full
+
+    def _request(self, key, path, headers, fresh=False):
+        (conn, reused) = self._acquire(key, fresh)
+
+        try:
+            conn.request("GET", path, headers=headers)
+            return (conn, conn.getresponse())
+
+        except (httplib.HTTPException, socket.error), e:
+            conn.close()
+
+            # the server may have dropped an idle connection, retry
+            # once on a newly opened one (other idle connections may be
+            # just as stale).
+            if reused:
+                return self._request(key, path, headers, fresh=True)
+
+            raise IOError("HTTP request failed [%s]" % (str(e) or
+                                                       e.__class__.__name__))
+
+    def open(self, url, headers=None):
+        """Issues a GET request for url, following redirects. Returns a
+        PooledResponse, which must be closed when done with it.
+        """
+        for _ in range(1 + MAX_REDIRECTS):
+            (scheme, netloc, path, params, query, _) = urlparse.urlparse(url)
+            if scheme not in ("http", "https"):
+                raise IOError("Unsupported url scheme '%s'" % scheme)
+
+            key = (scheme, netloc)
+            path = urlparse.urlunparse(("", "", path or "/",
+                                        params, query, ""))
+
+            (conn, response) = self._request(key, path, headers or {})
+            res = PooledResponse(self, key, conn, response)
+
+            location = response.getheader("location")
+            if response.status not in (301, 302, 303, 307) or not location:
+                return res
+
+            res.read()
+            res.close()
+            url = urlparse.urljoin(url, location)
+
+        raise IOError("Too many redirects for '%s'" % url)
+
+    def close(self):
+        """Closes every idle connection.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+
+            self._idle.clear()
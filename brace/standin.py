@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the ISPRA web site. It speaks the same protocol
+(servlet/zipper -> <script> redirect -> download/*.zip), serving
+synthetic archives, with configurable archive size, latency, error rate
+and truncated responses. This allows testing and benchmarking the
+network layer offline.
+
+usage:
+
+    python -m brace.standin [ --port=<port> ] [ --rows=<n> ]
+                            [ --latency=<secs> ] [ --error-rate=<p> ]
+                            [ --truncate-rate=<p> ] [ --seed=<n> ]
+
+Then point brace.py to it with --url-prefix=http://localhost:<port>/zipper
+"""
+import sys
+import time
+import random
+import calendar
+import hashlib
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Options handling
+import getopt
+
+# HTTP services
+import BaseHTTPServer
+import SocketServer
+import urlparse
+
+# Threading support
+import threading
+
+# Zip archives management
+import zipfile
+import cStringIO
+
+# custom modules
+from brace.ontology import pollutants_dict
+from brace.ontology import regions_dict
+from brace.ontology import stations_dict
+
+# Default number of rows in each archive
+DEFAULT_ROWS = 2000
+
+# The servlet page redirects to the generated archive
+REDIRECT_PAGE = """<html>
+<head>
+<script type="text/javascript">window.location="../download/%s";</script>
+</head>
+<body></body>
+</html>
+"""
+
+
+def build_archive(region, pollutant, year, rows):
+    """Builds a synthetic archive for a given region, pollutant and year
+    (all codes), in the same format of the ISPRA ones: a zip holding an
+    iso-8859-1 encoded csv file, one hourly sample per row. Archives are
+    deterministic.
+    """
+    formula = pollutants_dict.get_formula(pollutant)
+
+    stations = [name for (regcode, name, _, _) in stations_dict.all()
+                if regcode == region] or \
+               [u"%s %d" % (regions_dict.get_name(region).upper(), i)
+                for i in range(3)]
+
+    rnd = random.Random("%s_%s_%s" % (region, pollutant, year))
+    origin = calendar.timegm((year, 1, 1, 0, 0, 0))
+    per_station = max(1, rows / len(stations))
+
+    csv = cStringIO.StringIO()
+    for i in range(rows):
+        station = stations[(i / per_station) % len(stations)]
+        stamp = time.gmtime(origin + 3600 * (i % per_station))
+
+        csv.write((u"%s,%s,%s,%.1f\r\n" % (
+                    station, formula, time.strftime("%d-%m-%Y %H", stamp),
+                    rnd.uniform(0, 200))).encode("iso-8859-1"))
+
+    res = cStringIO.StringIO()
+    azip = zipfile.ZipFile(res, "w", zipfile.ZIP_DEFLATED)
+    azip.writestr("%s_%d.csv" % (formula, year), csv.getvalue())
+    azip.close()
+
+    return res.getvalue()
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves servlet and archive requests.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("standin: " + format, *args)
+
+    def _send(self, status, body="", headers=None):
+        self.send_response(status)
+        for (k, v) in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _servlet(self, query):
+        params = urlparse.parse_qs(query)
+        try:
+            key = (int(params["p_reg"][0]), int(params["p_comp"][0]),
+                   int(params["p_anno"][0]))
+
+        except (KeyError, ValueError):
+            self._send(400)
+            return
+
+        location = "%s_%s_%d.zip" % (
+            regions_dict.get_name(key[0]).upper().replace(" ", "_"),
+            pollutants_dict.get_formula(key[1]).upper(), key[2])
+        self.server.locations[location] = key
+
+        self._send(200, REDIRECT_PAGE % location,
+                   {"Content-Type": "text/html"})
+
+    def _download(self, location):
+        try:
+            key = self.server.locations[location]
+
+        except KeyError:
+            self._send(404)
+            return
+
+        body = self.server.archive(*key)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, headers={"ETag": etag})
+            return
+
+        headers = {
+            "Content-Type": "application/zip",
+            "ETag": etag,
+        }
+
+        status = 200
+        offset = 0
+        ranges = self.headers.get("Range", "")
+        if ranges.startswith("bytes=") and \
+                self.headers.get("If-Range", etag) == etag:
+            offset = int(ranges[6:].split("-")[0])
+            if len(body) <= offset:
+                self._send(416)
+                return
+
+            status = 206
+            headers["Content-Range"] = "bytes %d-%d/%d" % (
+                offset, len(body) - 1, len(body))
+
+        body = body[offset:]
+        if self.server.chance(self.server.truncate_rate):
+            # announce the whole body, send only half of it
+            self.send_response(status)
+            for (k, v) in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) / 2])
+            self.close_connection = 1
+            return
+
+        self._send(status, body, headers)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+
+        if self.server.chance(self.server.error_rate):
+            self._send(500)
+            return
+
+        (_, _, path, _, query, _) = urlparse.urlparse(self.path)
+        if path.endswith("/servlet/zipper"):
+            self._servlet(query)
+
+        elif "/download/" in path:
+            self._download(path.rsplit("/", 1)[1])
+
+        else:
+            self._send(404)
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded stand-in server. Archives are built on first request
+    and kept in memory.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, rows=DEFAULT_ROWS, latency=0.0,
+                 error_rate=0.0, truncate_rate=0.0, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinHandler)
+
+        self.rows = rows
+        self.latency = latency
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+
+        self.locations = {}
+
+        self._archives = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url_prefix(self):
+        (host, port) = self.server_address[:2]
+        return "http://%s:%d/zipper" % (host, port)
+
+    def chance(self, p):
+        with self._lock:
+            return self._random.random() < p
+
+    def archive(self, region, pollutant, year):
+        key = (region, pollutant, year)
+        with self._lock:
+            try:
+                return self._archives[key]
+
+            except KeyError:
+                res = build_archive(region, pollutant, year, self.rows)
+                self._archives[key] = res
+                return res
+
+    def start(self):
+        """Serves requests on a background thread.
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def main(args):
+    opts, args = getopt.getopt(args, "", [
+            "help", "port=", "rows=", "latency=", "error-rate=",
+            "truncate-rate=", "seed="])
+
+    port = 8000
+    kwargs = {}
+    for o, a in opts:
+        if o == "--port":
+            port = int(a)
+        elif o == "--rows":
+            kwargs["rows"] = int(a)
+        elif o == "--latency":
+            kwargs["latency"] = float(a)
+        elif o == "--error-rate":
+            kwargs["error_rate"] = float(a)
+        elif o == "--truncate-rate":
+            kwargs["truncate_rate"] = float(a)
+        elif o == "--seed":
+            kwargs["seed"] = int(a)
+        elif o == "--help":
+            print __doc__
+            sys.exit()
+
+    server = StandinServer(("localhost", port), **kwargs)
+    print "Serving on %s" % server.url_prefix
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Persistent store of parsed archives
+"""
+import os
+import json
+import time
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Compact storage support
+import array
+import sqlite3
+
+from brace.data import DataManager, COLUMN_TYPES
+from brace.manifest import fingerprint
+
+# Version of the store layout, stores of other versions are discarded
+STORE_VERSION = 2
+
+SCHEMA = """
+create table if not exists archives (
+    key text primary key,
+    sha1 text not null,
+    regions text not null,
+    stations text not null,
+    region blob not null,
+    station blob not null,
+    pollutant blob not null,
+    timestamp blob not null,
+    quantity blob not null,
+    stored real not null
+);
+
+create table if not exists failures (
+    key text primary key,
+    sha1 text not null,
+    reason text not null,
+    stored real not null
+)
+"""
+
+
+class ArchiveStore(object):
+    """Records the data parsed from each archive (see DataManager),
+    along with the sha1 of the archive it was parsed from. As long as
+    an archive is unchanged, its data can be loaded back from the store
+    instead of being parsed again.
+
+    Archives which could not be parsed entirely are recorded as well,
+    with the reason and the data parsed before the failure, so that
+    they are not parsed again either.
+
+    Data is stored by columns, one record per archive, in a SQLite
+    database.
+    """
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._db = sqlite3.connect(path)
+
+        (version, ) = self._db.execute("pragma user_version").fetchone()
+        if version != STORE_VERSION:
+            logger.debug("Discarding archive store version %d", version)
+            self._db.execute("drop table if exists archives")
+            self._db.execute("drop table if exists failures")
+            self._db.execute("pragma user_version = %d" % STORE_VERSION)
+
+        self._db.executescript(SCHEMA)
+        self._db.commit()
+
+        # run stats
+        self.hits = 0
+        self.misses = 0
+
+    def validator(self, archive, identity=None):
+        """Returns the validator of an archive (a file object), its
+        sha1. Unless the (size, sha1) identity of the archive is known
+        already (see ArchiveCache.identify), the archive is read and
+        rewound.
+        """
+        (_, sha1) = identity or fingerprint(archive)
+        return sha1
+
+    def failure(self, key, sha1):
+        """Returns the reason why the archive for key could not be
+        parsed, provided its sha1 is unchanged. Returns None otherwise.
+        """
+        record = self._db.execute(
+            "select reason from failures where key = ? and sha1 = ?",
+            (key, sha1)).fetchone()
+
+        return record and record[0]
+
+    def load(self, key, sha1):
+        """Returns a DataManager holding the data parsed from the archive
+        for key, provided its sha1 is unchanged. Returns None otherwise.
+        """
+        record = self._db.execute(
+            "select regions, stations, region, station, pollutant, "
+            "timestamp, quantity from archives where key = ? and sha1 = ?",
+            (key, sha1)).fetchone()
+
+        if record is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        columns = []
+        for (typecode, blob) in zip(COLUMN_TYPES, record[2:]):
+            column = array.array(typecode)
+            column.fromstring(str(blob))
+            columns.append(column)
+
+        return DataManager.from_columns(json.loads(record[0]),
+                                        json.loads(record[1]), columns)
+
+    def save(self, key, sha1, data_mgr):
+        """Records the data parsed from the archive for key, a
+        DataManager, replacing any previous record.
+        """
+        self._db.execute(
+            "insert or replace into archives values "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [key, sha1, json.dumps(data_mgr.regions),
+             json.dumps(data_mgr.stations)] +
+            [sqlite3.Binary(column.tostring())
+             for column in data_mgr.columns] + [time.time()])
+        self._db.execute("delete from failures where key = ?", (key, ))
+
+    def save_failure(self, key, sha1, reason, data_mgr):
+        """Records that the archive for key could not be parsed
+        entirely, and why, along with the data parsed before the
+        failure (see save and load), replacing any previous record.
+        """
+        self.save(key, sha1, data_mgr)
+        self._db.execute(
+            "insert or replace into failures values (?, ?, ?, ?)",
+            (key, sha1, reason, time.time()))
+
+    def flush(self):
+        """Commits the records saved so far.
+        """
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
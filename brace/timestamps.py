@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Compact timestamp services. ISPRA timestamps ("%d-%m-%Y %H") are
+represented as integer hours since the epoch (UTC), days as integer
+days since the epoch.
+"""
+import datetime
+
+# Logging support
+import logging
+logger = logging.getLogger("brace")
+
+# Number of hours in a day
+HOURS_PER_DAY = 24
+
+# The epoch, as a date
+EPOCH = datetime.date(1970, 1, 1)
+
+# memoized days since the epoch, by "%d-%m-%Y" prefix. Every station
+# repeats the same stamps, so this stays as small as the date range.
+_days = {}
+
+# memoized "%Y-%m-%d" representations, by day
+_isodays = {}
+
+# memoized days since the epoch, by "%Y-%m-%d" representation
+_fromisodays = {}
+
+
+def parse_day(prefix):
+    """Returns the number of days since the epoch for a "%d-%m-%Y"
+    prefix. Raises ValueError for malformed or invalid dates.
+    """
+    try:
+        return _days[prefix]
+
+    except KeyError:
+        try:
+            (d, m, y) = prefix.split("-")
+            date = datetime.date(int(y), int(m), int(d))
+
+        except (ValueError, TypeError):
+            raise ValueError("Invalid date: '%s'" % prefix)
+
+        res = (date - EPOCH).days
+        _days[prefix] = res
+        return res
+
+
+def parse_hour(stamp):
+    """Returns the number of hours since the epoch for a "%d-%m-%Y %H"
+    timestamp. Raises ValueError for malformed or invalid timestamps.
+    """
+    try:
+        (prefix, hour) = stamp.split(" ")
+        hour = int(hour)
+
+    except (ValueError, AttributeError):
+        raise ValueError("Invalid timestamp: '%s'" % stamp)
+
+    if not 0 <= hour < HOURS_PER_DAY:
+        raise ValueError("Invalid timestamp: '%s'" % stamp)
+
+    return HOURS_PER_DAY * parse_day(prefix) + hour
+
+
+def format_day(day):
+    """Returns the "%Y-%m-%d" representation of a day (since the epoch).
+    """
+    try:
+        return _isodays[day]
+
+    except KeyError:
+        res = (EPOCH + datetime.timedelta(days=day)).isoformat()
+        _isodays[day] = res
+        return res
+
+
+def parse_isoday(text):
+    """Returns the number of days since the epoch for a "%Y-%m-%d" date
+    (see format_day). Raises ValueError for malformed or invalid dates.
+    """
+    try:
+        return _fromisodays[text]
+
+    except KeyError:
+        try:
+            (y, m, d) = text.split("-")
+            date = datetime.date(int(y), int(m), int(d))
+
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError("Invalid date: '%s'" % text)
+
+        res = (date - EPOCH).days
+        _fromisodays[text] = res
+        return res
+
+
+def year_of(day):
+    """Returns the year a day (since the epoch) belongs to.
+    """
+    return int(format_day(day)[:4])
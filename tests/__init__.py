@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""brace test suite. Run it from the top directory with:
+
+    python -m unittest discover -s tests -t .
+"""
+
+# Logging support
+import logging
+logging.getLogger("brace").addHandler(logging.NullHandler())
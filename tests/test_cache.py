@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Archive cache tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import brace.cache
+from brace.cache import ArchiveCache
+
+
+class Clock(object):
+    """Stands in for the time module, each call is a second later.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        self.now += 1
+        return self.now
+
+
+class ArchiveCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._time = brace.cache.time
+        brace.cache.time = Clock()
+
+        self.cache = ArchiveCache(self.tmp)
+        self.cache.max_size = 250  # two 100 bytes archives
+
+    def tearDown(self):
+        brace.cache.time = self._time
+        shutil.rmtree(self.tmp)
+
+    def _store(self, key, data, etag=None):
+        archive = self.cache.store(key, StringIO.StringIO(data), etag)
+        res = archive.read()
+        archive.close()
+        return res
+
+    def _read(self, key):
+        archive = self.cache.open(key)
+        res = archive.read()
+        archive.close()
+        return res
+
+    def test_store(self):
+        self.assertEqual(self._store("3_1_2008", "a" * 100), "a" * 100)
+        self.assertEqual(self._read("3_1_2008"), "a" * 100)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # cached copies are identified without reading them
+        archive = self.cache.open("3_1_2008")
+        (size, sha1) = self.cache.identify(archive)
+        archive.close()
+        self.assertEqual((size, sha1), (100, self.cache.lookup(
+                    "3_1_2008")["sha1"]))
+        self.assertEqual(self.cache.identify(StringIO.StringIO("a")), None)
+
+        self.assertRaises(KeyError, self.cache.open, "3_1_2009")
+
+    def test_lru_eviction(self):
+        self._store("3_1_2008", "a" * 100)
+        self._store("3_1_2009", "b" * 100)
+
+        # the older entry is used again, the newer one is evicted
+        self._read("3_1_2008")
+        self._store("3_1_2010", "c" * 100)
+
+        self.assertEqual(self.cache.lookup("3_1_2009"), None)
+        self.assertEqual(self._read("3_1_2008"), "a" * 100)
+        self.assertEqual(self._read("3_1_2010"), "c" * 100)
+
+        blobs = [name for (_, _, names) in os.walk(
+                os.path.join(self.tmp, "objects")) for name in names]
+        self.assertEqual(len(blobs), 2)
+
+        # the index is shared with other runs
+        other = ArchiveCache(self.tmp)
+        self.assertEqual(sorted(other._index.get(key) is not None
+                                for key in ("3_1_2008", "3_1_2009",
+                                            "3_1_2010")),
+                         [False, True, True])
+
+    def test_eviction_shared_content(self):
+        # identical archives are stored once, and a blob is only
+        # removed along with its last entry
+        self._store("3_1_2008", "a" * 100)
+        self._store("3_5_2008", "a" * 100)
+        self._store("3_1_2009", "b" * 100)
+        for key in ("3_1_2008", "3_5_2008", "3_1_2009"):
+            self.assertNotEqual(self.cache.lookup(key), None)
+
+        self._store("3_1_2010", "c" * 100)
+        self.assertEqual(self.cache.lookup("3_1_2008"), None)
+        self.assertEqual(self.cache.lookup("3_5_2008"), None)
+        self.assertEqual(self._read("3_1_2009"), "b" * 100)
+        self.assertEqual(self._read("3_1_2010"), "c" * 100)
+
+    def test_reconcile_not_modified(self):
+        self._store("3_1_2008", "a" * 100, etag='"v1"')
+        self.assertEqual(self.cache.validators("3_1_2008"),
+                         {"If-None-Match": '"v1"'})
+        self.assertEqual(self.cache.validators("3_1_2009"), {})
+
+        # the (empty) response is discarded for the cached copy
+        response = StringIO.StringIO("")
+        archive = self.cache.reconcile("3_1_2008", response, 304)
+        self.assertTrue(response.closed)
+        self.assertEqual(archive.read(), "a" * 100)
+        archive.close()
+        self.assertEqual(self.cache.hits, 1)
+
+        # the cached copy has gone in the meantime
+        os.unlink(self.cache._blob_path(
+                self.cache.lookup("3_1_2008")["sha1"]))
+        self.assertRaises(KeyError, self.cache.reconcile, "3_1_2008",
+                          StringIO.StringIO(""), 304)
+
+    def test_reconcile_modified(self):
+        self._store("3_1_2008", "a" * 100, etag='"v1"')
+
+        archive = self.cache.reconcile("3_1_2008", StringIO.StringIO(
+                "b" * 100), 200, '"v2"')
+        self.assertEqual(archive.read(), "b" * 100)
+        archive.close()
+        self.assertEqual(self.cache.validators("3_1_2008"),
+                         {"If-None-Match": '"v2"'})
+
+        # other statuses are not cached
+        response = StringIO.StringIO("Not found")
+        self.assertTrue(self.cache.reconcile("3_1_2009", response, 404)
+                        is response)
+        self.assertEqual(self.cache.lookup("3_1_2009"), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
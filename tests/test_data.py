@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""DataManager tests
+"""
+import random
+import unittest
+
+import brace.data
+from brace.data import DataManager, StreamingDataManager
+from brace.aggregate import daily_aggregates
+from brace.exceptions import DataException
+from brace.ontology import stations_dict, pollutants_dict
+from brace.timestamps import parse_hour
+
+
+def archive_rows(seed, stations=5, days=20):
+    """Returns the rows of a synthetic archive (as read from its csv
+    file), in random order.
+    """
+    rnd = random.Random(seed)
+    names = [name for (_, name, _, _) in stations_dict.all()][:stations]
+
+    res = [(name, "NO2", "%02d-01-2009 %02d" % (1 + day, hour),
+            "%.2f" % rnd.uniform(0, 100))
+           for name in names
+           for day in range(days)
+           for hour in range(24)
+           if rnd.random() < 0.9]
+
+    rnd.shuffle(res)
+    return res
+
+
+def aggregates(data_mgr):
+    return [(a.region, a.station, a.day, a.pollutant, a.max,
+             round(a.avg, 9)) for a in daily_aggregates(data_mgr)]
+
+
+class DataManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_mgr = DataManager()
+        self.data_mgr.extend("Lombardia", "NO2", archive_rows(5, days=2))
+
+    def test_select_regions(self):
+        rows = len(self.data_mgr)
+        for ident in (3, "lombardia", u"LOMBARDIA"):
+            self.assertEqual(len(list(self.data_mgr.select(
+                            regions=[ident]))), rows)
+
+        # unknown, or known but not held
+        for ident in (99, "Atlantide", 1, None):
+            self.assertEqual(list(self.data_mgr.select(regions=[ident])),
+                             [])
+
+    def test_select_stations(self):
+        name = self.data_mgr.stations[0]
+        expected = [i for i in range(len(self.data_mgr))
+                    if self.data_mgr.columns[1][i] == 0]
+
+        self.assertEqual(sorted(self.data_mgr.select(
+                    stations=[name.upper(), 42])), expected)
+
+    def _scan(self, predicate):
+        """The ids of the rows matching predicate (a function of the
+        pollutant and timestamp columns), by a full scan.
+        """
+        (_, _, pollutant, timestamp, _) = self.data_mgr.columns
+        return [i for i in range(len(self.data_mgr))
+                if predicate(pollutant[i], timestamp[i])]
+
+    def test_select_time_range(self):
+        start = parse_hour("01-01-2009 06")
+        end = parse_hour("02-01-2009 06")
+
+        # end excluded, as hours or timestamps
+        expected = self._scan(lambda _, stamp: start <= stamp < end)
+        for bounds in ((start, end), ("01-01-2009 06", "02-01-2009 06")):
+            self.assertEqual(sorted(self.data_mgr.select(
+                        start=bounds[0], end=bounds[1])), expected)
+
+        self.assertEqual(sorted(self.data_mgr.select(start=end)),
+                         self._scan(lambda _, stamp: stamp >= end))
+        self.assertEqual(sorted(self.data_mgr.select(end=start)),
+                         self._scan(lambda _, stamp: stamp < start))
+        self.assertEqual(list(self.data_mgr.select(start=end, end=start)),
+                         [])
+
+        # series by series, each in time order
+        (_, station, _, timestamp, _) = self.data_mgr.columns
+        ids = list(self.data_mgr.select(start=start, end=end))
+        keys = [(station[i], timestamp[i]) for i in ids]
+        self.assertEqual(keys, sorted(keys))
+
+    def test_select_pollutants(self):
+        self.data_mgr.extend("Lombardia", "PM10", [
+                (name, "PM10", stamp, qty) for (name, _, stamp, qty)
+                in archive_rows(6, stations=2, days=2)])
+        pm10 = pollutants_dict.get_pk("PM10")
+
+        expected = self._scan(lambda pollutant, _: pollutant == pm10)
+        for ident in ("PM10", pm10):
+            self.assertEqual(sorted(self.data_mgr.select(
+                        pollutants=[ident, "Kryptonite"])), expected)
+
+        self.assertEqual(sorted(self.data_mgr.select(
+                    pollutants=["NO2", "PM10"])), range(len(self.data_mgr)))
+        self.assertEqual(list(self.data_mgr.select(pollutants=[])), [])
+
+        # along with a time range
+        start = parse_hour("02-01-2009 00")
+        self.assertEqual(sorted(self.data_mgr.select(
+                    pollutants=["PM10"], start=start)),
+                         self._scan(lambda pollutant, stamp:
+                                    pollutant == pm10 and stamp >= start))
+
+    def test_take(self):
+        ids = list(self.data_mgr.select(
+                start="01-01-2009 12", end="02-01-2009 12"))
+        res = self.data_mgr.take(ids)
+
+        self.assertEqual([column.typecode for column in res],
+                         [column.typecode for column in
+                          self.data_mgr.columns])
+        self.assertEqual([list(column) for column in res],
+                         [[column[i] for i in ids]
+                          for column in self.data_mgr.columns])
+        self.assertEqual([len(column) for column in self.data_mgr.take([])],
+                         [0] * 5)
+
+    def test_select_after_append(self):
+        # the index is rebuilt as rows are added
+        rows = len(self.data_mgr)
+        self.assertEqual(len(list(self.data_mgr.select())), rows)
+
+        self.data_mgr.append(region="Lombardia",
+                             station=self.data_mgr.stations[0],
+                             pollutant="NO2", timestamp="03-01-2009 00",
+                             quantity="12.5")
+        self.assertEqual(list(self.data_mgr.select(
+                    start="03-01-2009 00")), [rows])
+
+        self.data_mgr.extend("Lombardia", "NO2",
+                             archive_rows(7, days=1))
+        self.assertEqual(sorted(self.data_mgr.select()),
+                         range(len(self.data_mgr)))
+
+
+class StreamingDataManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._max_open_groups = brace.data.MAX_OPEN_GROUPS
+
+    def tearDown(self):
+        brace.data.MAX_OPEN_GROUPS = self._max_open_groups
+
+    def _check(self, rows):
+        data_mgr = DataManager()
+        streaming = StreamingDataManager()
+
+        data_mgr.extend("Lombardia", "NO2", rows)
+        streaming.extend("Lombardia", "NO2", rows)
+
+        self.assertEqual(len(data_mgr), len(streaming))
+        self.assertEqual(aggregates(data_mgr), aggregates(streaming))
+
+    def test_aggregates(self):
+        self._check(archive_rows(1))
+
+    def test_aggregates_recycled(self):
+        # station-days are met again after their accumulator has left
+        # the lookup table
+        brace.data.MAX_OPEN_GROUPS = 7
+        self._check(archive_rows(2))
+
+    def test_merge(self):
+        sink = DataManager()
+        sink.extend("Lombardia", "NO2", archive_rows(3))
+
+        data_mgr = DataManager()
+        data_mgr.merge(sink)
+        streaming = StreamingDataManager()
+        streaming.merge(sink)
+
+        self.assertEqual(aggregates(data_mgr), aggregates(streaming))
+
+    def test_no_rows(self):
+        streaming = StreamingDataManager()
+        streaming.extend("Lombardia", "NO2", archive_rows(4))
+
+        self.assertRaises(DataException, lambda: list(streaming.data))
+        self.assertRaises(DataException, streaming.select)
+        self.assertRaises(DataException, lambda: streaming.columns)
+
+
+if __name__ == "__main__":
+    unittest.main()
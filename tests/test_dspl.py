@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""DSPL bundle tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from brace.opts import opts_mgr
+from brace.data import DataManager
+from brace.ontology import regions_dict
+from brace.out.dspl import DsplDumper, ARCHIVE_DIR
+
+from tests.test_data import archive_rows
+
+
+def data_manager(rows):
+    res = DataManager()
+    res.extend("Lombardia", "NO2", rows)
+    return res
+
+
+class DsplDumperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "out.zip")
+
+        self._regions = opts_mgr.regions
+        opts_mgr.regions = [regions_dict.get_pk("Lombardia")]
+
+        # January, then the first days of January again (other values)
+        # and February
+        self.january = archive_rows(1, days=28)
+        self.update = archive_rows(2, days=3) + \
+            [(station, pollutant, stamp.replace("-01-", "-02-"), qty)
+             for (station, pollutant, stamp, qty) in self.january]
+
+    def tearDown(self):
+        opts_mgr.regions = self._regions
+        shutil.rmtree(self.tmp)
+
+    def _dump(self, rows, path=None, update=False):
+        DsplDumper(data_manager(rows), path or self.path, update=update)()
+
+    def _members(self, path=None):
+        azip = zipfile.ZipFile(path or self.path)
+        self.assertEqual(azip.testzip(), None)
+
+        res = dict((name, azip.read(name)) for name in azip.namelist()
+                   if name.endswith(".csv"))
+        azip.close()
+        return res
+
+    def test_update(self):
+        # updating with the whole data gives the same bundle
+        self._dump(self.january)
+        self._dump(self.january, update=True)
+
+        expected = os.path.join(self.tmp, "expected.zip")
+        self._dump(self.january, expected)
+        self.assertEqual(self._members(), self._members(expected))
+
+        # the days updated are replaced, others retained
+        self._dump(self.update, update=True)
+        self._dump(self.update + [row for row in self.january
+                                  if int(row[2][:2]) > 3], expected)
+        self.assertEqual(self._members(), self._members(expected))
+
+        # and again
+        self._dump(self.update, update=True)
+        self.assertEqual(self._members(), self._members(expected))
+
+    def test_update_legacy(self):
+        # tables of older bundles: ", " separated, max rows first
+        self._dump(self.january)
+        members = self._members()
+
+        lines = members[ARCHIVE_DIR + "data.csv"].splitlines()
+        rows = sorted(lines[1:], key=lambda line: line.split(",")[2] != "max")
+
+        azip = zipfile.ZipFile(self.path, "w")
+        for (name, data) in members.iteritems():
+            if name.endswith("data.csv"):
+                data = "\n".join([lines[0]] + rows) + "\n"
+            azip.writestr(name, data.replace(",", ", "))
+        azip.close()
+
+        self._dump(self.update, update=True)
+
+        expected = os.path.join(self.tmp, "expected.zip")
+        self._dump(self.update + [row for row in self.january
+                                  if int(row[2][:2]) > 3], expected)
+        self.assertEqual(self._members(), self._members(expected))
+
+    def test_check(self):
+        data_mgr = data_manager(self.january)
+        DsplDumper(data_mgr, self.path, update=True).check()
+
+        self._dump(self.january)
+        DsplDumper(data_mgr, self.path, update=True).check()
+        DsplDumper(data_mgr, self.path, shard="year").check()
+        self.assertRaises(ValueError, DsplDumper(
+                data_mgr, self.path, shard="year", update=True).check)
+
+        with open(self.path, "w") as f:
+            f.write("not a bundle")
+        self.assertRaises(ValueError, DsplDumper(
+                data_mgr, self.path, update=True).check)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""External sort and bounded aggregation tests
+"""
+import random
+import unittest
+
+import brace.extsort
+from brace.extsort import external_sort
+from brace.aggregate import group_by, bounded_group_by, GROUP_SIZE
+
+
+def records(seed, count=5000):
+    rnd = random.Random(seed)
+    return [(rnd.randrange(50), rnd.randrange(1000), u"r%d" % i,
+             rnd.uniform(0, 100))
+            for i in range(count)]
+
+
+class ExternalSortTest(unittest.TestCase):
+
+    def setUp(self):
+        self._spill = brace.extsort._spill
+        self.runs = []
+
+        def spill(run):
+            self.runs.append(len(run))
+            return self._spill(run)
+
+        brace.extsort._spill = spill
+
+    def tearDown(self):
+        brace.extsort._spill = self._spill
+
+    def test_in_memory(self):
+        data = records(1)
+        self.assertEqual(list(external_sort(iter(data))), sorted(data))
+        self.assertEqual(self.runs, [])
+
+    def test_spilled(self):
+        # a few hundred records per run
+        data = records(2)
+        self.assertEqual(list(external_sort(iter(data), 0.05)),
+                         sorted(data))
+        self.assertTrue(len(self.runs) > 10)
+        self.assertEqual(sum(self.runs), len(data))
+
+    def test_empty(self):
+        self.assertEqual(list(external_sort(iter([]), 0.05)), [])
+
+
+class BoundedGroupByTest(unittest.TestCase):
+
+    def _check(self, max_memory):
+        rnd = random.Random(3)
+        keys = [(rnd.randrange(3), rnd.randrange(20), 8, rnd.randrange(30))
+                for _ in range(20000)]
+        values = [rnd.uniform(0, 100) for _ in keys]
+
+        expected = group_by(keys, values)
+        res = dict(bounded_group_by(iter(keys), values, max_memory))
+
+        self.assertEqual(sorted(res), sorted(expected))
+        for (key, (max_, sum_, count)) in expected.iteritems():
+            self.assertEqual(res[key][0], max_)
+            self.assertAlmostEqual(res[key][1], sum_)
+            self.assertEqual(res[key][2], count)
+
+    def test_in_memory(self):
+        self._check(1)
+
+    def test_spilled(self):
+        # 100 groups at once, out of 1800
+        self._check(100.0 * GROUP_SIZE / 1024 / 1024)
+
+
+if __name__ == "__main__":
+    unittest.main()
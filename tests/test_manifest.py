@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Location manifest tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+import brace.network
+from brace.network import query, session
+from brace.manifest import LocationManifest, fingerprint
+from brace.standin import StandinServer, StandinHandler
+
+
+class CountingHandler(StandinHandler):
+    """Counts the servlet requests.
+    """
+
+    def _servlet(self, query):
+        self.server.servlet_requests += 1
+        StandinHandler._servlet(self, query)
+
+
+class LocationManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "manifest.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_record(self):
+        manifest = LocationManifest(self.path)
+        archive = StringIO.StringIO("PK" + "a" * 100)
+        archive.read(10)
+
+        manifest.record("3_5_2008", "LOMBARDIA_PM10_2008.zip", archive)
+        self.assertEqual(archive.tell(), 0)
+        self.assertEqual(manifest.get("3_5_2008"), {
+                'location': "LOMBARDIA_PM10_2008.zip",
+                'size': 102, 'sha1': fingerprint(archive)[1]})
+
+        # a known identity, nothing is read
+        manifest.record("3_5_2009", "LOMBARDIA_PM10_2009.zip", None,
+                        (10, "sha1"))
+        self.assertEqual(manifest.location("3_5_2009"),
+                         "LOMBARDIA_PM10_2009.zip")
+
+        # changes are saved when flushed
+        self.assertEqual(LocationManifest(self.path).get("3_5_2008"), None)
+        manifest.flush()
+        other = LocationManifest(self.path)
+        self.assertEqual(other.get("3_5_2008"), manifest.get("3_5_2008"))
+
+        other.forget("3_5_2008")
+        self.assertEqual(other.location("3_5_2008"), None)
+        other.flush()
+        self.assertEqual(LocationManifest(self.path).location("3_5_2008"),
+                         None)
+        self.assertEqual(LocationManifest(self.path).location("3_5_2009"),
+                         "LOMBARDIA_PM10_2009.zip")
+
+
+class KnownLocationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandinServer(("localhost", 0), rows=100, seed=1)
+        self.server.RequestHandlerClass = CountingHandler
+        self.server.servlet_requests = 0
+        self.server.start()
+
+        self.tmp = tempfile.mkdtemp()
+        self.manifest = LocationManifest(os.path.join(self.tmp,
+                                                      "manifest.json"))
+
+        self._url_prefix = brace.network.URL_PREFIX
+        brace.network.URL_PREFIX = self.server.url_prefix
+
+    def tearDown(self):
+        brace.network.URL_PREFIX = self._url_prefix
+
+        session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _query(self):
+        archive = query(3, 5, 2008, manifest=self.manifest)
+        try:
+            self.assertEqual(archive.read(), self.server.archive(3, 5, 2008))
+
+        finally:
+            archive.close()
+
+    def test_hit(self):
+        self._query()
+        self.assertEqual(self.server.servlet_requests, 1)
+        self.assertEqual(self.manifest.location("3_5_2008"),
+                         "LOMBARDIA_PM10_2008.zip")
+
+        # the servlet round trip is skipped
+        self._query()
+        self._query()
+        self.assertEqual(self.server.servlet_requests, 1)
+
+    def test_stale(self):
+        self.manifest.record("3_5_2008", "GONE.zip", None, (10, "sha1"))
+
+        # the stale location is forgotten, and resolved again
+        self._query()
+        self.assertEqual(self.server.servlet_requests, 1)
+        self.assertEqual(self.manifest.get("3_5_2008")["location"],
+                         "LOMBARDIA_PM10_2008.zip")
+        self.assertEqual(self.manifest.get("3_5_2008")["size"],
+                         len(self.server.archive(3, 5, 2008)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Network layer tests, against the local stand-in server
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+import brace.network
+import brace.asyncnet
+from brace.network import query, session
+from brace.asyncnet import AsyncEngine
+from brace.manifest import LocationManifest
+from brace.standin import StandinServer, StandinHandler
+
+
+class RecordingHandler(StandinHandler):
+    """Records the Range header of archive requests.
+    """
+
+    def _download(self, location):
+        self.server.ranges.append(self.headers.get("Range"))
+        StandinHandler._download(self, location)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandinServer(("localhost", 0), rows=3000,
+                                    truncate_rate=0.5, seed=1)
+        self.server.RequestHandlerClass = RecordingHandler
+        self.server.ranges = []
+        self.server.start()
+
+        self._url_prefix = brace.network.URL_PREFIX
+        self._backoff_delay = brace.network.backoff_delay
+        brace.network.URL_PREFIX = self.server.url_prefix
+        brace.network.backoff_delay = lambda attempts: 0.0
+
+    def tearDown(self):
+        brace.network.URL_PREFIX = self._url_prefix
+        brace.network.backoff_delay = self._backoff_delay
+
+        session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_truncated_downloads_are_resumed(self):
+        for year in range(2003, 2009):
+            archive = query(3, 5, year)
+            try:
+                self.assertEqual(archive.read(),
+                                 self.server.archive(3, 5, year))
+
+                archive.seek(0)
+                self.assertEqual(zipfile.ZipFile(archive).testzip(), None)
+
+            finally:
+                archive.close()
+
+        # some of the transfers have been cut short, and resumed
+        self.assertTrue([r for r in self.server.ranges if r])
+
+
+class MissingHandler(StandinHandler):
+    """There is no data for Piemonte (404).
+    """
+
+    def _download(self, location):
+        if location.startswith("PIEMONTE_"):
+            self._send(404, "Not found")
+            return
+
+        StandinHandler._download(self, location)
+
+
+class MissingDataTest(unittest.TestCase):
+
+    # (pollutant, region, year) jobs, Piemonte has no data
+    JOBS = [(5, 3, 2008), (5, 1, 2008), (5, 3, 2009)]
+
+    def setUp(self):
+        self.server = StandinServer(("localhost", 0), rows=100, seed=1)
+        self.server.RequestHandlerClass = MissingHandler
+        self.server.start()
+
+        self.tmp = tempfile.mkdtemp()
+
+        self._url_prefix = brace.network.URL_PREFIX
+        self._backoff_delay = brace.asyncnet.backoff_delay
+        brace.network.URL_PREFIX = self.server.url_prefix
+        brace.asyncnet.backoff_delay = lambda attempts: 0.0
+
+    def tearDown(self):
+        brace.network.URL_PREFIX = self._url_prefix
+        brace.asyncnet.backoff_delay = self._backoff_delay
+
+        session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _check(self, results):
+        for ((pollutant, region, year), archive) in results:
+            try:
+                if region == 1:
+                    self.assertEqual(archive.read(), "Not found")
+                else:
+                    self.assertEqual(archive.read(), self.server.archive(
+                            region, pollutant, year))
+            finally:
+                archive.close()
+
+    def test_threads(self):
+        self._check(((pollutant, region, year),
+                     query(region, pollutant, year))
+                    for (pollutant, region, year) in self.JOBS)
+
+    def test_async(self):
+        # missing data is a result, not an error
+        engine = AsyncEngine(prefix=self.server.url_prefix)
+        self._check(list(engine.imap(self.JOBS)))
+
+    def test_async_known_locations(self):
+        manifest = LocationManifest(os.path.join(self.tmp, "manifest.json"))
+        for _ in range(2):
+            engine = AsyncEngine(prefix=self.server.url_prefix,
+                                 manifest=manifest)
+            self._check(list(engine.imap(self.JOBS)))
+
+        # archives which are not available are not worth remembering
+        self.assertEqual(manifest.location("1_5_2008"), None)
+        self.assertTrue(manifest.location("3_5_2008"))
+
+
+if __name__ == "__main__":
+    unittest.main()
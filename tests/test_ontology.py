@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""Stations spatial index tests
+"""
+import random
+import unittest
+
+from brace.ontology import StationsGrid, great_circle, stations_dict
+
+
+def stations(seed, count=500):
+    """Synthetic (pk, name, latitude, longitude) stations, spread over
+    northern Italy along with a few far away ones.
+    """
+    rnd = random.Random(seed)
+    res = [(i, u"S%d" % i, rnd.uniform(44.0, 47.0), rnd.uniform(6.5, 13.0))
+           for i in range(count)]
+    res += [(count, u"Nord", 78.2, 15.6), (count + 1, u"Sud", -33.9, 18.4)]
+    return res
+
+
+class StationsGridTest(unittest.TestCase):
+
+    def _check_nearest(self, grid, stations, points):
+        for (latitude, longitude) in points:
+            expected = min(great_circle(latitude, longitude, s[2], s[3])
+                           for s in stations)
+            res = grid.nearest(latitude, longitude)
+
+            # the same distance, ties being broken either way
+            self.assertAlmostEqual(great_circle(latitude, longitude,
+                                                res[2], res[3]), expected)
+
+    def _check_within(self, grid, stations, boxes):
+        for (south, west, north, east) in boxes:
+            expected = sorted(s for s in stations
+                              if south <= s[2] <= north and
+                              west <= s[3] <= east)
+            self.assertEqual(sorted(grid.within(south, west, north, east)),
+                             expected)
+
+    def test_nearest(self):
+        rnd = random.Random(1)
+        data = stations(2)
+        grid = StationsGrid(data)
+
+        # within the grid, around it and far from it
+        points = [(rnd.uniform(43.0, 48.0), rnd.uniform(5.0, 14.0))
+                  for _ in range(300)]
+        points += [(rnd.uniform(-60, 80), rnd.uniform(-180, 180))
+                   for _ in range(100)]
+        points += [(s[2], s[3]) for s in data[:20]]
+        self._check_nearest(grid, data, points)
+
+        # a coarser and a finer grid
+        for cell_size in (2.0, 0.05):
+            self._check_nearest(StationsGrid(data, cell_size), data,
+                                points[:100])
+
+    def test_within(self):
+        rnd = random.Random(3)
+        data = stations(4)
+        grid = StationsGrid(data)
+
+        boxes = []
+        for _ in range(200):
+            (south, north) = sorted(rnd.uniform(43.5, 47.5) for _ in "ab")
+            (west, east) = sorted(rnd.uniform(6.0, 13.5) for _ in "ab")
+            boxes.append((south, west, north, east))
+        boxes += [(-90, -180, 90, 180), (45, 9, 45, 9), (46, 10, 45, 9)]
+
+        # station coordinates lie on the boundary
+        boxes += [(s[2], s[3], s[2], s[3]) for s in data[:10]]
+        self._check_within(grid, data, boxes)
+
+    def test_empty(self):
+        grid = StationsGrid([])
+        self.assertEqual(grid.nearest(45.0, 9.0), None)
+        self.assertEqual(grid.within(-90, -180, 90, 180), [])
+
+    def test_stations_dict(self):
+        data = stations_dict.all()
+        grid = StationsGrid(data)
+
+        rnd = random.Random(5)
+        self._check_nearest(grid, data, [(rnd.uniform(44.5, 46.7),
+                                          rnd.uniform(8.4, 11.5))
+                                         for _ in range(100)])
+        self.assertEqual(sorted(stations_dict.within(44.5, 8.4, 46.7, 11.5)),
+                         sorted(s for s in data if 44.5 <= s[2] <= 46.7 and
+                                8.4 <= s[3] <= 11.5))
+
+
+if __name__ == "__main__":
+    unittest.main()
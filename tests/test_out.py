@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Output plugins tests
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import itertools
+
+from brace.data import DataManager
+from brace.aggregate import daily_aggregates
+from brace.ontology import pollutants_dict
+from brace.timestamps import format_day
+from brace.out.base import Dumper, BatchDumper
+from brace.out.columnar import ColumnarDumper, ColumnarFile
+from brace.out.jsonl import JsonLinesDumper
+from brace.out.npz import NpzDumper, HAVE_NUMPY
+
+from tests.test_data import archive_rows
+
+if HAVE_NUMPY:
+    import numpy
+
+
+def data_manager():
+    res = DataManager()
+    res.extend("Lombardia", "NO2", archive_rows(1))
+    res.extend("Lombardia", "PM10",
+               [(station, "PM10", stamp, qty) for (station, _, stamp, qty)
+                in archive_rows(2, stations=3)])
+    return res
+
+
+def expected(data_mgr):
+    """The (region, station, formula, day, max, avg) aggregates of
+    data_mgr, in output order.
+    """
+    return sorted((a.region, a.station, pollutants_dict.get_formula(
+                a.pollutant), a.day, a.max, a.avg)
+                  for a in daily_aggregates(data_mgr))
+
+
+class DumperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data_mgr = data_manager()
+        self.expected = expected(self.data_mgr)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, Dumper, self.data_mgr, "out")
+
+        class Incomplete(BatchDumper):
+            def _open(self):
+                pass
+
+        self.assertRaises(TypeError, Incomplete, self.data_mgr, "out")
+
+    def test_columnar(self):
+        # several blocks, the last one partial
+        out = os.path.join(self.tmp, "out")
+        ColumnarDumper(self.data_mgr, out, batch_size=100)()
+
+        f = ColumnarFile(out + ".brc")
+        self.assertEqual(len(f), len(self.expected))
+        self.assertEqual(f.columns, list(BatchDumper.COLUMNS))
+
+        names = [f.dictionaries[name]
+                 for name in ("region", "station", "pollutant")]
+        res = []
+        for block in f.blocks():
+            self.assertTrue(len(block[0]) <= 100)
+            for row in itertools.izip(*block):
+                res.append(tuple(values[code] for (values, code) in
+                                 zip(names, row[:3])) + row[3:])
+        f.close()
+
+        self.assertEqual(res, self.expected)
+
+    def test_jsonl(self):
+        out = os.path.join(self.tmp, "out.jsonl")
+        JsonLinesDumper(self.data_mgr, out, batch_size=100)()
+
+        with open(out) as f:
+            res = [json.loads(line) for line in f]
+
+        self.assertEqual(res, [{
+                    'region': region, 'station': station,
+                    'pollutant': formula, 'day': format_day(day),
+                    'max': max_, 'avg': avg_,
+                    } for (region, station, formula, day, max_, avg_)
+                               in self.expected])
+
+    @unittest.skipIf(not HAVE_NUMPY, "NumPy is not installed")
+    def test_npz(self):
+        out = os.path.join(self.tmp, "out")
+        NpzDumper(self.data_mgr, out, batch_size=100)()
+
+        data = numpy.load(out + ".npz")
+        res = zip(data["regions"][data["region"]],
+                  data["stations"][data["station"]],
+                  data["pollutants"][data["pollutant"]],
+                  data["day"], data["max"], data["avg"])
+
+        self.assertEqual([tuple(row) for row in res], self.expected)
+        data.close()
+
+    @unittest.skipIf(HAVE_NUMPY, "NumPy is installed")
+    def test_npz_unavailable(self):
+        self.assertRaises(ImportError, NpzDumper, self.data_mgr, "out")
+
+
+if __name__ == "__main__":
+    unittest.main()
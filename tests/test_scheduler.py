@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Fetch scheduler tests
+"""
+import time
+import threading
+import unittest
+
+from brace.scheduler import FetchScheduler, FetchJob
+
+
+def jobs(count=30):
+    return [FetchJob("NO2", "Lombardia", 2000 + i) for i in range(count)]
+
+
+class FetchSchedulerTest(unittest.TestCase):
+
+    def test_order(self):
+        # later jobs complete first
+        def fetch(job):
+            time.sleep(0.001 * (2030 - job.year))
+            return job.year
+
+        scheduler = FetchScheduler(fetch, workers=4, throttle=0)
+        res = list(scheduler.imap(jobs()))
+
+        self.assertEqual(res, [(job, job.year) for job in jobs()])
+        self.assertEqual(len(scheduler.latencies), len(jobs()))
+
+    def test_error(self):
+        fetched = []
+        lock = threading.Lock()
+
+        def fetch(job):
+            with lock:
+                fetched.append(job)
+            if job.year == 2005:
+                raise IOError("Could not fetch %d" % job.year)
+            return job.year
+
+        res = []
+        scheduler = FetchScheduler(fetch, workers=3, throttle=0)
+        try:
+            for (job, year) in scheduler.imap(jobs()):
+                res.append(year)
+
+        except IOError, e:
+            self.assertEqual(str(e), "Could not fetch 2005")
+
+        else:
+            self.fail("IOError not raised")
+
+        # the results before the failing job are yielded, in order, and
+        # the jobs far ahead of it are never started
+        self.assertEqual(res, range(2000, 2005))
+        self.assertTrue(len(fetched) < len(jobs()))
+
+    def test_host_throttle(self):
+        running = [0, 0]
+        lock = threading.Lock()
+
+        def fetch(job):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return job.year
+
+        scheduler = FetchScheduler(fetch, workers=6, max_per_host=2,
+                                   throttle=0, host=lambda job: "host")
+        self.assertEqual([year for (_, year) in scheduler.imap(jobs(12))],
+                         range(2000, 2012))
+        self.assertTrue(running[1] <= 2)
+
+    def test_workers(self):
+        self.assertRaises(ValueError, FetchScheduler, None, workers=0)
+        self.assertEqual(list(FetchScheduler(None).imap([])), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Compact timestamps tests
+"""
+import time
+import random
+import calendar
+import unittest
+
+from brace.timestamps import parse_hour, parse_day, format_day, \
+    parse_isoday, year_of, HOURS_PER_DAY
+
+
+def reference_hour(stamp):
+    """Hours since the epoch of a "%d-%m-%Y %H" timestamp, the slow
+    way.
+    """
+    return calendar.timegm(time.strptime(stamp, "%d-%m-%Y %H")) // 3600
+
+
+class TimestampsTest(unittest.TestCase):
+
+    def test_parse_hour(self):
+        rnd = random.Random(1)
+        stamps = ["01-01-1970 00", "31-12-1969 23", "29-02-2008 12",
+                  "31-12-2009 23", "01-03-2100 05"]
+        stamps += ["%02d-%02d-%d %02d" % (rnd.randint(1, 28),
+                                          rnd.randint(1, 12),
+                                          rnd.randint(1950, 2030),
+                                          rnd.randrange(HOURS_PER_DAY))
+                   for _ in range(1000)]
+
+        for stamp in stamps:
+            self.assertEqual(parse_hour(stamp), reference_hour(stamp))
+            # memoized
+            self.assertEqual(parse_hour(stamp), reference_hour(stamp))
+
+        # unpadded fields, as strptime accepts them
+        self.assertEqual(parse_hour("1-3-2008 7"),
+                         reference_hour("01-03-2008 07"))
+
+    def test_parse_hour_invalid(self):
+        for stamp in ("", "01-01-2008", "01-01-2008 24", "01-01-2008 -1",
+                      "30-02-2008 00", "01-13-2008 00", "01/01/2008 00",
+                      "01-01-2008 0a", "01-01-2008  00", None, 42):
+            self.assertRaises(ValueError, parse_hour, stamp)
+
+    def test_days(self):
+        for day in range(-800, 20000, 7):
+            text = format_day(day)
+            self.assertEqual(parse_isoday(text), day)
+            self.assertEqual(year_of(day), int(text[:4]))
+            self.assertEqual(parse_day("-".join(reversed(text.split("-")))),
+                             day)
+
+        self.assertRaises(ValueError, parse_isoday, "2008-02-30")
+        self.assertRaises(ValueError, parse_day, "2008-01-01 00")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Streaming zip members tests
+"""
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zipfile
+import multiprocessing
+
+import brace.out.zipstream
+from brace.out.zipstream import ZipEntryWriter, copy_member
+
+
+def content(seed, size=300000):
+    rnd = random.Random(seed)
+    return "".join("%d, %.2f\n" % (rnd.randrange(1000), rnd.uniform(0, 100))
+                   for _ in xrange(size // 10))
+
+
+class ZipEntryWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "out.zip")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, members, level, pool=None):
+        azip = zipfile.ZipFile(self.path, "w")
+        for (name, data) in members:
+            with ZipEntryWriter(azip, name, level, pool, 2) as member:
+                for i in xrange(0, len(data), 7777):
+                    member.write(data[i: i + 7777])
+        azip.close()
+
+    def _check(self, members):
+        azip = zipfile.ZipFile(self.path)
+        self.assertEqual(azip.testzip(), None)
+        self.assertEqual(azip.namelist(), [name for (name, _) in members])
+        for (name, data) in members:
+            self.assertEqual(azip.read(name), data)
+        azip.close()
+
+    def _local_flags(self, name):
+        azip = zipfile.ZipFile(self.path)
+        with open(self.path, "rb") as f:
+            f.seek(azip.getinfo(name).header_offset)
+            header = struct.unpack(zipfile.structFileHeader,
+                                   f.read(zipfile.sizeFileHeader))
+        azip.close()
+
+        return (header[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS],
+                header[zipfile._FH_CRC])
+
+    def test_levels(self):
+        members = [("a.csv", content(1)), ("empty.csv", ""),
+                   (u"b/c.csv", content(2))]
+
+        for level in (0, 1, 6, 9):
+            self._write(members, level)
+            self._check(members)
+
+    def test_stored(self):
+        data = content(3)
+        self._write([("a.csv", data)], 0)
+
+        # sizes and crc are in the local header, not in a descriptor
+        (flags, crc) = self._local_flags("a.csv")
+        self.assertEqual(flags & 0x08, 0)
+        self.assertEqual(crc, zipfile.crc32(data) & 0xffffffff)
+        self._check([("a.csv", data)])
+
+    def test_pool(self):
+        block_size = brace.out.zipstream.COMPRESS_BLOCK_SIZE
+        brace.out.zipstream.COMPRESS_BLOCK_SIZE = 50000
+
+        pool = multiprocessing.Pool(2)
+        try:
+            members = [("a.csv", content(4)), ("b.csv", content(5, 1000))]
+            self._write(members, 6, pool)
+            self._check(members)
+
+        finally:
+            pool.close()
+            pool.join()
+            brace.out.zipstream.COMPRESS_BLOCK_SIZE = block_size
+
+    def test_copy_member(self):
+        members = [("a.csv", content(6)), ("b.csv", content(7))]
+        for level in (0, 6):
+            self._write(members, level)
+
+            copy = os.path.join(self.tmp, "copy.zip")
+            source = zipfile.ZipFile(self.path)
+            azip = zipfile.ZipFile(copy, "w")
+            with ZipEntryWriter(azip, "new.csv", level) as member:
+                member.write(u"città\n")
+            for (name, _) in reversed(members):
+                copy_member(azip, source, name)
+            azip.close()
+            source.close()
+
+            os.rename(copy, self.path)
+            self._check([("new.csv", u"città\n".encode("utf-8"))] +
+                        list(reversed(members)))
+
+
+if __name__ == "__main__":
+    unittest.main()